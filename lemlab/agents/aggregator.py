@@ -55,7 +55,7 @@ class Aggregator:
         self.matched_bids = None
         self.matched_bids_by_timestep = None
 
-    def pre_clearing_activity(self, db_obj, flag_retrain_forecasts, clear_positions=False):
+    def pre_clearing_activity(self, db_obj, flag_retrain_forecasts, clear_positions=False, results_market=None):
         """
         Executes all activities required before the market is cleared.
 
@@ -63,6 +63,7 @@ class Aggregator:
         :param flag_retrain_forecasts: bool, if True, forecasts models are retrained
         :param clear_positions: bool, if True, clear all open positions from ex-ante markets before posting
                                       new positions
+        :param results_market: dict, prefetched market results by market agent, see get_market_results()
 
         :return None:
         """
@@ -71,7 +72,7 @@ class Aggregator:
         if flag_retrain_forecasts:
             self.retrain_forecasts()
         self.get_predictions()
-        self.get_market_results(db_obj=db_obj)
+        self.get_market_results(db_obj=db_obj, results_market=results_market)
         self.market_agent(db_obj=db_obj, clear_positions=clear_positions)
 
     def post_clearing_activity(self, db_obj):
@@ -94,7 +95,7 @@ class Aggregator:
         :return None:
         """
         # get contents of user info table
-        user_info = db_obj.get_info_user(self.config_dict["id_user"])
+        user_info = db_obj.get_info_user(self.config_dict["id_user"], balances=False)
 
         # update the config dict using the user info table
         self.config_dict["max_bid"] = \
@@ -117,18 +118,24 @@ class Aggregator:
         with open(f"{self.path}/config_account.json", "w") as write_file:
             json.dump(self.config_dict, write_file)
 
-    def get_market_results(self, db_obj):
+    def get_market_results(self, db_obj, results_market=None):
         """
         Retrieve ex-ante market results for the market participant
 
         :param db_obj: DatabaseConnection instance, provides database connection
+        :param results_market: dict, market results prefetched for several market agents, see
+                               DatabaseConnection.get_results_market_ex_ante_by_user(). The results are queried if
+                               None or if the market agent is missing
 
         :return None:
         """
+        if results_market is not None:
+            results_market = results_market.get(self.config_dict['id_market_agent'])
         self.matched_bids, self.matched_bids_by_timestep = db_obj.get_results_market_ex_ante(
             id_user=self.config_dict['id_market_agent'],
             ts_delivery_first=self.ts_delivery_prev,
-            ts_delivery_last=self.ts_delivery_current + self.config_dict["ma_horizon"]*900
+            ts_delivery_last=self.ts_delivery_current + self.config_dict["ma_horizon"]*900,
+            results_market=results_market
             )
 
     def market_agent(self, db_obj, clear_positions=False):
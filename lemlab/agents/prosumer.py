@@ -6,15 +6,20 @@ __email__ = "sebastian.lumpp@tum.de"
 
 import json
 import datetime
-import feather as ft
+import threading
 import pandas as pd
 import numpy as np
 from pyomo import environ as pyo
 from typing import Union
 from random import random
 from lemlab.utilities.forecasting import ForecastManager
+from lemlab.utilities.state_store import StateStore
 from bisect import bisect_left
 
+# pyomo solver interfaces are not thread-safe. Prosumers stepped concurrently (see AsyncDatabaseConnection) solve
+# their optimization models one after another
+_lock_solver = threading.Lock()
+
 
 class Prosumer:
     """Prosumer defines objects and methods used to simulate a single family home in a local energy market
@@ -27,7 +32,8 @@ class Prosumer:
                         2)  PV plants with or without battery storage
                         3)  Market agents for trading in double-sided electricity markets
 
-       Instances of the Prosumer class are created and destroyed once each Simulation step.
+       Instances of the Prosumer class are created and destroyed once each Simulation step, unless agents are
+       persistent. Persistent instances are kept in memory across steps, see set_time() and checkpoint().
 
         Public methods:
 
@@ -45,13 +51,21 @@ class Prosumer:
                                     determining controller setpoints
     """
 
-    def __init__(self, path, t_override=None, df_weather_history=None, df_weather_fcast=None):
+    def __init__(self, path, t_override=None, df_weather_history=None, df_weather_fcast=None, persistent=False,
+                 state_store=None):
         """Create a Prosumer instance from a configuration folder created using the Simulation class.
 
         :param path: path to prosumer configuration directory
         :param t_override: pandas Timestamp, if supplied, this parameter forces the MP to use the supplied
                             timestamp, otherwise the current time is used.
+        :param persistent: bool, if True, the instance is reused in the following steps. The account and plant
+                           configuration are kept in memory and only written to the configuration directory by
+                           checkpoint()
+        :param state_store: StateStore, store of the states of the prosumer such as SOCs, meter readings, logs and
+                            controller results. If None, states are read from and written to their files directly
         """
+        self.persistent = persistent
+        self.state_store = state_store if state_store is not None else StateStore(path)
         # set current timestamp from system clock or keyword arg
         self.t_now = t_override if t_override else pd.Timestamp.now().timestamp()
         # derive previous and next timestamps
@@ -86,7 +100,60 @@ class Prosumer:
         # df containing net matched market volumes by timestep (multiple matched offers for each timestamp summated)
         self.matched_bids_by_timestep = None
 
-    def pre_clearing_activity(self, db_obj, clear_positions=False):
+    def set_time(self, t_override=None):
+        """Advances a persistent instance to a new simulation time.
+
+        The results of the previous activities are discarded, as for a newly created instance. Configuration and
+        retail prices are kept.
+
+        :param t_override: pandas Timestamp, if supplied, this parameter forces the MP to use the supplied
+                            timestamp, otherwise the current time is used.
+
+        :return: None
+        """
+        self.t_now = t_override if t_override else pd.Timestamp.now().timestamp()
+        self.ts_delivery_prev = round(pd.Timestamp(self.t_now, unit="s").floor("15min").timestamp() - 15 * 60)
+        self.ts_delivery_current = self.ts_delivery_prev + 15 * 60
+        self.meas_val = {"timestamp": self.ts_delivery_prev}
+        self.fcast_manager.set_time(self)
+        self.fcast_table = None
+        self.mpc_table = None
+        self.matched_bids = None
+        self.matched_bids_by_timestep = None
+
+    def checkpoint(self):
+        """Writes the account and plant configuration kept in memory by a persistent instance to the configuration
+        directory, as well as the states kept in memory by its state store.
+
+        :return: None
+        """
+        self.state_store.checkpoint()
+        with open(f"{self.path}/config_account.json", "w") as write_file:
+            json.dump(self.config_dict, write_file)
+        with open(f"{self.path}/config_plants.json", "w") as write_file:
+            json.dump(self.plant_dict, write_file)
+
+    def save_config_account(self):
+        """Writes the account configuration to the configuration directory, deferred to checkpoint() if the instance
+        is persistent.
+
+        :return: None
+        """
+        if not self.persistent:
+            with open(f"{self.path}/config_account.json", "w") as write_file:
+                json.dump(self.config_dict, write_file)
+
+    def save_config_plants(self):
+        """Writes the plant configuration to the configuration directory, deferred to checkpoint() if the instance
+        is persistent.
+
+        :return: None
+        """
+        if not self.persistent:
+            with open(f"{self.path}/config_plants.json", "w") as write_file:
+                json.dump(self.plant_dict, write_file)
+
+    def pre_clearing_activity(self, db_obj, clear_positions=False, results_market=None):
         self.update_user_preferences(db_obj)
         self.controller_real_time()
         self.log_meter_readings(db_obj=db_obj)
@@ -98,7 +165,8 @@ class Prosumer:
 
             # get most recent market results, update price history
             self.get_market_results(market_type=market_type,
-                                    db_obj=db_obj)
+                                    db_obj=db_obj,
+                                    results_market=results_market)
             # update forecasts for all plants, retrain if necessary
             self.fcast_manager.update_forecasts()
             # execute model predictive control
@@ -107,12 +175,13 @@ class Prosumer:
             if db_obj.lem_config["types_clearing_ex_ante"]:
                 self.market_agent(db_obj=db_obj, clear_positions=clear_positions)
 
-    def post_clearing_activity(self, db_obj):
+    def post_clearing_activity(self, db_obj, results_market=None):
         market_type = "ex_ante" if db_obj.lem_config["types_clearing_ex_ante"] else "ex_post"
         # if the user
         if "mpc" in self.config_dict["controller_strategy"]:
             self.get_market_results(market_type=market_type,
-                                    db_obj=db_obj)
+                                    db_obj=db_obj,
+                                    results_market=results_market)
         # if the user
         if "mpc" in self.config_dict["controller_strategy"]:
             self.set_target_grid_power(market_type)
@@ -126,8 +195,8 @@ class Prosumer:
 
         # pv maximum power constraint
         def pv_rule(_model, _plant):
-            p_max = ft.read_dataframe(f"{self.path}/raw_data_{_plant}.ft", columns=["timestamp", "power"]
-                                      ).set_index("timestamp")
+            p_max = self.state_store.read_dataframe(f"raw_data_{_plant}.ft",
+                                                    columns=["timestamp", "power"]).set_index("timestamp")
             p_max = p_max.loc[self.ts_delivery_prev, "power"]
             p_max *= self.plant_dict[_plant]["power"]
             if self.plant_dict[_plant].get("controllable"):
@@ -148,8 +217,7 @@ class Prosumer:
         # wind maximum power constraint
         def wind_rule(_model, _plant):
 
-            with open(f"{self.path}/spec_{_plant}.json") as read_file:
-                spec_file = json.load(read_file)
+            spec_file = self.state_store.read_json(f"spec_{_plant}.json")
 
             lookup_wind_speed = spec_file["wind_speed_m/s"]
             lookup_power = spec_file["power_pu"]
@@ -171,7 +239,7 @@ class Prosumer:
                                        domain=pyo.NonNegativeReals)
 
         def fixedgen_rule(_model, _plant):
-            p_max = ft.read_dataframe(f"{self.path}/raw_data_{_plant}.ft").set_index("timestamp")
+            p_max = self.state_store.read_dataframe(f"raw_data_{_plant}.ft").set_index("timestamp")
             p_max = p_max.loc[self.ts_delivery_prev, "power"]
             p_max *= self.plant_dict[_plant]["power"]
             if self.plant_dict[_plant].get("controllable"):
@@ -231,8 +299,7 @@ class Prosumer:
         rtc_model.n_tes = {}
 
         for hp in self._get_list_plants(plant_type="hp"):
-            with open(f"{self.path}/soc_{hp}.json", "r") as read_file:
-                dict_soc_old[hp] = json.load(read_file)
+            dict_soc_old[hp] = self.state_store.read_json(f"soc_{hp}.json")
             dict_capacity_wh[hp] = self.plant_dict[hp]['capacity']
             dict_power_th[hp] = self.plant_dict[hp]['power_th']
             rtc_model.n_tes[hp] = self.plant_dict[hp]["efficiency"]
@@ -276,8 +343,7 @@ class Prosumer:
             rtc_model.con_bat_dev = pyo.ConstraintList()
 
             for bat in self._get_list_plants(plant_type="bat"):
-                with open(f"{self.path}/soc_{bat}.json", "r") as read_file:
-                    dict_soc_old[bat] = json.load(read_file)
+                dict_soc_old[bat] = self.state_store.read_json(f"soc_{bat}.json")
                 rtc_model.n_bat[bat] = self.plant_dict[bat]["efficiency"]
 
                 rtc_model.p_bat_in[bat].setub(self.plant_dict[bat]["power"])
@@ -338,7 +404,7 @@ class Prosumer:
             for ev in self._get_list_plants(plant_type="ev"):
                 rtc_model.p_ev_out[ev].setub(0)
                 rtc_model.p_ev_in[ev].setub(0)
-                raw_data_ev = ft.read_dataframe(f"{self.path}/raw_data_{ev}.ft")
+                raw_data_ev = self.state_store.read_dataframe(f"raw_data_{ev}.ft")
                 raw_data_ev.set_index("timestamp", inplace=True)
                 raw_data_ev = raw_data_ev[raw_data_ev.index == self.ts_delivery_prev]
                 raw_data_ev = dict(raw_data_ev.loc[self.ts_delivery_prev])
@@ -347,10 +413,10 @@ class Prosumer:
                     if self.plant_dict[ev].get("v2g"):
                         rtc_model.p_ev_out[ev].setub(self.plant_dict[ev]["charging_power"])
 
-                with open(f"{self.path}/soc_{ev}.json", "r") as read_file:
-                    rtc_model.ev_soc_old[ev] = max(0.05 * self.plant_dict[ev]["capacity"],
-                                                   json.load(read_file) - raw_data_ev["distance_driven"] / 100
-                                                   * self.plant_dict[ev]["consumption"])
+                rtc_model.ev_soc_old[ev] = max(0.05 * self.plant_dict[ev]["capacity"],
+                                               self.state_store.read_json(f"soc_{ev}.json")
+                                               - raw_data_ev["distance_driven"] / 100
+                                               * self.plant_dict[ev]["consumption"])
 
                 n_ev = self.plant_dict[ev]["efficiency"]
 
@@ -390,7 +456,7 @@ class Prosumer:
         # fixedgen load consumption, sum of household loads
         p_load = float(0)
         for hh in self._get_list_plants(plant_type="hh"):
-            p_meas = ft.read_dataframe(f"{self.path}/raw_data_{hh}.ft")
+            p_meas = self.state_store.read_dataframe(f"raw_data_{hh}.ft")
             p_meas.set_index("timestamp", inplace=True)
             p_meas = float(p_meas[p_meas.index == self.ts_delivery_prev]["power"].values)
             p_load += float(p_meas)
@@ -400,7 +466,7 @@ class Prosumer:
         # fixed hosehould thermal load
         q_load = float(0)
         for hp in self._get_list_plants(plant_type="hp"):
-            q_meas = ft.read_dataframe(f"{self.path}/raw_data_{hp}.ft")
+            q_meas = self.state_store.read_dataframe(f"raw_data_{hp}.ft")
             q_meas.set_index("timestamp", inplace=True)
             q_meas = float(q_meas[q_meas.index == self.ts_delivery_prev]["heat"].values)
             q_load += float(q_meas)
@@ -461,7 +527,7 @@ class Prosumer:
     def get_result_rtc(self, rtc_model):
         meas_grid = 0
         for hh in self._get_list_plants(plant_type="hh"):
-            p_meas = ft.read_dataframe(f"{self.path}/raw_data_{hh}.ft")
+            p_meas = self.state_store.read_dataframe(f"raw_data_{hh}.ft")
             p_meas.set_index("timestamp", inplace=True)
             self.meas_val[hh] = float(p_meas[p_meas.index == self.ts_delivery_prev]["power"].values)
             meas_grid += self.meas_val[hh]
@@ -477,23 +543,19 @@ class Prosumer:
         for hp in self._get_list_plants(plant_type="hp"):
             self.meas_val[hp] = rtc_model.p_hp[hp].value
             meas_grid += rtc_model.p_hp[hp].value
-            with open(f"{self.path}/soc_{hp}.json", "r") as read_file:
-                dict_soc_old = json.load(read_file)
+            dict_soc_old = self.state_store.read_json(f"soc_{hp}.json")
             tes_soc_new = dict_soc_old \
                           - 0.25 * rtc_model.q_tes_out[hp].value / self.plant_dict[hp]["efficiency"] \
                           + 0.25 * rtc_model.q_tes_in[hp].value * self.plant_dict[hp]["efficiency"]
-            with open(f"{self.path}/soc_{hp}.json", "w") as write_file:
-                json.dump(tes_soc_new, write_file)
+            self.state_store.write_json(f"soc_{hp}.json", tes_soc_new)
         for bat in self._get_list_plants(plant_type="bat"):
             self.meas_val[bat] = rtc_model.p_bat_out[bat].value - rtc_model.p_bat_in[bat].value
             meas_grid += rtc_model.p_bat_out[bat].value - rtc_model.p_bat_in[bat].value
-            with open(f"{self.path}/soc_{bat}.json", "r") as read_file:
-                dict_soc_old = json.load(read_file)
+            dict_soc_old = self.state_store.read_json(f"soc_{bat}.json")
             bat_soc_new = dict_soc_old \
                           - 0.25 * rtc_model.p_bat_out[bat].value / self.plant_dict[bat]["efficiency"] \
                           + 0.25 * rtc_model.p_bat_in[bat].value * self.plant_dict[bat]["efficiency"]
-            with open(f"{self.path}/soc_{bat}.json", "w") as write_file:
-                json.dump(bat_soc_new, write_file)
+            self.state_store.write_json(f"soc_{bat}.json", bat_soc_new)
 
         for ev in self._get_list_plants(plant_type="ev"):
             self.meas_val[ev] = rtc_model.p_ev_out[ev].value - rtc_model.p_ev_in[ev].value
@@ -501,8 +563,7 @@ class Prosumer:
             ev_soc_new = rtc_model.ev_soc_old[ev] \
                          - 0.25 * rtc_model.p_ev_out[ev].value / self.plant_dict[ev]["efficiency"] \
                          + 0.25 * rtc_model.p_ev_in[ev].value * self.plant_dict[ev]["efficiency"]
-            with open(f"{self.path}/soc_{ev}.json", "w") as write_file:
-                json.dump(ev_soc_new, write_file)
+            self.state_store.write_json(f"soc_{ev}.json", ev_soc_new)
 
         self.meas_val[self.config_dict['id_meter_grid']] = int(meas_grid)
 
@@ -515,7 +576,7 @@ class Prosumer:
         """
         # if the MPC and market results are active, they provide setpoints that the real time controller must stick to
         if self.config_dict["controller_strategy"] == "mpc_opt":
-            df_target_grid_power = (ft.read_dataframe(f"{self.path}/target_grid_power.ft")
+            df_target_grid_power = (self.state_store.read_dataframe("target_grid_power.ft")
                                     .pipe(pd.DataFrame.set_index, keys="timestamp")
                                     ).loc[self.ts_delivery_prev]
             # non-default controllers common model parameters initialized here.
@@ -543,7 +604,8 @@ class Prosumer:
             self.add_obj_rtc(rtc_model)
 
             # solve model
-            pyo.SolverFactory(self.config_dict["solver"]).solve(rtc_model)
+            with _lock_solver:
+                pyo.SolverFactory(self.config_dict["solver"]).solve(rtc_model)
 
             # assign results to instance variables for logging
             self.get_result_rtc(rtc_model)
@@ -552,35 +614,34 @@ class Prosumer:
             meas_grid = 0
             # household load is simply logged from raw data
             for hh in self._get_list_plants(plant_type="hh"):
-                p_meas = ft.read_dataframe(f"{self.path}/raw_data_{hh}.ft").set_index("timestamp")
+                p_meas = self.state_store.read_dataframe(f"raw_data_{hh}.ft").set_index("timestamp")
                 self.meas_val[hh] = float(p_meas[p_meas.index == self.ts_delivery_prev]["power"].values)
                 meas_grid += self.meas_val[hh]
             # generators feed in maximum power at all times.
             for pv in self._get_list_plants(plant_type="pv"):
-                p_max = ft.read_dataframe(f"{self.path}/raw_data_{pv}.ft", columns=["timestamp", "power"]
-                                          ).set_index("timestamp")
+                p_max = self.state_store.read_dataframe(f"raw_data_{pv}.ft",
+                                                        columns=["timestamp", "power"]).set_index("timestamp")
                 p_max = p_max.loc[self.ts_delivery_prev, "power"]
                 self.meas_val[pv] = p_max * self.plant_dict[pv]["power"]
                 meas_grid += self.meas_val[pv]
             for wind in self._get_list_plants(plant_type="wind"):
                 current_wind_speed = float(self.df_weather_history.loc[self.ts_delivery_prev, "wind_speed"])
-                with open(f"{self.path}/spec_{wind}.json") as read_file:
-                    spec_file = json.load(read_file)
+                spec_file = self.state_store.read_json(f"spec_{wind}.json")
                 lookup_wind_speed = spec_file["wind_speed_m/s"]
                 lookup_power = spec_file["power_pu"]
                 self.meas_val[wind] = self._lookup(current_wind_speed, lookup_wind_speed, lookup_power) * \
                                       self.plant_dict[wind]["power"]
                 meas_grid += self.meas_val[wind]
             for fixedgen in self._get_list_plants(plant_type="fixedgen"):
-                p_max = ft.read_dataframe(f"{self.path}/raw_data_{fixedgen}.ft", columns=["timestamp", "power"]
-                                          ).set_index("timestamp")
+                p_max = self.state_store.read_dataframe(f"raw_data_{fixedgen}.ft",
+                                                        columns=["timestamp", "power"]).set_index("timestamp")
                 p_max = p_max.loc[self.ts_delivery_prev, "power"]
                 self.meas_val[fixedgen] = float(p_max * self.plant_dict[fixedgen]["power"])
 
                 meas_grid += p_max * self.plant_dict[fixedgen]["power"]
             # the electric vehicle charges at maximum power upon arrival
             for ev in self._get_list_plants(plant_type="ev"):
-                raw_data_ev = ft.read_dataframe(f"{self.path}/raw_data_{ev}.ft").set_index("timestamp")
+                raw_data_ev = self.state_store.read_dataframe(f"raw_data_{ev}.ft").set_index("timestamp")
                 raw_data_ev = raw_data_ev[raw_data_ev.index == self.ts_delivery_prev]
                 raw_data_ev = dict(raw_data_ev.loc[self.ts_delivery_prev])
                 if raw_data_ev["availability"] == 0:
@@ -589,10 +650,9 @@ class Prosumer:
                     self.meas_val[ev] = 0
                 else:
                     # get old soc
-                    with open(f"{self.path}/soc_{ev}.json", "r") as read_file:
-                        ev_soc_old = max(0.05 * self.plant_dict[ev]["capacity"],
-                                         json.load(read_file) - raw_data_ev["distance_driven"] / 100
-                                         * self.plant_dict[ev]["consumption"])
+                    ev_soc_old = max(0.05 * self.plant_dict[ev]["capacity"],
+                                     self.state_store.read_json(f"soc_{ev}.json")
+                                     - raw_data_ev["distance_driven"] / 100 * self.plant_dict[ev]["consumption"])
                     # fully charge the battery immediately, from old SoC to full
                     soc_missing = self.plant_dict[ev]["capacity"] - ev_soc_old
                     power_to_full = soc_missing / self.plant_dict[ev]["efficiency"] / 0.25
@@ -600,8 +660,7 @@ class Prosumer:
                     ev_power = min(power_to_full, self.plant_dict[ev]["charging_power"])
                     # calculate new soc
                     ev_soc_new = ev_soc_old + 0.25 * ev_power * self.plant_dict[ev]["efficiency"]
-                    with open(f"{self.path}/soc_{ev}.json", "w") as write_file:
-                        json.dump(ev_soc_new, write_file)
+                    self.state_store.write_json(f"soc_{ev}.json", ev_soc_new)
                     # update measured values
                     self.meas_val[ev] = ev_power * -1
                     meas_grid += ev_power * -1
@@ -622,10 +681,9 @@ class Prosumer:
                 # was the hp previously on or off?
                 state = self.plant_dict[hp].get("rtc_state", "off")
                 # load hp soc
-                with open(f"{self.path}/soc_{hp}.json", "r") as read_file:
-                    hp_soc_old = json.load(read_file)
+                hp_soc_old = self.state_store.read_json(f"soc_{hp}.json")
                 # determine building heat demand
-                p_heat = ft.read_dataframe(f"{self.path}/raw_data_{hp}.ft").set_index("timestamp")
+                p_heat = self.state_store.read_dataframe(f"raw_data_{hp}.ft").set_index("timestamp")
                 p_heat = float(p_heat[p_heat.index == self.ts_delivery_prev]["heat"].values)
 
                 # what happens if we don't charge at all?
@@ -661,16 +719,13 @@ class Prosumer:
                 meas_grid += p_hp
                 self.plant_dict[hp]["rtc_state"] = state
 
-                with open(f"{self.path}/config_plants.json", "w") as write_file:
-                    json.dump(self.plant_dict, write_file)
+                self.save_config_plants()
 
-                with open(f"{self.path}/soc_{hp}.json", "w") as write_file:
-                    json.dump(hp_soc_new, write_file)
+                self.state_store.write_json(f"soc_{hp}.json", hp_soc_new)
             # the battery attempts to maintain grid connection power at 0 if at all possible.
             for bat in self._get_list_plants(plant_type="bat"):
                 # get old soc
-                with open(f"{self.path}/soc_{bat}.json", "r") as read_file:
-                    bat_soc_old = json.load(read_file)
+                bat_soc_old = self.state_store.read_json(f"soc_{bat}.json")
                 # calc power required to get meas_grid to zero
                 if meas_grid > 0:
                     grid_power_requirement = -1 * meas_grid
@@ -689,8 +744,7 @@ class Prosumer:
                     # update SoC
                     bat_soc_new = bat_soc_old - 0.25 * bat_power / self.plant_dict[bat]["efficiency"]
 
-                with open(f"{self.path}/soc_{bat}.json", "w") as write_file:
-                    json.dump(bat_soc_new, write_file)
+                self.state_store.write_json(f"soc_{bat}.json", bat_soc_new)
 
                 self.meas_val[bat] = bat_power
                 meas_grid += bat_power
@@ -699,8 +753,7 @@ class Prosumer:
 
         # save calculated values to .json file so that results can be used by later methods in case of parallelization
 
-        with open(f"{self.path}/controller_rtc.json", "w") as write_file:
-            json.dump(self.meas_val, write_file)
+        self.state_store.write_json("controller_rtc.json", self.meas_val)
 
     def log_meter_readings(self, db_obj):
         """Log the result of the controller_real_time method to the database as metering data.
@@ -711,7 +764,7 @@ class Prosumer:
         """
         # create local dataframe containing all previous metering logs from file
 
-        df_meas_local = ft.read_dataframe(f"{self.path}/log_ems.ft")
+        df_meas_local = self.state_store.read_dataframe("log_ems.ft")
         df_meas_local.set_index("timestamp", inplace=True)
         # define local lists for containing new measurement values, once for local logging, once for database logging
         factor_w_to_wh = 1 / 4
@@ -739,11 +792,10 @@ class Prosumer:
 
         df_meas_local.loc[self.ts_delivery_prev] = log_ems
         df_meas_local.index.name = "timestamp"
-        ft.write_dataframe(df_meas_local.round().reset_index(),
-                           f"{self.path}/log_ems.ft")
+        self.state_store.write_dataframe("log_ems.ft", df_meas_local.round().reset_index())
 
         # log measurement values to database
-        df_meter_readings_input = ft.read_dataframe(f"{self.path}/buffer_meter_readings.ft")
+        df_meter_readings_input = self.state_store.read_dataframe("buffer_meter_readings.ft")
 
         df_db_logging = df_meter_readings_input[
             df_meter_readings_input["t_send"] <= self.t_now].drop(columns={"t_send"})
@@ -753,7 +805,7 @@ class Prosumer:
         if len(df_db_logging):
             db_obj.log_meter_readings_cumulative(df_db_logging)
 
-        ft.write_dataframe(df_meter_readings_output, f"{self.path}/buffer_meter_readings.ft")
+        self.state_store.write_dataframe("buffer_meter_readings.ft", df_meter_readings_output)
 
     def controller_model_predictive(self, controller=None):
         """Execute the model predictive controller_real_time for the market participant given the predicted
@@ -764,7 +816,7 @@ class Prosumer:
 
         :return: None
         """
-        self.mpc_table = ft.read_dataframe(f"{self.path}/fcasts_current.ft").set_index("timestamp")
+        self.mpc_table = self.state_store.read_dataframe("fcasts_current.ft").set_index("timestamp")
 
         # if no plants, revert to simple rule-based controller
         if controller is None and len(self._get_list_plants()) - len(self._get_list_plants(plant_type="hh")) == 0:
@@ -874,8 +926,7 @@ class Prosumer:
             dict_soc_ev_min = {}
             dict_soc_ev_old = {}
             for ev in self._get_list_plants(plant_type="ev"):
-                with open(f"{self.path}/soc_{ev}.json", "r") as read_file:
-                    dict_soc_ev_old[ev] = json.load(read_file)
+                dict_soc_ev_old[ev] = self.state_store.read_json(f"soc_{ev}.json")
 
                 n_ev = self.plant_dict[ev]["efficiency"]
                 dict_soc_ev_min[ev] = [0] * self.config_dict["mpc_horizon"]
@@ -1056,8 +1107,7 @@ class Prosumer:
 
             for hp in self._get_list_plants(plant_type="hp"):
                 n_tes = self.plant_dict[hp]["efficiency"]
-                with open(f"{self.path}/soc_{hp}.json", "r") as read_file:
-                    soc_tes_init = json.load(read_file)
+                soc_tes_init = self.state_store.read_json(f"soc_{hp}.json")
                 model.con_tes_soc_calc.add(expr=soc_tes_init
                                                 - 0.25 * model.q_tes_out[hp, 0] / n_tes
                                                 + 0.25 * model.q_tes_in[hp, 0] * n_tes
@@ -1091,8 +1141,7 @@ class Prosumer:
 
             for bat in self._get_list_plants(plant_type="bat"):
                 n_bat = self.plant_dict[bat]["efficiency"]
-                with open(f"{self.path}/soc_{bat}.json", "r") as read_file:
-                    soc_bat_init = json.load(read_file)
+                soc_bat_init = self.state_store.read_json(f"soc_{bat}.json")
                 model.con_soc_calc.add(expr=soc_bat_init
                                             - 0.25 * model.p_bat_out[bat, 0] / n_bat
                                             + 0.25 * model.p_bat_in[bat, 0] * n_bat
@@ -1156,7 +1205,8 @@ class Prosumer:
 
             # Solve model
             model.objective_fun = pyo.Objective(rule=obj_rule, sense=pyo.minimize)
-            pyo.SolverFactory(self.config_dict["solver"]).solve(model)
+            with _lock_solver:
+                pyo.SolverFactory(self.config_dict["solver"]).solve(model)
             # Update mpc_table with results of model
             dict_mpc_table = self.mpc_table.to_dict()
             for i, t_d in enumerate(range(self.ts_delivery_current,
@@ -1219,10 +1269,11 @@ class Prosumer:
             # Save results to file, which will be used as basis for controller_real_time set points and market trading
             self.mpc_table = pd.DataFrame.from_dict(dict_mpc_table)
 
-        ft.write_dataframe(self.mpc_table.reset_index().rename(columns={"index": "timestamp"}),
-                           f"{self.path}/controller_mpc.ft")
-        ft.write_dataframe(self.mpc_table.reset_index().rename(columns={"index": "timestamp"}),
-                           f"{self.path}/controller_mpc_{self.ts_delivery_current}.ft")
+        self.state_store.write_dataframe("controller_mpc.ft",
+                                         self.mpc_table.reset_index().rename(columns={"index": "timestamp"}))
+        self.state_store.write_dataframe(f"controller_mpc_{self.ts_delivery_current}.ft",
+                                         self.mpc_table.reset_index().rename(columns={"index": "timestamp"}),
+                                         keep=False)
 
     def update_price_history(self, db_obj, market_type="ex_ante"):
         """Calculate price history from market results, save output to price_history.ft
@@ -1232,7 +1283,7 @@ class Prosumer:
         """
         euro_kwh_to_sigma_wh = db_obj.db_param.EURO_TO_SIGMA / 1000
 
-        df_price_history = ft.read_dataframe(f"{self.path}/price_history.ft").set_index("timestamp")
+        df_price_history = self.state_store.read_dataframe("price_history.ft").set_index("timestamp")
 
         settlement_prices = db_obj.get_prices_settlement(
             ts_delivery_first=self.ts_delivery_prev - 24 * 3600,
@@ -1303,21 +1354,27 @@ class Prosumer:
 
         # return most recent settlement prices
         # these are considered during MPC planning
-        ft.write_dataframe(df_price_history.reset_index(), f"{self.path}/price_history.ft")
+        self.state_store.write_dataframe("price_history.ft", df_price_history.reset_index())
 
-    def get_market_results(self, db_obj, market_type="ex_ante"):
+    def get_market_results(self, db_obj, market_type="ex_ante", results_market=None):
         """Query and return currently matched and unmatched market positions of the market
         participant in question.
 
         :param db_obj: Database instance, pass the database connection instance to this method
         :param market_type: Type of market (ex-post or ex-ante)
+        :param results_market: dict, market results prefetched for several market agents, see
+                               DatabaseConnection.get_results_market_ex_ante_by_user(). The results are queried if
+                               None or if the market agent is missing
         :return: none
         """
         if market_type == "ex_ante":
+            if results_market is not None:
+                results_market = results_market.get(self.config_dict['id_market_agent'])
             self.matched_bids, self.matched_bids_by_timestep = db_obj.get_results_market_ex_ante(
                 id_user=self.config_dict['id_market_agent'],
                 ts_delivery_first=self.ts_delivery_prev,
-                ts_delivery_last=self.ts_delivery_current + self.config_dict["ma_horizon"] * 900
+                ts_delivery_last=self.ts_delivery_current + self.config_dict["ma_horizon"] * 900,
+                results_market=results_market
             )
             self.update_price_history(db_obj, market_type="ex_ante")
         elif market_type == "ex-post":
@@ -1336,7 +1393,7 @@ class Prosumer:
         """
 
         # Get user info from database and convert it to panda series
-        user_info = db_obj.get_info_user(self.config_dict["id_user"]).squeeze()
+        user_info = db_obj.get_info_user(self.config_dict["id_user"], balances=False).squeeze()
 
         # Values to be updated with each time step
         # Set positions boundaries (currently set by the retail prices of that time step)
@@ -1354,8 +1411,7 @@ class Prosumer:
             float(user_info[db_obj.db_param.PREMIUM_PREFERENCE_QUALITY])
 
         # Save updated values to account config
-        with open(f"{self.path}/config_account.json", "w") as write_file:
-            json.dump(self.config_dict, write_file)
+        self.save_config_account()
 
     def set_target_grid_power(self, market_type="ex_ante"):
         """Determine and save the controller_real_time setpoint for the real time controller_real_time to a .ft
@@ -1366,7 +1422,7 @@ class Prosumer:
 
         :return: none
         """
-        df_target_grid_power = ft.read_dataframe(f"{self.path}/controller_mpc.ft").set_index("timestamp")
+        df_target_grid_power = self.state_store.read_dataframe("controller_mpc.ft").set_index("timestamp")
 
         if market_type == "ex_post":
             '''When operating in a Strommunity market design, the target grid power is
@@ -1379,8 +1435,7 @@ class Prosumer:
             df_target_grid_power[f"power_{self.config_dict['id_meter_grid']}"] = \
                 self.matched_bids_by_timestep["net_bids"] * 4
 
-        ft.write_dataframe(df_target_grid_power.reset_index(),
-                           f"{self.path}/target_grid_power.ft")
+        self.state_store.write_dataframe("target_grid_power.ft", df_target_grid_power.reset_index())
 
     def market_agent(self, db_obj, clear_positions=False):
         """Calculate and post/update market positions to the double sided market.
@@ -1500,12 +1555,11 @@ class Prosumer:
         return list_plants
 
     def _get_old_meter_reading_local(self, id_meter):
-        with open(f"{self.path}/meter_{id_meter}.json", "r") as read_file:
-            reading = json.load(read_file)
+        reading = self.state_store.read_json(f"meter_{id_meter}.json")
         return [reading[0], reading[1]]
 
     def _set_new_meter_reading_local(self, dict_new_readings):
-        dict_buffer_meter_readings = ft.read_dataframe(f"{self.path}/buffer_meter_readings.ft").to_dict()
+        dict_buffer_meter_readings = self.state_store.read_dataframe("buffer_meter_readings.ft").to_dict()
         for id_meter in dict_new_readings:
             if id_meter == self.config_dict["id_meter_grid"] \
                     or self.plant_dict[id_meter].get("has_submeter") is not False:
@@ -1519,9 +1573,7 @@ class Prosumer:
                 else:
                     time_late = 0
 
-                with open(f"{self.path}/meter_{id_meter}.json",
-                          "w") as write_file:
-                    json.dump([energy_in_cum_new, energy_out_cum_new], write_file)
+                self.state_store.write_json(f"meter_{id_meter}.json", [energy_in_cum_new, energy_out_cum_new])
 
                 index = len(dict_buffer_meter_readings["t_reading"])
 
@@ -1534,8 +1586,7 @@ class Prosumer:
         df_meter_readings = pd.DataFrame.from_dict(dict_buffer_meter_readings)
         # load meter readings file
         if random() + self.config_dict["meter_prob_missing"] <= 1:
-            ft.write_dataframe(df_meter_readings,
-                               f"{self.path}/buffer_meter_readings.ft")
+            self.state_store.write_dataframe("buffer_meter_readings.ft", df_meter_readings)
 
     # Internal methods and functions
 
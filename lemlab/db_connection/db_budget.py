@@ -0,0 +1,199 @@
+__author__ = "sdlumpp"
+__credits__ = []
+__license__ = ""
+__maintainer__ = "sdlumpp"
+__email__ = "sebastian.lumpp@tum.de"
+
+import time
+import warnings
+import threading
+import sqlalchemy as db
+
+
+class ConnectionBudget:
+    """Distributes a global budget of database connections among all engines of a lemlab run.
+
+    Every process of a simulation (the executor itself and each worker of the prosumer pool) creates its own
+    DatabaseConnection and therefore its own connection pool. Without a budget each engine may open up to 20
+    connections, which quickly exceeds the max_connections setting of the database server on many-core machines.
+
+    Configured through the db_connections section of the config file:
+        max_connections -- int or None, number of simultaneous connections all engines may open in total
+        mode_pool -- str, "queue" for pools sized from the budget, "lazy" for connections opened on demand
+        proxy -- dict or None, host and port of a local pooling proxy all connections are routed through, independent
+                 of mode_pool. "lazy" is recommended behind a proxy, as the proxy keeps the server connections open
+        transfer_results -- str, "rows" for results fetched row by row, "copy" for results streamed with COPY
+    """
+
+    def __init__(self, config_db):
+        self.config_db = config_db
+        self.max_connections = config_db.get("max_connections")
+        self.mode_pool = config_db.get("mode_pool", "queue")
+        self.proxy = config_db.get("proxy")
+        self.transfer_results = config_db.get("transfer_results", "rows")
+
+    def get_db_dict(self, name_connection, n_engines=1):
+        """Returns the connection dict for a DatabaseConnection, extended by the pool settings of this budget.
+
+        :param name_connection: str, key of the connection in the db_connections section
+        :param n_engines: int, number of engines sharing the budget
+
+        :return: dict, input for DatabaseConnection(db_dict=...)
+        """
+        db_dict = dict(self.config_db[name_connection])
+        if self.proxy is not None:
+            db_dict["host"] = self.proxy.get("host", db_dict.get("host"))
+            db_dict["port"] = self.proxy.get("port", db_dict.get("port"))
+        db_dict["mode_pool"] = self.mode_pool
+        db_dict["transfer_results"] = self.transfer_results
+        if self.max_connections is not None:
+            db_dict["pool_size"] = self.get_pool_size(n_engines)
+            db_dict["max_overflow"] = 0
+        return db_dict
+
+    def get_pool_size(self, n_engines):
+        """Returns the number of connections each of n_engines engines may keep open within the budget."""
+        if self.mode_pool == "queue" and self.max_connections < n_engines:
+            warnings.warn(f"A connection budget of {self.max_connections} cannot supply {n_engines} connection pools. "
+                          f"Every pool receives one connection. Reduce the number of processes or use mode_pool "
+                          f"'lazy' behind a pooling proxy.")
+        return max(1, self.max_connections // n_engines)
+
+
+def create_engine(string_eng, db_dict):
+    """Creates a SQLAlchemy engine with a pool sized from the connection budget.
+
+    Statements executed with a list of parameter sets are sent to the server in pages instead of row by row.
+
+    :param string_eng: str, database URL
+    :param db_dict: dict, connection dict, optionally containing mode_pool ("queue" or "lazy"), pool_size and
+                    max_overflow
+
+    :return: sqlalchemy engine
+    """
+    mode_pool = db_dict.get("mode_pool", "queue")
+    if mode_pool == "lazy":
+        return db.create_engine(string_eng, poolclass=db.pool.NullPool, executemany_mode="values_plus_batch")
+    if mode_pool == "queue":
+        return db.create_engine(string_eng,
+                                executemany_mode="values_plus_batch",
+                                poolclass=db.pool.QueuePool,
+                                pool_size=db_dict.get("pool_size", 10),
+                                max_overflow=db_dict.get("max_overflow", 10))
+    raise ValueError(f"Unknown mode_pool '{mode_pool}' of the connection budget. Valid modes are 'queue' and 'lazy'.")
+
+
+def listen_stats_wait(engine, db_dict):
+    """Records the checkouts of the engine's pool, the time spent waiting for them and opening new connections.
+
+    Every checkout is timed by wrapping the connect() method of the engine's pool, through which all connections of
+    the engine are checked out. The time spent opening new connections within a checkout is measured with the
+    dialect event "do_connect", which marks the start of opening a connection, and the pool event "connect". It is
+    reported separately and is not part of the waiting time, so the waiting time is the time spent blocked on an
+    exhausted queue pool. A checkout that takes the last connection of a queue pool is counted as exhausting it.
+
+    :param engine: sqlalchemy engine created by create_engine()
+    :param db_dict: dict, connection dict the engine was created with
+
+    :return: StatsWait, updated by the checkouts of the engine
+    """
+    stats_wait = StatsWait()
+    max_overflow = db_dict.get("max_overflow", 10)
+    # time spent opening connections during the current checkout of each thread
+    local = threading.local()
+
+    def wrap_pool(pool):
+        connect = pool.connect
+
+        def connect_timed():
+            local.t_connect = 0
+            t_start = time.perf_counter()
+            connection = connect()
+            stats_wait.record_checkout(time.perf_counter() - t_start - local.t_connect)
+            return connection
+        pool.connect = connect_timed
+
+    @db.event.listens_for(engine, "do_connect")
+    def on_do_connect(dialect, connection_record, cargs, cparams):
+        connection_record.info["t_connect_start"] = time.perf_counter()
+
+    @db.event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        t_start = connection_record.info.pop("t_connect_start", None)
+        if t_start is not None:
+            t_connect = time.perf_counter() - t_start
+            local.t_connect = getattr(local, "t_connect", 0) + t_connect
+            stats_wait.record_connect(t_connect)
+
+    @db.event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool = engine.pool
+        if isinstance(pool, db.pool.QueuePool) and pool.checkedout() >= pool.size() + max_overflow:
+            stats_wait.record_exhausted()
+
+    # disposing the engine replaces its pool
+    @db.event.listens_for(engine, "engine_disposed")
+    def on_engine_disposed(engine_disposed):
+        wrap_pool(engine_disposed.pool)
+
+    wrap_pool(engine.pool)
+    return stats_wait
+
+
+class StatsWait:
+    """Accumulates the checkouts of a pool, the time spent waiting for them and opening new connections."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.checkouts_exhausted = 0
+        self.t_wait_total = 0
+        self.t_wait_max = 0
+        self.connects = 0
+        self.t_connect_total = 0
+        self.t_connect_max = 0
+
+    def record_checkout(self, t_wait):
+        with self.lock:
+            self.checkouts += 1
+            self.t_wait_total += t_wait
+            self.t_wait_max = max(self.t_wait_max, t_wait)
+
+    def record_exhausted(self):
+        with self.lock:
+            self.checkouts_exhausted += 1
+
+    def record_connect(self, t_connect):
+        with self.lock:
+            self.connects += 1
+            self.t_connect_total += t_connect
+            self.t_connect_max = max(self.t_connect_max, t_connect)
+
+    def to_dict(self):
+        with self.lock:
+            return {"checkouts": self.checkouts,
+                    "checkouts_exhausted": self.checkouts_exhausted,
+                    "t_wait_total": self.t_wait_total,
+                    "t_wait_mean": self.t_wait_total / self.checkouts if self.checkouts else 0,
+                    "t_wait_max": self.t_wait_max,
+                    "connects": self.connects,
+                    "t_connect_total": self.t_connect_total,
+                    "t_connect_mean": self.t_connect_total / self.connects if self.connects else 0,
+                    "t_connect_max": self.t_connect_max}
+
+
+def merge_stats_wait(list_stats):
+    """Combines the dicts returned by StatsWait.to_dict() of several pools into a single dict."""
+    checkouts = sum(stats["checkouts"] for stats in list_stats)
+    t_wait_total = sum(stats["t_wait_total"] for stats in list_stats)
+    connects = sum(stats["connects"] for stats in list_stats)
+    t_connect_total = sum(stats["t_connect_total"] for stats in list_stats)
+    return {"checkouts": checkouts,
+            "checkouts_exhausted": sum(stats["checkouts_exhausted"] for stats in list_stats),
+            "t_wait_total": t_wait_total,
+            "t_wait_mean": t_wait_total / checkouts if checkouts else 0,
+            "t_wait_max": max([stats["t_wait_max"] for stats in list_stats], default=0),
+            "connects": connects,
+            "t_connect_total": t_connect_total,
+            "t_connect_mean": t_connect_total / connects if connects else 0,
+            "t_connect_max": max([stats["t_connect_max"] for stats in list_stats], default=0)}
@@ -4,9 +4,21 @@ __license__ = ""
 __maintainer__ = "sdlumpp"
 __email__ = "sebastian.lumpp@tum.de"
 
+import os
+import io
+import json
+import shutil
+import itertools
+import warnings
+import threading
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import sqlalchemy as db
 import lemlab.db_connection.db_param as db_p
+import lemlab.db_connection.db_budget as db_budget
 import time
 
 
@@ -24,16 +36,50 @@ class DatabaseConnection:
                      f":{db_dict.get('port')}" \
                      f"/{db_dict.get('db')}"
 
-        self.engine = db.create_engine(string_eng, pool_size=10)
+        # pool settings are set by ConnectionBudget, default: pool of 10 connections plus 10 overflow connections
+        self.engine = db_budget.create_engine(string_eng, db_dict=db_dict)
+        self.stats_wait = db_budget.listen_stats_wait(self.engine, db_dict=db_dict)
 
         self.lem_config = lem_config
         self.db_param = db_p
 
+        # transfer of query results, "rows" - rows are fetched and converted by pandas,
+        # "copy" - results are streamed with COPY and parsed into typed columns, see _query_copy()
+        self.transfer_results = db_dict.get("transfer_results", "rows")
+
+        # if True, transactions are only inserted into logs_transactions and account balances are derived from them
+        # and periodic snapshots instead of being updated in info_user, see get_balances_user()
+        self.balances_ledger = lem_config.get("balances_ledger", False)
+
         self.list_tables = self.db_param.LIST_TABLES[:]
 
+        # cache of metadata lookups (info tables and table formats) that only change when agents are registered
+        # every entry stores the tables it was derived from and is dropped as soon as one of these tables is modified
+        # through this connection, or through any other connection once refresh_cache() is called. version_metadata
+        # holds the versions of the tables in versions_metadata last seen by this connection
+        self._cache_metadata = {}
+        self._cache_table_columns = {}
+        self.version_metadata = {}
+        # incremented whenever entries are dropped, so entries derived concurrently are not stored, see _get_cached()
+        self._generation_cache = 0
+
+        # lower bounds of the partitions known to exist, by table
+        self._dict_partitions = {}
+
+        # statements with bound parameters, built once per connection, see _get_statement()
+        self._statements = {}
+
+        # connection of the open unit of work of each thread, see unit_of_work()
+        self._local = threading.local()
+
+        # agents may share a connection across threads, see AsyncDatabaseConnection. The caches and statements above
+        # are only read and modified while holding this lock, database queries are made without holding it
+        self._lock_cache = threading.RLock()
+
         self._dynamize_db_param()
 
     def init_db(self, clear_tables=False, reformat_tables=False):
+        self.clear_cache_metadata()
         for table in self.list_tables:
             self._init_table(table=table,
                              clear_table=clear_tables,
@@ -42,24 +88,128 @@ class DatabaseConnection:
     def end_connection(self):
         self.engine.dispose()
 
+    def get_stats_pool(self):
+        """Returns the number of connection checkouts, the time spent waiting for them and the time spent opening new
+        connections in seconds, see db_budget.listen_stats_wait()."""
+        return self.stats_wait.to_dict()
+
+    @contextmanager
+    def unit_of_work(self):
+        """Groups all statements issued through this connection by the current thread into one transaction.
+
+        Without a unit of work every method commits on its own. Within the block, all methods share one database
+        connection and see the uncommitted writes of the block. The transaction is committed when the block is left
+        and rolled back if the block raises an exception, so a failed simulation step leaves no partial results.
+        Nested blocks are executed as savepoints, see savepoint().
+
+        Example:
+            with db_obj.unit_of_work():
+                with db_obj.savepoint():
+                    clearing_ex_ante.market_clearing(db_obj=db_obj, ...)
+                with db_obj.savepoint():
+                    settlement.update_balance_levies(db_obj=db_obj, ...)
+
+        :return:
+        """
+        if getattr(self._local, "connection", None) is not None:
+            with self.savepoint():
+                yield
+            return
+        try:
+            with self.engine.begin() as connection:
+                self._local.connection = connection
+                try:
+                    yield
+                finally:
+                    self._local.connection = None
+        except BaseException:
+            # cached lookups may have been derived from rolled back rows
+            self.clear_cache_metadata()
+            raise
+
+    @contextmanager
+    def savepoint(self):
+        """Executes the block within a savepoint of the open unit of work.
+
+        If the block raises an exception, only the statements of the block are rolled back and the exception is
+        re-raised. It may be caught to continue the unit of work. Outside of a unit of work the block is executed as a
+        unit of work of its own.
+
+        :return:
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            with self.unit_of_work():
+                yield
+            return
+        with connection.begin_nested():
+            yield
+
     ###################################################
     # Functions for the info_user table
     # Market participants only
 
-    def get_info_user(self, id_user=None):
-        sql = f"SELECT * FROM \"{self.db_param.NAME_TABLE_INFO_USER}\""
-        if id_user is not None:
-            sql += f" WHERE {self.db_param.ID_USER} = '{id_user}'"
-        return self._query_data_free(sql)
+    def get_info_user(self, id_user=None, balances=True):
+        """Returns the info of the users.
+
+        The info is served from the cache of this connection, see refresh_cache(). The account balances change every
+        step and are not cached, they are read with a separate query.
+
+        :param id_user: str, id of the user, all users if None
+        :param balances: bool, if False, the columns balance_account and t_update_balance are omitted and the info is
+                         returned without querying the database
+
+        :return: DataFrame with the rows of info_user
+        """
+        list_columns_balance = [self.db_param.BALANCE_ACCOUNT, self.db_param.T_UPDATE_BALANCE]
+        list_columns = self.get_table_columns(self.db_param.NAME_TABLE_INFO_USER)
+
+        def build():
+            sql = f"SELECT {', '.join(column for column in list_columns if column not in list_columns_balance)} " \
+                  f"FROM \"{self.db_param.NAME_TABLE_INFO_USER}\""
+            if id_user is not None:
+                sql += f" WHERE {self.db_param.ID_USER} = :id_user"
+            return sql
+        statement = self._get_statement(("get_info_user", id_user is None), build)
+        info_user = self._get_cached(key=("get_info_user", id_user),
+                                     list_tables=[self.db_param.NAME_TABLE_INFO_USER],
+                                     func=lambda: self._query_data_free(statement,
+                                                                        params={"id_user": id_user},
+                                                                        table_name=self.db_param.NAME_TABLE_INFO_USER))
+        if not balances:
+            return info_user
+
+        def build_balances():
+            if not self.balances_ledger:
+                sql = f"SELECT {self.db_param.ID_USER}, {', '.join(list_columns_balance)} " \
+                      f"FROM {self.db_param.NAME_TABLE_INFO_USER}"
+                if id_user is not None:
+                    sql += f" WHERE {self.db_param.ID_USER} = :id_user"
+                return sql
+            # info_user holds the opening balances, the current balances are derived from the ledger
+            return self._get_sql_balances_user_ledger(
+                sql_filter=None if id_user is None else f"users.{self.db_param.ID_USER} = :id_user",
+                list_columns_users=[self.db_param.T_UPDATE_BALANCE])
+        statement_balances = self._get_statement(("get_info_user_balances", id_user is None, self.balances_ledger),
+                                                 build_balances)
+        df_balances = self._query_data_free(statement_balances,
+                                            params={"id_user": id_user},
+                                            table_name=self.db_param.NAME_TABLE_INFO_USER)
+        return info_user.merge(df_balances, on=self.db_param.ID_USER, how="left").loc[:, list_columns]
 
     def get_list_all_users(self, ts_delivery_active=None):
-        # select all meters
-        # if t_d is used, only meters active at the selected t_d are returned
-        sql = f"SELECT {self.db_param.ID_USER} FROM {self.db_param.NAME_TABLE_INFO_USER}"
-        if ts_delivery_active is not None:
-            sql += f" AND {self.db_param.TS_DELIVERY_FIRST} <= {ts_delivery_active}" \
-                   f" AND {self.db_param.TS_DELIVERY_FIRST} >= {ts_delivery_active};"
-        return list(self._query_data_free(sql).loc[:, self.db_param.ID_USER])
+        # select all users
+        # if t_d is used, only users active at the selected t_d are returned
+        def build():
+            sql = f"SELECT {self.db_param.ID_USER} FROM {self.db_param.NAME_TABLE_INFO_USER}"
+            if ts_delivery_active is not None:
+                sql += f" WHERE {self.db_param.TS_DELIVERY_FIRST} <= :ts_delivery_active" \
+                       f" AND {self.db_param.TS_DELIVERY_LAST} >= :ts_delivery_active"
+            return sql
+        statement = self._get_statement(("get_list_all_users", ts_delivery_active is None), build)
+        return list(self._query_data_free(statement,
+                                          params={"ts_delivery_active": ts_delivery_active}
+                                          ).loc[:, self.db_param.ID_USER])
 
     # Admins only
 
@@ -68,41 +218,46 @@ class DatabaseConnection:
                     df_insert=df_in)
 
     def edit_user(self, df_user):
-        list_columns_all = self.get_table_columns(table_name=self.db_param.NAME_TABLE_INFO_USER)
-        list_columns_pk = self.get_table_columns(table_name=self.db_param.NAME_TABLE_INFO_USER, pk_only=True)
-        list_columns_not_pk = list(set(list_columns_all) - set(list_columns_pk))
-        sql = f"UPDATE {self.db_param.NAME_TABLE_INFO_USER} SET "
-        for column in list_columns_not_pk[:-1]:
-            if type(df_user.loc[0, column]) is str:
-                sql += f"{column} = '{df_user.loc[0, column]}', "
-            else:
-                sql += f"{column} = {df_user.loc[0, column]}, "
-        if type(df_user.loc[0, list_columns_not_pk[-1]]) is str:
-            sql += f"{list_columns_not_pk[-1]} = '{df_user.loc[0, list_columns_not_pk[-1]]}'"
-        else:
-            sql += f"{list_columns_not_pk[-1]} = {df_user.loc[0, list_columns_not_pk[-1]]}"
-        sql += f" WHERE {self.db_param.ID_USER} = '{df_user.loc[0, self.db_param.ID_USER]}';"
-        self.engine.execute(sql)
+        self._update_row(table_name=self.db_param.NAME_TABLE_INFO_USER,
+                         column_key=self.db_param.ID_USER,
+                         df_row=df_user)
 
     def delete_user(self, id_user):
-        sql = f"DELETE FROM \"{self.db_param.NAME_TABLE_INFO_USER}\" " \
-              f" WHERE {self.db_param.ID_USER} = '{id_user}';"
-        self.engine.execute(sql)
+        statement = self._get_statement(
+            ("delete_user",),
+            lambda: f"DELETE FROM \"{self.db_param.NAME_TABLE_INFO_USER}\" WHERE {self.db_param.ID_USER} = :id_user")
+        with self._begin() as conn:
+            conn.execute(statement, id_user=id_user)
+        self._invalidate_cache_metadata(self.db_param.NAME_TABLE_INFO_USER)
 
     ###################################################
     # Functions for the meter registration table
     # Market participants only
 
     def get_info_meter(self, id_user="%%", id_meter="%%",  ts_delivery_active=None):
-        sql = f"SELECT * FROM \"{self.db_param.NAME_TABLE_INFO_METER}\" " \
-              f"WHERE {self.db_param.ID_USER} LIKE '{id_user}' " \
-              f"AND {self.db_param.ID_METER} LIKE '{id_meter}'"
-        if ts_delivery_active is not None:
-            sql += f"AND {self.db_param.TS_DELIVERY_FIRST} <= {ts_delivery_active}" \
-                   f" AND {self.db_param.TS_DELIVERY_LAST} >= {ts_delivery_active}"
-        return self._query_data_free(sql)
+        def build():
+            sql = f"SELECT * FROM \"{self.db_param.NAME_TABLE_INFO_METER}\" " \
+                  f"WHERE {self.db_param.ID_USER} LIKE :id_user " \
+                  f"AND {self.db_param.ID_METER} LIKE :id_meter"
+            if ts_delivery_active is not None:
+                sql += f" AND {self.db_param.TS_DELIVERY_FIRST} <= :ts_delivery_active" \
+                       f" AND {self.db_param.TS_DELIVERY_LAST} >= :ts_delivery_active"
+            return sql
+        statement = self._get_statement(("get_info_meter", ts_delivery_active is None), build)
+        return self._get_cached(key=("get_info_meter", id_user, id_meter, ts_delivery_active),
+                                list_tables=[self.db_param.NAME_TABLE_INFO_METER],
+                                func=lambda: self._query_data_free(statement,
+                                                                   params={"id_user": id_user,
+                                                                           "id_meter": id_meter,
+                                                                           "ts_delivery_active": ts_delivery_active},
+                                                                   table_name=self.db_param.NAME_TABLE_INFO_METER))
 
     def get_mapping_to_user(self):
+        return self._get_cached(key=("get_mapping_to_user",),
+                                list_tables=[self.db_param.NAME_TABLE_INFO_METER, self.db_param.NAME_TABLE_INFO_USER],
+                                func=self._get_mapping_to_user)
+
+    def _get_mapping_to_user(self):
         info_meter = self._query_data_free(f"SELECT {self.db_param.ID_METER}, {self.db_param.ID_USER}"
                                            f" FROM {self.db_param.NAME_TABLE_INFO_METER}")
 
@@ -122,6 +277,11 @@ class DatabaseConnection:
         return dict_mapping
 
     def get_map_to_main_meter(self):
+        return self._get_cached(key=("get_map_to_main_meter",),
+                                list_tables=[self.db_param.NAME_TABLE_INFO_METER, self.db_param.NAME_TABLE_INFO_USER],
+                                func=self._get_map_to_main_meter)
+
+    def _get_map_to_main_meter(self):
         info_meter = self._query_data_free(f"SELECT {self.db_param.ID_METER}, {self.db_param.ID_USER}"
                                            f" FROM {self.db_param.NAME_TABLE_INFO_METER}"
                                            f" WHERE {self.db_param.TYPE_METER} LIKE '%%grid%%'")
@@ -144,27 +304,46 @@ class DatabaseConnection:
     def get_list_main_meters(self, ts_delivery_active=None):
         # select main meters
         # if t_d is used, only meters active at the selected t_d are returned
-        sql = f"SELECT {self.db_param.ID_METER} FROM {self.db_param.NAME_TABLE_INFO_METER}" \
-              f" WHERE ({self.db_param.TYPE_METER} = 1 OR {self.db_param.TYPE_METER} = 2)"
-
-        if ts_delivery_active is not None:
-            sql += f" AND {self.db_param.TS_DELIVERY_FIRST} <= {ts_delivery_active}" \
-                   f" AND {self.db_param.TS_DELIVERY_LAST} >= {ts_delivery_active};"
-        return list(self._query_data_free(sql).loc[:, self.db_param.ID_METER])
+        def build():
+            sql = f"SELECT {self.db_param.ID_METER} FROM {self.db_param.NAME_TABLE_INFO_METER}" \
+                  f" WHERE {self.db_param.TYPE_METER} IN :types_meter_main"
+            if ts_delivery_active is not None:
+                sql += f" AND {self.db_param.TS_DELIVERY_FIRST} <= :ts_delivery_active" \
+                       f" AND {self.db_param.TS_DELIVERY_LAST} >= :ts_delivery_active"
+            return sql
+        statement = self._get_statement(("get_list_main_meters", ts_delivery_active is None), build,
+                                        list_expanding=["types_meter_main"])
+        return list(self._query_data_free(statement,
+                                          params={"types_meter_main": [self.lem_config["types_meter"][4],
+                                                                       self.lem_config["types_meter"][5]],
+                                                  "ts_delivery_active": ts_delivery_active}
+                                          ).loc[:, self.db_param.ID_METER])
 
     def get_list_all_meters(self, ts_delivery_active=None, non_virtual=True):
         # select all meters
         # if t_d is used, only meters active at the selected t_d are returned
-        sql = f"SELECT {self.db_param.ID_METER} FROM {self.db_param.NAME_TABLE_INFO_METER}"
-
-        if ts_delivery_active is not None:
-            sql += f" WHERE ({self.db_param.TS_DELIVERY_FIRST} <= {ts_delivery_active}" \
-                   f" AND {self.db_param.TS_DELIVERY_LAST} >= {ts_delivery_active})"
-        if non_virtual:
-            sql += f" AND {self.db_param.TYPE_METER} NOT LIKE 'virtual%%'"
-        return list(self._query_data_free(sql).loc[:, self.db_param.ID_METER])
+        def build():
+            list_conditions = []
+            if ts_delivery_active is not None:
+                list_conditions += [f"{self.db_param.TS_DELIVERY_FIRST} <= :ts_delivery_active",
+                                    f"{self.db_param.TS_DELIVERY_LAST} >= :ts_delivery_active"]
+            if non_virtual:
+                list_conditions.append(f"{self.db_param.TYPE_METER} NOT LIKE 'virtual%'")
+            sql = f"SELECT {self.db_param.ID_METER} FROM {self.db_param.NAME_TABLE_INFO_METER}"
+            if list_conditions:
+                sql += " WHERE " + " AND ".join(list_conditions)
+            return sql
+        statement = self._get_statement(("get_list_all_meters", ts_delivery_active is None, non_virtual), build)
+        return list(self._query_data_free(statement,
+                                          params={"ts_delivery_active": ts_delivery_active}
+                                          ).loc[:, self.db_param.ID_METER])
 
     def get_map_meter_to_quality(self):
+        return self._get_cached(key=("get_map_meter_to_quality",),
+                                list_tables=[self.db_param.NAME_TABLE_INFO_METER],
+                                func=self._get_map_meter_to_quality)
+
+    def _get_map_meter_to_quality(self):
         info_meter = self._query_data_free(f"SELECT {self.db_param.ID_METER}, {self.db_param.QUALITY_ENERGY}"
                                            f" FROM {self.db_param.NAME_TABLE_INFO_METER}")
 
@@ -180,26 +359,17 @@ class DatabaseConnection:
                     df_insert=df_in)
 
     def edit_meter(self, df_meter):
-        list_columns_all = self.get_table_columns(table_name=self.db_param.NAME_TABLE_INFO_METER)
-        list_columns_pk = self.get_table_columns(table_name=self.db_param.NAME_TABLE_INFO_METER, pk_only=True)
-        list_columns_not_pk = list(set(list_columns_all) - set(list_columns_pk))
-        sql = f"UPDATE {self.db_param.NAME_TABLE_INFO_METER} SET "
-        for column in list_columns_not_pk[:-1]:
-            if type(df_meter.loc[0, column]) is str:
-                sql += f"{column} = '{df_meter.loc[0, column]}', "
-            else:
-                sql += f"{column} = {df_meter.loc[0, column]}, "
-        if type(df_meter.loc[0, list_columns_not_pk[-1]]) is str:
-            sql += f"{list_columns_not_pk[-1]} = '{df_meter.loc[0, list_columns_not_pk[-1]]}' "
-        else:
-            sql += f"{list_columns_not_pk[-1]} = {df_meter.loc[0, list_columns_not_pk[-1]]} "
-        sql += f" WHERE {self.db_param.ID_METER} = '{df_meter.loc[0, self.db_param.ID_METER]}';"
-        self.engine.execute(sql)
+        self._update_row(table_name=self.db_param.NAME_TABLE_INFO_METER,
+                         column_key=self.db_param.ID_METER,
+                         df_row=df_meter)
 
     def delete_meter(self, id_meter):
-        sql = f"DELETE FROM {self.db_param.NAME_TABLE_INFO_METER} " \
-              f" WHERE {self.db_param.ID_METER} = '{id_meter}';"
-        self.engine.execute(sql)
+        statement = self._get_statement(
+            ("delete_meter",),
+            lambda: f"DELETE FROM {self.db_param.NAME_TABLE_INFO_METER} WHERE {self.db_param.ID_METER} = :id_meter")
+        with self._begin() as conn:
+            conn.execute(statement, id_meter=id_meter)
+        self._invalidate_cache_metadata(self.db_param.NAME_TABLE_INFO_METER)
 
     ###################################################
     # Functions for the market bid submission table
@@ -211,86 +381,264 @@ class DatabaseConnection:
                     df_insert=df_bids)
 
     def clear_positions(self, id_user):
-        self.engine.execute(f"DELETE FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE} "
-                            f"WHERE {self.db_param.ID_USER} "
-                            f"LIKE {id_user}")
+        statement = self._get_statement(
+            ("clear_positions",),
+            lambda: f"DELETE FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE} "
+                    f"WHERE {self.db_param.ID_USER} LIKE :id_user")
+        with self._begin() as conn:
+            conn.execute(statement, id_user=id_user)
 
     def get_open_positions(self, id_user="%%", ts_delivery_first=None,
-                           ts_delivery_last=None, clear_table=False, archive=False):
+                           ts_delivery_last=None, clear_table=False, archive=False, aggregate=False):
+        """Returns the open bids and offers, optionally archiving and clearing them in the same transaction.
+
+        :param id_user: str, user id pattern, "%%" for all users
+        :param ts_delivery_first: int, first delivery period, None for no lower bound
+        :param ts_delivery_last: int, last delivery period, None for no upper bound
+        :param clear_table: bool, if True the positions table is cleared
+        :param archive: bool, if True the returned positions are archived
+        :param aggregate: bool, if True the positions of a user with identical delivery period, price and quality are
+                          summed up by the database and returned in clearing order, see _get_sql_positions_aggregated()
+
+        :return: tuple of DataFrames, open bids and open offers
+        """
         ts_delivery_first = ts_delivery_first if ts_delivery_first is not None else 0
         ts_delivery_last = ts_delivery_last if ts_delivery_last is not None else 2147483647
 
-        # query the open bids for the market trading horizon
-        open_bids = self._query_data_free(
-            f"SELECT * FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE} "
-            f"WHERE {self.db_param.ID_USER} LIKE '{id_user}' "
-            f"AND {self.db_param.TYPE_POSITION} LIKE 'bid' "
-            f"AND {self.db_param.TS_DELIVERY} "
-            f"BETWEEN {ts_delivery_first} "
-            f"AND {ts_delivery_last} "
-            f"ORDER BY {self.db_param.TS_DELIVERY}"
-        )
-
-        # query the open offers for the market trading horizon
-        open_offers = self._query_data_free(
-            f"SELECT * FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE} "
-            f"WHERE {self.db_param.ID_USER} LIKE '{id_user}' "
-            f"AND {self.db_param.TYPE_POSITION} LIKE 'offer' "
-            f"AND {self.db_param.TS_DELIVERY} "
-            f"BETWEEN {ts_delivery_first} "
-            f"AND {ts_delivery_last} "
-            f"ORDER BY {self.db_param.TS_DELIVERY}"
-        )
-
-        if archive:
-            self.insert(table_name=self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE,
-                        df_insert=open_bids)
-            self.insert(table_name=self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE,
-                        df_insert=open_offers)
+        sql_filter = f"{self.db_param.ID_USER} LIKE :id_user " \
+                     f"AND {self.db_param.TYPE_POSITION} IN ('bid', 'offer') " \
+                     f"AND {self.db_param.TS_DELIVERY} " \
+                     f"BETWEEN :ts_delivery_first " \
+                     f"AND :ts_delivery_last"
+        params = {"id_user": id_user, "ts_delivery_first": ts_delivery_first, "ts_delivery_last": ts_delivery_last}
 
         if clear_table:
-            self._clear_table(self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE)
+            # read, archive and clear the open positions in a single statement. The statement runs in one
+            # transaction, so positions posted while the market is being cleared are neither lost nor archived
+            # without having been read
+            def build():
+                list_columns = ", ".join(self.get_table_columns(self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE))
+                sql = f"WITH moved AS (DELETE FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE} RETURNING *)"
+                if archive:
+                    sql += f", archived AS (INSERT INTO {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE} " \
+                           f"({list_columns}) SELECT {list_columns} FROM moved WHERE {sql_filter})"
+                if aggregate:
+                    sql += " " + self._get_sql_positions_aggregated(source="moved", sql_filter=sql_filter)
+                else:
+                    sql += f" SELECT * FROM moved WHERE {sql_filter} ORDER BY {self.db_param.TS_DELIVERY}"
+                return sql
+            statement = self._get_statement(("get_open_positions", clear_table, archive, aggregate), build)
+            with self._begin() as conn:
+                open_positions = pd.read_sql_query(statement, conn, params=self._to_python(params))
+            open_positions = self._set_dtypes(open_positions, self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE)
+        elif aggregate:
+            # archive the individual positions, but only return the aggregated book
+            def build():
+                list_columns = ", ".join(self.get_table_columns(self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE))
+                sql = f"WITH selected AS (SELECT * FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE} " \
+                      f"WHERE {sql_filter})"
+                if archive:
+                    sql += f", archived AS (INSERT INTO {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE} " \
+                           f"({list_columns}) SELECT {list_columns} FROM selected)"
+                return sql + " " + self._get_sql_positions_aggregated(source="selected")
+            statement = self._get_statement(("get_open_positions", clear_table, archive, aggregate), build)
+            with self._begin() as conn:
+                open_positions = pd.read_sql_query(statement, conn, params=self._to_python(params))
+            open_positions = self._set_dtypes(open_positions, self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE)
+        else:
+            # query the open bids and offers for the market trading horizon in a single round trip
+            statement = self._get_statement(
+                ("get_open_positions", clear_table),
+                lambda: f"SELECT * FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE} "
+                        f"WHERE {sql_filter} "
+                        f"ORDER BY {self.db_param.TS_DELIVERY}")
+            open_positions = self._query_data_free(statement,
+                                                   params=params,
+                                                   table_name=self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE)
+            if archive:
+                self.insert(table_name=self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE,
+                            df_insert=open_positions)
+
+        open_bids = open_positions[open_positions[self.db_param.TYPE_POSITION] == "bid"].reset_index(drop=True)
+        open_offers = open_positions[open_positions[self.db_param.TYPE_POSITION] == "offer"].reset_index(drop=True)
 
         return open_bids, open_offers
 
+    def _get_sql_positions_aggregated(self, source, sql_filter=None):
+        # positions of a user with identical delivery period, type, price and quality are merged into one position
+        # with the summed quantity. The book is sorted in clearing order per delivery period: offers by ascending
+        # and bids by descending price, then by descending quality name as clearing_pda() sorts the qualities,
+        # remaining ties in random order so that the time of submission does not matter. The binary collation "C"
+        # compares the names by code point, as python does
+        dict_aggregation = {self.db_param.QTY_ENERGY: "CAST(SUM({}) AS BIGINT)",
+                            self.db_param.PREMIUM_PREFERENCE_QUALITY: "MAX({})",
+                            self.db_param.NUMBER_POSITION: "MIN({})",
+                            self.db_param.STATUS_POSITION: "MIN({})",
+                            self.db_param.T_SUBMISSION: "MAX({})"}
+        list_columns_group = [self.db_param.TS_DELIVERY, self.db_param.ID_USER, self.db_param.PRICE_ENERGY,
+                              self.db_param.QUALITY_ENERGY, self.db_param.TYPE_POSITION]
+        list_select = []
+        for column in self.get_table_columns(self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE):
+            if column in list_columns_group:
+                list_select.append(column)
+            else:
+                list_select.append(f"{dict_aggregation.get(column, 'MIN({})').format(column)} AS {column}")
+        sql = f"SELECT {', '.join(list_select)} FROM {source}"
+        if sql_filter is not None:
+            sql += f" WHERE {sql_filter}"
+        sql += f" GROUP BY {', '.join(list_columns_group)}" \
+               f" ORDER BY {self.db_param.TS_DELIVERY}, {self.db_param.TYPE_POSITION}," \
+               f" CASE WHEN {self.db_param.TYPE_POSITION} = 'offer' THEN {self.db_param.PRICE_ENERGY}" \
+               f" ELSE -{self.db_param.PRICE_ENERGY} END," \
+               f" {self.db_param.QUALITY_ENERGY} COLLATE \"C\" DESC," \
+               f" random()"
+        return sql
+
     def get_positions_archive(self, id_user="%%", ts_delivery_first=None, ts_delivery_last=None):
 
         ts_delivery_first = ts_delivery_first if ts_delivery_first is not None else 0
         ts_delivery_last = ts_delivery_last if ts_delivery_last is not None else 2147483647
 
-        # query the open bids for the market trading horizon
-        bids_archived = self._query_data_free(
-            f"SELECT * FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE} "
-            f"WHERE {self.db_param.ID_USER} LIKE '{id_user}' "
-            f"AND {self.db_param.TYPE_POSITION} LIKE 'bid' "
-            f"AND {self.db_param.TS_DELIVERY} "
-            f"BETWEEN {ts_delivery_first} "
-            f"AND {ts_delivery_last} "
-            f"ORDER BY {self.db_param.TS_DELIVERY}"
-        )
-
-        # query the open offers for the market trading horizon
-        offers_archived = self._query_data_free(
-            f"SELECT * FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE} "
-            f"WHERE {self.db_param.ID_USER} LIKE '{id_user}' "
-            f"AND {self.db_param.TYPE_POSITION} LIKE 'offer' "
-            f"AND {self.db_param.TS_DELIVERY} "
-            f"BETWEEN {ts_delivery_first} "
-            f"AND {ts_delivery_last} "
-            f"ORDER BY {self.db_param.TS_DELIVERY}"
-        )
+        # query the archived bids and offers for the market trading horizon in a single round trip
+        statement = self._get_statement(
+            ("get_positions_archive",),
+            lambda: f"SELECT * FROM {self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE} "
+                    f"WHERE {self.db_param.ID_USER} LIKE :id_user "
+                    f"AND {self.db_param.TYPE_POSITION} IN ('bid', 'offer') "
+                    f"AND {self.db_param.TS_DELIVERY} "
+                    f"BETWEEN :ts_delivery_first "
+                    f"AND :ts_delivery_last "
+                    f"ORDER BY {self.db_param.TS_DELIVERY}")
+        positions_archived = self._query_data_free(
+            statement,
+            params={"id_user": id_user, "ts_delivery_first": ts_delivery_first, "ts_delivery_last": ts_delivery_last},
+            table_name=self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE)
+
+        bids_archived = positions_archived[positions_archived[self.db_param.TYPE_POSITION] == "bid"
+                                           ].reset_index(drop=True)
+        offers_archived = positions_archived[positions_archived[self.db_param.TYPE_POSITION] == "offer"
+                                             ].reset_index(drop=True)
 
         return bids_archived, offers_archived
 
     # Admins only
 
+    def compact_positions_archive(self, ts_delivery_before, mode="summary", path_cold=None, t_max=None,
+                                  size_batch=4):
+        """Compacts archived positions of delivery periods before ts_delivery_before and prunes them from the archive.
+
+        The oldest delivery periods are processed first, in batches of size_batch delivery periods. Each batch is moved
+        in a single transaction. Processing stops after the first batch that exceeds t_max, so the method can be
+        called each step and catches up with the retention period over several steps.
+
+        :param ts_delivery_before: int, archived positions of earlier delivery periods are compacted
+        :param mode: str, "summary" aggregates positions per delivery period, type and quality into the summary
+                     table, "cold" moves the positions to compressed parquet files in path_cold
+        :param path_cold: str, directory of the cold files, required for mode "cold"
+        :param t_max: float, seconds after which no further batch is started, None for no limit
+        :param size_batch: int, number of delivery periods compacted per transaction
+
+        :return: int, number of archived positions compacted
+        """
+        t_start = time.time()
+        n_compacted = 0
+        name_archive = self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE
+        while t_max is None or time.time() - t_start < t_max:
+            ts_delivery_first = self._query_data_free(
+                self._get_statement(("compact_positions_archive", "first"),
+                                    lambda: f"SELECT MIN({self.db_param.TS_DELIVERY}) AS ts_first "
+                                            f"FROM {name_archive} "
+                                            f"WHERE {self.db_param.TS_DELIVERY} < :ts_delivery_before"),
+                params={"ts_delivery_before": int(ts_delivery_before)})["ts_first"].iloc[0]
+            if pd.isna(ts_delivery_first):
+                break
+            ts_delivery_first = int(ts_delivery_first)
+            ts_delivery_last = int(min(ts_delivery_first + (size_batch - 1) * 900, ts_delivery_before - 1))
+            params = {"ts_delivery_first": ts_delivery_first, "ts_delivery_last": ts_delivery_last}
+            sql_moved = f"WITH moved AS (DELETE FROM {name_archive} " \
+                        f"WHERE {self.db_param.TS_DELIVERY} BETWEEN :ts_delivery_first AND :ts_delivery_last " \
+                        f"RETURNING *) "
+            with self._begin() as conn:
+                if mode == "cold":
+                    df_moved = pd.read_sql_query(
+                        self._get_statement(("compact_positions_archive", mode),
+                                            lambda: sql_moved + "SELECT * FROM moved"),
+                        conn, params=params)
+                    os.makedirs(path_cold, exist_ok=True)
+                    # an exception while writing rolls back the transaction, no positions are lost
+                    df_moved.to_parquet(f"{path_cold}/{name_archive}_{ts_delivery_first}_{ts_delivery_last}.parquet",
+                                        compression="zstd", index=False)
+                    n_moved = len(df_moved)
+                else:
+                    # delivery periods may be compacted again, e.g. if positions were archived after their first
+                    # compaction. existing summaries are merged with the new one, the mean price is weighted by the
+                    # quantities of both
+                    n_moved = conn.execute(self._get_statement(("compact_positions_archive", mode),
+                                                               lambda: self._get_sql_summary_positions(sql_moved)),
+                                           params).scalar()
+            n_compacted += n_moved
+        return n_compacted
+
+    def _get_sql_summary_positions(self, sql_moved):
+        # aggregates the positions moved by sql_moved into the summary table and returns the number of moved positions
+        name_summary = self.db_param.NAME_TABLE_POSITIONS_MARKET_EX_ANTE_SUMMARY
+        qty_old = f"{name_summary}.{self.db_param.QTY_ENERGY}"
+        qty_new = f"EXCLUDED.{self.db_param.QTY_ENERGY}"
+        return sql_moved[:-1] + \
+            f", summarized AS (" \
+            f"INSERT INTO {name_summary} " \
+            f"({self.db_param.TS_DELIVERY}, {self.db_param.TYPE_POSITION}, " \
+            f"{self.db_param.QUALITY_ENERGY}, {self.db_param.NUMBER_POSITIONS}, " \
+            f"{self.db_param.QTY_ENERGY}, {self.db_param.PRICE_ENERGY_MIN}, " \
+            f"{self.db_param.PRICE_ENERGY_MAX}, {self.db_param.PRICE_ENERGY_MEAN}, " \
+            f"{self.db_param.T_SUBMISSION_FIRST}, {self.db_param.T_SUBMISSION_LAST}) " \
+            f"SELECT {self.db_param.TS_DELIVERY}, {self.db_param.TYPE_POSITION}, " \
+            f"{self.db_param.QUALITY_ENERGY}, COUNT(*), SUM({self.db_param.QTY_ENERGY}), " \
+            f"MIN({self.db_param.PRICE_ENERGY}), MAX({self.db_param.PRICE_ENERGY}), " \
+            f"ROUND(SUM({self.db_param.PRICE_ENERGY} * {self.db_param.QTY_ENERGY}::NUMERIC) " \
+            f"/ NULLIF(SUM({self.db_param.QTY_ENERGY}), 0)), " \
+            f"MIN({self.db_param.T_SUBMISSION}), MAX({self.db_param.T_SUBMISSION}) " \
+            f"FROM moved GROUP BY {self.db_param.TS_DELIVERY}, {self.db_param.TYPE_POSITION}, " \
+            f"{self.db_param.QUALITY_ENERGY} " \
+            f"ON CONFLICT ({self.db_param.TS_DELIVERY}, {self.db_param.TYPE_POSITION}, " \
+            f"{self.db_param.QUALITY_ENERGY}) DO UPDATE SET " \
+            f"{self.db_param.NUMBER_POSITIONS} = {name_summary}.{self.db_param.NUMBER_POSITIONS} " \
+            f"+ EXCLUDED.{self.db_param.NUMBER_POSITIONS}, " \
+            f"{self.db_param.QTY_ENERGY} = {qty_old} + {qty_new}, " \
+            f"{self.db_param.PRICE_ENERGY_MIN} = LEAST({name_summary}.{self.db_param.PRICE_ENERGY_MIN}, " \
+            f"EXCLUDED.{self.db_param.PRICE_ENERGY_MIN}), " \
+            f"{self.db_param.PRICE_ENERGY_MAX} = GREATEST({name_summary}.{self.db_param.PRICE_ENERGY_MAX}, " \
+            f"EXCLUDED.{self.db_param.PRICE_ENERGY_MAX}), " \
+            f"{self.db_param.PRICE_ENERGY_MEAN} = ROUND(" \
+            f"(COALESCE({name_summary}.{self.db_param.PRICE_ENERGY_MEAN}, 0) * {qty_old}::NUMERIC " \
+            f"+ COALESCE(EXCLUDED.{self.db_param.PRICE_ENERGY_MEAN}, 0) * {qty_new}::NUMERIC) " \
+            f"/ NULLIF({qty_old} + {qty_new}, 0)), " \
+            f"{self.db_param.T_SUBMISSION_FIRST} = LEAST({name_summary}.{self.db_param.T_SUBMISSION_FIRST}, " \
+            f"EXCLUDED.{self.db_param.T_SUBMISSION_FIRST}), " \
+            f"{self.db_param.T_SUBMISSION_LAST} = GREATEST({name_summary}.{self.db_param.T_SUBMISSION_LAST}, " \
+            f"EXCLUDED.{self.db_param.T_SUBMISSION_LAST})) " \
+            f"SELECT COUNT(*) FROM moved"
+
     ###################################################
     # Functions for the market results table
     # Market participants only
 
     def get_results_market_ex_ante(self, table_name=None, id_user="%%", ts_delivery_first=None, ts_delivery_last=None,
-                                   t_cleared_first=None, t_cleared_last=None):
-
+                                   t_cleared_first=None, t_cleared_last=None, results_market=None):
+        """Returns the matched positions of a user and, for a single user, the net matched quantity per delivery period.
+
+        :param table_name: str, results table, defaults to the first ex-ante clearing type
+        :param id_user: str, user id pattern, "%%" for all users
+        :param ts_delivery_first: int, first delivery period, None for no lower bound
+        :param ts_delivery_last: int, last delivery period, None for no upper bound
+        :param t_cleared_first: int, earliest clearing time, None for no lower bound
+        :param t_cleared_last: int, latest clearing time, None for no upper bound
+        :param results_market: DataFrame, prefetched results of id_user covering the requested range, see
+                               get_results_market_ex_ante_by_user(). If given, no query is issued
+
+        :return: tuple, DataFrame of matched positions and DataFrame of net matched quantities by delivery period,
+                 the latter is None if id_user is "%%"
+        """
         # generate table name to be queried
         if table_name is None:
             table_name = self.db_param.NAME_TABLE_RESULTS_MARKET_EX_ANTE_ + self.lem_config["types_clearing_ex_ante"][0]
@@ -303,18 +651,93 @@ class DatabaseConnection:
         t_cleared_first = t_cleared_first if t_cleared_first is not None else 0
         t_cleared_last = t_cleared_last if t_cleared_last is not None else 2147483647
 
+        if results_market is not None:
+            matched_bids = results_market[
+                results_market[self.db_param.TS_DELIVERY].between(ts_delivery_first, ts_delivery_last)
+                & results_market[self.db_param.T_CLEARED].between(t_cleared_first, t_cleared_last)
+                ].reset_index(drop=True)
+            return self._get_net_bids_by_timestep(matched_bids, id_user=id_user,
+                                                  ts_delivery_first=ts_delivery_first,
+                                                  ts_delivery_last=ts_delivery_last)
+
+        statement = self._get_statement(
+            ("get_results_market_ex_ante", table_name),
+            lambda: f"SELECT * FROM {table_name} "
+                    f"WHERE ({self.db_param.ID_USER_BID} LIKE :id_user "
+                    f"OR {self.db_param.ID_USER_OFFER} LIKE :id_user) "
+                    f"AND {self.db_param.TS_DELIVERY} "
+                    f"BETWEEN :ts_delivery_first "
+                    f"AND :ts_delivery_last "
+                    f"AND {self.db_param.T_CLEARED} "
+                    f"BETWEEN :t_cleared_first "
+                    f"AND :t_cleared_last "
+                    f"ORDER BY {self.db_param.TS_DELIVERY}")
+        matched_bids = self._query_data_free(statement,
+                                             params={"id_user": id_user,
+                                                     "ts_delivery_first": ts_delivery_first,
+                                                     "ts_delivery_last": ts_delivery_last,
+                                                     "t_cleared_first": t_cleared_first,
+                                                     "t_cleared_last": t_cleared_last},
+                                             table_name=table_name)
+
+        return self._get_net_bids_by_timestep(matched_bids, id_user=id_user,
+                                              ts_delivery_first=ts_delivery_first,
+                                              ts_delivery_last=ts_delivery_last)
+
+    def get_results_market_ex_ante_by_user(self, list_id_user, table_name=None, ts_delivery_first=None,
+                                           ts_delivery_last=None, t_cleared_first=None, t_cleared_last=None):
+        """Returns the matched positions of several users, retrieved in a single query.
+
+        The DataFrame of each user equals the matched positions returned by get_results_market_ex_ante() for that user
+        and can be passed to it as results_market to compute the net matched quantities without another query.
+
+        :param list_id_user: list of str, user ids
+        :param table_name: str, results table, defaults to the first ex-ante clearing type
+        :param ts_delivery_first: int, first delivery period, None for no lower bound
+        :param ts_delivery_last: int, last delivery period, None for no upper bound
+        :param t_cleared_first: int, earliest clearing time, None for no lower bound
+        :param t_cleared_last: int, latest clearing time, None for no upper bound
+
+        :return: dict, DataFrame of matched positions by user id, for every user of list_id_user
+        """
+        if table_name is None:
+            table_name = self.db_param.NAME_TABLE_RESULTS_MARKET_EX_ANTE_ + self.lem_config["types_clearing_ex_ante"][0]
+        statement = self._get_statement(
+            ("get_results_market_ex_ante_by_user", table_name),
+            lambda: f"SELECT * FROM {table_name} "
+                    f"WHERE ({self.db_param.ID_USER_BID} IN :list_id_user "
+                    f"OR {self.db_param.ID_USER_OFFER} IN :list_id_user) "
+                    f"AND {self.db_param.TS_DELIVERY} "
+                    f"BETWEEN :ts_delivery_first "
+                    f"AND :ts_delivery_last "
+                    f"AND {self.db_param.T_CLEARED} "
+                    f"BETWEEN :t_cleared_first "
+                    f"AND :t_cleared_last "
+                    f"ORDER BY {self.db_param.TS_DELIVERY}",
+            list_expanding=["list_id_user"])
         matched_bids = self._query_data_free(
-            f"SELECT * FROM {table_name} "
-            f"WHERE ({self.db_param.ID_USER_BID} LIKE '{id_user}' "
-            f"OR {self.db_param.ID_USER_OFFER} LIKE '{id_user}') "
-            f"AND {self.db_param.TS_DELIVERY} "
-            f"BETWEEN '{ts_delivery_first}' "
-            f"AND '{ts_delivery_last}' "
-            f"AND {self.db_param.T_CLEARED} "
-            f"BETWEEN '{t_cleared_first}' "
-            f"AND '{t_cleared_last}' "
-            f"ORDER BY {self.db_param.TS_DELIVERY}")
-
+            statement,
+            params={"list_id_user": list(list_id_user),
+                    "ts_delivery_first": ts_delivery_first if ts_delivery_first is not None else 0,
+                    "ts_delivery_last": ts_delivery_last if ts_delivery_last is not None else 2147483647,
+                    "t_cleared_first": t_cleared_first if t_cleared_first is not None else 0,
+                    "t_cleared_last": t_cleared_last if t_cleared_last is not None else 2147483647},
+            table_name=table_name)
+
+        # partition by user, a position matched between two of the users belongs to both
+        dict_index = {id_user: [] for id_user in list_id_user}
+        for column in [self.db_param.ID_USER_BID, self.db_param.ID_USER_OFFER]:
+            for id_user, index in matched_bids.groupby(column).indices.items():
+                if id_user in dict_index:
+                    dict_index[id_user].append(index)
+        return {id_user: matched_bids.iloc[np.unique(np.concatenate(list_index)) if list_index else []
+                                           ].reset_index(drop=True)
+                for id_user, list_index in dict_index.items()}
+
+    def _get_net_bids_by_timestep(self, matched_bids, id_user, ts_delivery_first, ts_delivery_last):
+        # adds the net matched quantity of id_user, offered minus bid, to the matched positions and sums it up per
+        # delivery period. The sums are None for all users
+        matched_bids_by_timestep = None
         if id_user != "%%" and len(matched_bids):
             # summate matched market bids for id_user for the market trading horizon
             # initialize dataframe
@@ -364,12 +787,16 @@ class DatabaseConnection:
                     df_insert=df_in)
 
     def get_status_settlement(self, ts_delivery=None):
-        if ts_delivery is None:
-            return self._query_data_free(f"SELECT * FROM {self.db_param.NAME_TABLE_STATUS_SETTLEMENT}  "
-                                         f"ORDER BY {self.db_param.TS_DELIVERY}")
-        else:
-            return self._query_data_free(f"SELECT * FROM {self.db_param.NAME_TABLE_STATUS_SETTLEMENT}  "
-                                         f"WHERE {self.db_param.TS_DELIVERY}={ts_delivery}")
+        def build():
+            if ts_delivery is None:
+                return f"SELECT * FROM {self.db_param.NAME_TABLE_STATUS_SETTLEMENT} " \
+                       f"ORDER BY {self.db_param.TS_DELIVERY}"
+            return f"SELECT * FROM {self.db_param.NAME_TABLE_STATUS_SETTLEMENT} " \
+                   f"WHERE {self.db_param.TS_DELIVERY} = :ts_delivery"
+        statement = self._get_statement(("get_status_settlement", ts_delivery is None), build)
+        return self._query_data_free(statement,
+                                     params={"ts_delivery": ts_delivery},
+                                     table_name=self.db_param.NAME_TABLE_STATUS_SETTLEMENT)
 
     ###################################################
     # Functions for the cumulative meter readings table
@@ -380,15 +807,35 @@ class DatabaseConnection:
                     df_insert=df_readings_meter)
 
     def get_meter_readings_cumulative(self, t_reading_first, t_reading_last,
-                                      id_meter="%%"):
-        # query cumulative meter readings
+                                      id_meter="%%", list_t_reading=None):
+        # query cumulative meter readings, optionally only those at the times in list_t_reading within the range
+        if list_t_reading is None:
+            statement = self._get_statement(
+                ("get_meter_readings_cumulative",),
+                lambda: f"SELECT * FROM {self.db_param.NAME_TABLE_READINGS_METER_CUMULATIVE} "
+                        f"WHERE {self.db_param.ID_METER} LIKE :id_meter "
+                        f"AND {self.db_param.T_READING} "
+                        f"BETWEEN :t_reading_first "
+                        f"AND :t_reading_last "
+                        f"ORDER BY {self.db_param.T_READING}")
+        else:
+            statement = self._get_statement(
+                ("get_meter_readings_cumulative", "list_t_reading"),
+                lambda: f"SELECT * FROM {self.db_param.NAME_TABLE_READINGS_METER_CUMULATIVE} "
+                        f"WHERE {self.db_param.ID_METER} LIKE :id_meter "
+                        f"AND {self.db_param.T_READING} "
+                        f"BETWEEN :t_reading_first "
+                        f"AND :t_reading_last "
+                        f"AND {self.db_param.T_READING} IN :list_t_reading "
+                        f"ORDER BY {self.db_param.T_READING}",
+                list_expanding=["list_t_reading"])
+        params = {"id_meter": id_meter, "t_reading_first": t_reading_first, "t_reading_last": t_reading_last}
+        if list_t_reading is not None:
+            params["list_t_reading"] = [int(t_reading) for t_reading in list_t_reading]
         readings_meter_cumulative = self._query_data_free(
-            f"SELECT * FROM {self.db_param.NAME_TABLE_READINGS_METER_CUMULATIVE} "
-            f"WHERE {self.db_param.ID_METER} LIKE '{id_meter}' "
-            f"AND {self.db_param.T_READING} "
-            f"BETWEEN '{t_reading_first}' "
-            f"AND '{t_reading_last}' "
-            f"ORDER BY {self.db_param.T_READING}")
+            statement,
+            params=params,
+            table_name=self.db_param.NAME_TABLE_READINGS_METER_CUMULATIVE)
         return readings_meter_cumulative
 
     # Admins only
@@ -410,35 +857,52 @@ class DatabaseConnection:
         ts_delivery_first = ts_delivery_first if ts_delivery_first is not None else 0
         ts_delivery_last = ts_delivery_last if ts_delivery_last is not None else 2147483647
 
+        statement = self._get_statement(
+            ("get_meter_readings_delta",),
+            lambda: f"SELECT * FROM {self.db_param.NAME_TABLE_READINGS_METER_DELTA} "
+                    f"WHERE {self.db_param.ID_METER} LIKE :id_meter "
+                    f"AND {self.db_param.TS_DELIVERY} "
+                    f"BETWEEN :ts_delivery_first "
+                    f"AND :ts_delivery_last "
+                    f"ORDER BY {self.db_param.TS_DELIVERY}")
         readings_meter_delta = self._query_data_free(
-            f"SELECT * FROM {self.db_param.NAME_TABLE_READINGS_METER_DELTA} "
-            f"WHERE {self.db_param.ID_METER} LIKE '{id_meter}' "
-            f"AND {self.db_param.TS_DELIVERY} "
-            f"BETWEEN '{ts_delivery_first}' "
-            f"AND '{ts_delivery_last}' "
-            f"ORDER BY {self.db_param.TS_DELIVERY}")
+            statement,
+            params={"id_meter": id_meter, "ts_delivery_first": ts_delivery_first, "ts_delivery_last": ts_delivery_last},
+            table_name=self.db_param.NAME_TABLE_READINGS_METER_DELTA)
         return readings_meter_delta
 
-    def get_meter_readings_by_type(self, ts_delivery, types_meters=None):
+    def get_meter_readings_by_type(self, ts_delivery, types_meters=None, ts_delivery_last=None):
+        """Returns the energy deltas of all meters of the given types that are active during the delivery period.
+
+        :param ts_delivery: int, delivery period, the first one if ts_delivery_last is given
+        :param types_meters: list of int, keys of the meter types in the lem config, None for all types
+        :param ts_delivery_last: int, last delivery period, None to query ts_delivery only
+
+        :return: DataFrame, meter reading deltas ordered by delivery period
+        """
         if types_meters is None:
             types_meters = []
         if len(types_meters) == 0:
             types_meters = [0, 1, 2, 3, 4, 5]
-
-        df_meters = self._query_data_free(f"SELECT * FROM {self.db_param.NAME_TABLE_INFO_METER}"
-                                          f" WHERE {self.db_param.TS_DELIVERY_FIRST} <= {ts_delivery} "
-                                          f" AND {self.db_param.TS_DELIVERY_LAST} >= {ts_delivery}")
-        df_meters = df_meters[df_meters["type_meter"].isin([self.lem_config["types_meter"][i] for i in types_meters])]
-        list_meters = list(df_meters["id_meter"])
-
-        str_list_meters = "\'" + '\', \''.join(list_meters) + "\'"
-
-        sql = f"SELECT * FROM {self.db_param.NAME_TABLE_READINGS_METER_DELTA} " \
-              f"WHERE {self.db_param.ID_METER} IN ({str_list_meters}) " \
-              f"AND {self.db_param.TS_DELIVERY} = {ts_delivery} " \
-              f"ORDER BY {self.db_param.TS_DELIVERY}"
-
-        return self._query_data_free(sql)
+        ts_delivery_last = ts_delivery_last if ts_delivery_last is not None else ts_delivery
+
+        # select the readings of all meters of the requested types that are active at their ts_delivery in one query
+        statement = self._get_statement(
+            ("get_meter_readings_by_type",),
+            lambda: f"SELECT readings.* FROM {self.db_param.NAME_TABLE_READINGS_METER_DELTA} AS readings "
+                    f"JOIN {self.db_param.NAME_TABLE_INFO_METER} AS meters "
+                    f"ON readings.{self.db_param.ID_METER} = meters.{self.db_param.ID_METER} "
+                    f"WHERE meters.{self.db_param.TYPE_METER} IN :types_meter "
+                    f"AND meters.{self.db_param.TS_DELIVERY_FIRST} <= readings.{self.db_param.TS_DELIVERY} "
+                    f"AND meters.{self.db_param.TS_DELIVERY_LAST} >= readings.{self.db_param.TS_DELIVERY} "
+                    f"AND readings.{self.db_param.TS_DELIVERY} BETWEEN :ts_delivery AND :ts_delivery_last "
+                    f"ORDER BY readings.{self.db_param.TS_DELIVERY}",
+            list_expanding=["types_meter"])
+        return self._query_data_free(statement,
+                                     params={"types_meter": [self.lem_config["types_meter"][i] for i in types_meters],
+                                             "ts_delivery": ts_delivery,
+                                             "ts_delivery_last": ts_delivery_last},
+                                     table_name=self.db_param.NAME_TABLE_READINGS_METER_DELTA)
 
     ###################################################
     # Functions for the ex_post_pricing results table
@@ -455,29 +919,39 @@ class DatabaseConnection:
     def get_results_market_ex_post(self, table_name=None, ts_delivery_first=None, ts_delivery_last=None):
         if table_name is None:
             table_name = self.db_param.NAME_TABLE_RESULTS_MARKET_EX_POST_ + self.lem_config["types_clearing_ex_post"][0]
-        if ts_delivery_first is None and ts_delivery_last is None:
-            sql = f"SELECT * FROM {table_name} " \
-                  f"ORDER BY self.db_param.TS_DELIVERY"
-        elif ts_delivery_first is not None and ts_delivery_last is None:
-            sql = f"SELECT * FROM {table_name} " \
-                  f"WHERE {self.db_param.TS_DELIVERY} = {ts_delivery_first}"
-        else:
-            sql = f"SELECT * FROM {table_name} " \
-                  f"WHERE {self.db_param.TS_DELIVERY} BETWEEN {ts_delivery_first} " \
-                  f"AND {ts_delivery_last}"
-        return self._query_data_free(sql)
+        def build():
+            if ts_delivery_first is None and ts_delivery_last is None:
+                return f"SELECT * FROM {table_name} " \
+                       f"ORDER BY {self.db_param.TS_DELIVERY}"
+            elif ts_delivery_first is not None and ts_delivery_last is None:
+                return f"SELECT * FROM {table_name} " \
+                       f"WHERE {self.db_param.TS_DELIVERY} = :ts_delivery_first"
+            return f"SELECT * FROM {table_name} " \
+                   f"WHERE {self.db_param.TS_DELIVERY} BETWEEN :ts_delivery_first " \
+                   f"AND :ts_delivery_last"
+        statement = self._get_statement(("get_results_market_ex_post", table_name,
+                                         ts_delivery_first is None, ts_delivery_last is None), build)
+        return self._query_data_free(statement,
+                                     params={"ts_delivery_first": ts_delivery_first,
+                                             "ts_delivery_last": ts_delivery_last},
+                                     table_name=table_name)
 
     ###################################################
     # Functions for the balancing energy table
     # Market participants only
 
-    def get_energy_balancing(self, ts_delivery=None):
-        sql = f"SELECT * FROM {self.db_param.NAME_TABLE_ENERGY_BALANCING}"
-
-        if ts_delivery is not None:
-            sql += f" WHERE {self.db_param.TS_DELIVERY} = '{ts_delivery}'"
-
-        return self._query_data_free(sql)
+    def get_energy_balancing(self, ts_delivery=None, ts_delivery_last=None):
+        def build():
+            sql = f"SELECT * FROM {self.db_param.NAME_TABLE_ENERGY_BALANCING}"
+            if ts_delivery is not None and ts_delivery_last is not None:
+                sql += f" WHERE {self.db_param.TS_DELIVERY} BETWEEN :ts_delivery AND :ts_delivery_last"
+            elif ts_delivery is not None:
+                sql += f" WHERE {self.db_param.TS_DELIVERY} = :ts_delivery"
+            return sql
+        statement = self._get_statement(("get_energy_balancing", ts_delivery is None, ts_delivery_last is None), build)
+        return self._query_data_free(statement,
+                                     params={"ts_delivery": ts_delivery, "ts_delivery_last": ts_delivery_last},
+                                     table_name=self.db_param.NAME_TABLE_ENERGY_BALANCING)
 
     # Admins only
 
@@ -494,12 +968,17 @@ class DatabaseConnection:
         ts_delivery_first = ts_delivery_first if ts_delivery_first is not None else 0
         ts_delivery_last = ts_delivery_last if ts_delivery_last is not None else ts_delivery_first
 
-        sql = f"SELECT * FROM {self.db_param.NAME_TABLE_PRICES_SETTLEMENT} " \
-              f"WHERE {self.db_param.TS_DELIVERY} " \
-              f"BETWEEN {ts_delivery_first} AND {ts_delivery_last} " \
-              f"ORDER BY {self.db_param.TS_DELIVERY}  "
+        statement = self._get_statement(
+            ("get_prices_settlement",),
+            lambda: f"SELECT * FROM {self.db_param.NAME_TABLE_PRICES_SETTLEMENT} "
+                    f"WHERE {self.db_param.TS_DELIVERY} "
+                    f"BETWEEN :ts_delivery_first AND :ts_delivery_last "
+                    f"ORDER BY {self.db_param.TS_DELIVERY}")
 
-        return self._query_data_free(sql)
+        return self._query_data_free(statement,
+                                     params={"ts_delivery_first": ts_delivery_first,
+                                             "ts_delivery_last": ts_delivery_last},
+                                     table_name=self.db_param.NAME_TABLE_PRICES_SETTLEMENT)
 
     # Admins only
 
@@ -518,30 +997,98 @@ class DatabaseConnection:
         ts_delivery_first = ts_delivery_first if ts_delivery_first is not None else 0
         ts_delivery_last = ts_delivery_last if ts_delivery_last is not None else 2147483647
 
+        statement = self._get_statement(
+            ("get_logs_transactions",),
+            lambda: f"SELECT * FROM {self.db_param.NAME_TABLE_LOGS_TRANSACTIONS} "
+                    f"WHERE {self.db_param.ID_USER} LIKE :id_user "
+                    f"AND {self.db_param.TS_DELIVERY} "
+                    f"BETWEEN :ts_delivery_first "
+                    f"AND :ts_delivery_last "
+                    f"ORDER BY {self.db_param.TS_DELIVERY}")
         logs_transactions = self._query_data_free(
-            f"SELECT * FROM {self.db_param.NAME_TABLE_LOGS_TRANSACTIONS} "
-            f"WHERE {self.db_param.ID_USER} LIKE '{id_user}' "
-            f"AND {self.db_param.TS_DELIVERY} "
-            f"BETWEEN '{ts_delivery_first}' "
-            f"AND '{ts_delivery_last}' "
-            f"ORDER BY {self.db_param.TS_DELIVERY}")
+            statement,
+            params={"id_user": id_user, "ts_delivery_first": ts_delivery_first, "ts_delivery_last": ts_delivery_last},
+            table_name=self.db_param.NAME_TABLE_LOGS_TRANSACTIONS)
         return logs_transactions
 
     # Admins only
 
-    def update_balance_user(self, update_balance_df):
-        conn = self.engine.connect()
-
-        for _, row in update_balance_df.iterrows():
-            sql = f"UPDATE {self.db_param.NAME_TABLE_INFO_USER} " \
-                  f" SET {self.db_param.BALANCE_ACCOUNT} = {self.db_param.BALANCE_ACCOUNT}" \
-                  f" + {row[self.db_param.DELTA_BALANCE]}," \
-                  f" {self.db_param.T_UPDATE_BALANCE} = {row[self.db_param.T_UPDATE_BALANCE]}" \
-                  f" WHERE {self.db_param.ID_USER} = '{row[self.db_param.ID_USER]}'"
+    def get_balances_user(self, id_user="%%"):
+        """Returns the current account balances of the users.
+
+        If balances are kept in the ledger, the balance of a user is the last snapshot, or the opening balance in
+        info_user if there is none, plus the sum of all transactions logged since the snapshot. Otherwise, the
+        balances are read from info_user.
+
+        :param id_user: str, id of the user, all users by default
+
+        :return: DataFrame with the columns id_user and balance_account
+        """
+        def build():
+            if not self.balances_ledger:
+                return f"SELECT {self.db_param.ID_USER}, {self.db_param.BALANCE_ACCOUNT} " \
+                       f"FROM {self.db_param.NAME_TABLE_INFO_USER} " \
+                       f"WHERE {self.db_param.ID_USER} LIKE :id_user"
+            return self._get_sql_balances_user_ledger(sql_filter=f"users.{self.db_param.ID_USER} LIKE :id_user")
+        statement = self._get_statement(("get_balances_user", self.balances_ledger), build)
+        return self._query_data_free(statement,
+                                     params={"id_user": id_user},
+                                     table_name=self.db_param.NAME_TABLE_BALANCES_SNAPSHOT)
+
+    def snapshot_balances_user(self, t_snapshot):
+        """Materializes the account balances of all users from all transactions logged so far.
+
+        Only the transactions since the previous snapshot are summed up by the database, no rows are transferred.
+        Transactions are identified by their id_transaction, which the database numbers in the order they are logged.
+        Transactions logged after a snapshot are therefore summed up by the next one, regardless of their
+        t_update_balance. Transactions must not be logged by other connections while the snapshot is taken.
+
+        :param t_snapshot: int, unix timestamp of the snapshot
+
+        :return None:
+        """
+        statement_last = self._get_statement(
+            ("snapshot_balances_user", "last"),
+            lambda: f"SELECT COALESCE(MAX({self.db_param.ID_TRANSACTION}), 0) "
+                    f"FROM {self.db_param.NAME_TABLE_LOGS_TRANSACTIONS}")
+        statement = self._get_statement(
+            ("snapshot_balances_user",),
+            lambda: f"INSERT INTO {self.db_param.NAME_TABLE_BALANCES_SNAPSHOT} "
+                    f"({self.db_param.ID_USER}, {self.db_param.BALANCE_ACCOUNT}, {self.db_param.T_SNAPSHOT}, "
+                    f"{self.db_param.ID_TRANSACTION_LAST}) "
+                    f"SELECT users.{self.db_param.ID_USER}, {self._get_sql_balances_ledger()}, :t_snapshot, "
+                    f":id_transaction_last "
+                    f"{self._get_sql_from_balances_ledger()} "
+                    f"AND logs.{self.db_param.ID_TRANSACTION} <= :id_transaction_last "
+                    f"GROUP BY users.{self.db_param.ID_USER}, snapshots.{self.db_param.BALANCE_ACCOUNT}, "
+                    f"users.{self.db_param.BALANCE_ACCOUNT} "
+                    f"ON CONFLICT ({self.db_param.ID_USER}) DO UPDATE SET "
+                    f"{self.db_param.BALANCE_ACCOUNT} = EXCLUDED.{self.db_param.BALANCE_ACCOUNT}, "
+                    f"{self.db_param.T_SNAPSHOT} = EXCLUDED.{self.db_param.T_SNAPSHOT}, "
+                    f"{self.db_param.ID_TRANSACTION_LAST} = EXCLUDED.{self.db_param.ID_TRANSACTION_LAST}")
+        with self._begin() as conn:
+            id_transaction_last = conn.execute(statement_last).scalar()
+            conn.execute(statement, t_snapshot=int(t_snapshot), id_transaction_last=int(id_transaction_last))
+        self._invalidate_cache_metadata(self.db_param.NAME_TABLE_BALANCES_SNAPSHOT)
 
-            conn.execute(sql)
-
-        conn.close()
+    def update_balance_user(self, update_balance_df):
+        # the ledger already contains the transactions the balance updates are derived from
+        if self.balances_ledger:
+            return
+        statement = self._get_statement(
+            ("update_balance_user",),
+            lambda: f"UPDATE {self.db_param.NAME_TABLE_INFO_USER}"
+                    f" SET {self.db_param.BALANCE_ACCOUNT} = {self.db_param.BALANCE_ACCOUNT} + :delta_balance,"
+                    f" {self.db_param.T_UPDATE_BALANCE} = :t_update_balance"
+                    f" WHERE {self.db_param.ID_USER} = :id_user")
+        list_params = self._to_params(update_balance_df,
+                                      [self.db_param.DELTA_BALANCE, self.db_param.T_UPDATE_BALANCE,
+                                       self.db_param.ID_USER])
+        # all balance updates of a step are sent as one batch. account balances are not part of the cached lookups,
+        # see get_info_user(), so the cache is not invalidated
+        if list_params:
+            with self._begin() as conn:
+                conn.execute(statement, list_params)
 
     def log_transactions(self, df_tx):
         # Write results back to database
@@ -551,51 +1098,265 @@ class DatabaseConnection:
     ######################################################################
     # General functions
     def insert(self, table_name, df_insert):
-        df_insert.to_sql(name=table_name,
-                         con=self.engine,
-                         if_exists='append',
-                         index=False)
+        with self._begin() as conn:
+            df_insert.to_sql(name=table_name,
+                             con=conn,
+                             if_exists='append',
+                             index=False)
+        self._invalidate_cache_metadata(table_name)
 
     def upsert(self, table_name, df_insert):
-        sql = f"INSERT INTO {table_name}"
-        list_columns_all = self.get_table_columns(table_name)
-        sql += " ("
-        for column in list_columns_all[:-1]:
-            sql += f"{column}, "
-        sql += f"{list_columns_all[-1]}) VALUES "
-
-        for i, (index, row) in enumerate(df_insert.iterrows()):
-            sql += f"("
-            column = ""
-            for column in list_columns_all[:-1]:
-                if type(row[column]) == str:
-                    sql += f"'{row[column]}', "
-                else:
-                    sql += f"{row[column]}, "
-            if type(row[column]) == str:
-                sql += f"'{row[list_columns_all[-1]]}')"
-            else:
-                sql += f"{row[list_columns_all[-1]]})"
-
-            if i < len(df_insert)-1:
-                sql += ", "
-
-        sql += f" ON CONFLICT"
-        list_columns_pk = self.get_table_columns(table_name, pk_only=True)
-        sql += " ("
-        for column in list_columns_pk[:-1]:
-            sql += f"{column}, "
-        sql += f"{list_columns_pk[-1]}) DO UPDATE SET "
-        list_columns_not_pk = list(set(list_columns_all) - set(list_columns_pk))
-        for column in list_columns_not_pk[:-1]:
-            sql += f"{column} = EXCLUDED.{column}, "
-        sql += f"{list_columns_not_pk[-1]} = EXCLUDED.{list_columns_not_pk[-1]};"
-        self.engine.execute(sql)
+        def build():
+            list_columns_all = self.get_table_columns(table_name)
+            list_columns_pk = self.get_table_columns(table_name, pk_only=True)
+            list_columns_not_pk = [column for column in list_columns_all if column not in list_columns_pk]
+            return f"INSERT INTO {table_name} ({', '.join(list_columns_all)}) " \
+                   f"VALUES ({', '.join(':' + column for column in list_columns_all)}) " \
+                   f"ON CONFLICT ({', '.join(list_columns_pk)}) DO UPDATE SET " \
+                   f"{', '.join(f'{column} = EXCLUDED.{column}' for column in list_columns_not_pk)}"
+        statement = self._get_statement(("upsert", table_name), build)
+        list_params = self._to_params(df_insert, self.get_table_columns(table_name))
+        # all rows are sent as one batch, see db_budget.create_engine()
+        if list_params:
+            with self._begin() as conn:
+                conn.execute(statement, list_params)
+        self._invalidate_cache_metadata(table_name)
+
+    def clear_cache_metadata(self):
+        """Drops all cached metadata lookups.
+
+        The cache is invalidated automatically whenever the info tables are modified through a DatabaseConnection,
+        see refresh_cache(). This method must only be called if they were modified bypassing lemlab.
+        """
+        with self._lock_cache:
+            self._cache_metadata = {}
+            self.version_metadata = {}
+            self._generation_cache += 1
+
+    def refresh_cache(self):
+        """Drops the cached metadata lookups derived from tables modified through other connections.
+
+        Modifications through this connection drop the affected lookups right away. Modifications through other
+        connections, e.g. registrations through the admin connection, are recorded in versions_metadata and are
+        only seen after this method was called. The versions are read with a single query, so simulations call it
+        once per step for every connection instead of checking the versions on every lookup.
+
+        :return: None
+        """
+        versions = self._get_versions_metadata(self.db_param.LIST_TABLES_VERSIONED)
+        with self._lock_cache:
+            for table_name, version in versions.items():
+                if self.version_metadata.get(table_name) != version:
+                    self._drop_cache_metadata(table_name)
+            self.version_metadata.update(versions)
 
     ###################################################
     # Internal functions
-    def _query_data_free(self, sql):
-        return pd.read_sql_query(sql, self.engine)
+    def _get_sql_balances_ledger(self):
+        # last snapshot or opening balance plus all transactions logged since
+        return f"CAST(COALESCE(snapshots.{self.db_param.BALANCE_ACCOUNT}, users.{self.db_param.BALANCE_ACCOUNT}) " \
+               f"+ COALESCE(SUM(logs.{self.db_param.DELTA_BALANCE}), 0) AS BIGINT)"
+
+    def _get_sql_from_balances_ledger(self):
+        # transactions logged after the last snapshot
+        return f"FROM {self.db_param.NAME_TABLE_INFO_USER} AS users " \
+               f"LEFT JOIN {self.db_param.NAME_TABLE_BALANCES_SNAPSHOT} AS snapshots " \
+               f"ON snapshots.{self.db_param.ID_USER} = users.{self.db_param.ID_USER} " \
+               f"LEFT JOIN {self.db_param.NAME_TABLE_LOGS_TRANSACTIONS} AS logs " \
+               f"ON logs.{self.db_param.ID_USER} = users.{self.db_param.ID_USER} " \
+               f"AND logs.{self.db_param.ID_TRANSACTION} > COALESCE(snapshots.{self.db_param.ID_TRANSACTION_LAST}, 0)"
+
+    def _get_sql_balances_user_ledger(self, sql_filter=None, list_columns_users=()):
+        # current account balances of all users matching sql_filter and further columns of info_user, see
+        # get_balances_user()
+        sql_columns_users = "".join(f", users.{column}" for column in list_columns_users)
+        sql = f"SELECT users.{self.db_param.ID_USER}{sql_columns_users}, " \
+              f"{self._get_sql_balances_ledger()} AS {self.db_param.BALANCE_ACCOUNT} " \
+              f"{self._get_sql_from_balances_ledger()} "
+        if sql_filter is not None:
+            sql += f"WHERE {sql_filter} "
+        return sql + f"GROUP BY users.{self.db_param.ID_USER}{sql_columns_users}, " \
+                     f"snapshots.{self.db_param.BALANCE_ACCOUNT}, users.{self.db_param.BALANCE_ACCOUNT}"
+
+    def _get_sql_select_table(self, table_name, list_columns):
+        # exported account balances are derived from the ledger if info_user only holds the opening balances
+        if not self.balances_ledger or table_name != self.db_param.NAME_TABLE_INFO_USER:
+            return f"SELECT {', '.join(list_columns)} FROM \"{table_name}\""
+        list_select = [f"balances.{column}" if column == self.db_param.BALANCE_ACCOUNT else f"info.{column}"
+                       for column in list_columns]
+        return f"SELECT {', '.join(list_select)} FROM {table_name} AS info " \
+               f"JOIN ({self._get_sql_balances_user_ledger()}) AS balances " \
+               f"ON balances.{self.db_param.ID_USER} = info.{self.db_param.ID_USER}"
+
+    def _query_data_free(self, sql, params=None, table_name=None):
+        with self._connect() as conn:
+            if self.transfer_results == "copy" and conn.dialect.driver == "psycopg2":
+                df_result = self._query_copy(conn, sql, params=params, table_name=table_name)
+            else:
+                df_result = pd.read_sql_query(sql, conn, params=self._to_python(params))
+        if table_name is not None:
+            df_result = self._set_dtypes(df_result, table_name)
+        return df_result
+
+    def _query_copy(self, conn, sql, params=None, table_name=None):
+        # the result is streamed as csv and parsed by the C parser of pandas directly into typed columns, so no python
+        # objects are created per row. COPY does not accept bound parameters, they are rendered into the statement by
+        # the driver with the same escaping as for regular queries
+        statement = db.text(sql) if isinstance(sql, str) else sql
+        params = self._to_python(params) or {}
+        names_bind = statement.compile(dialect=conn.dialect).binds
+        statement = statement.bindparams(**{name: value for name, value in params.items() if name in names_bind})
+        compiled = statement.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+        buffer = io.StringIO()
+        with conn.connection.cursor() as cursor:
+            query = cursor.mogrify(compiled.string, compiled.params).decode()
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER, NULL '\\N')", buffer)
+        buffer.seek(0)
+        # text columns are never inferred as numbers, e.g. numeric ids. integer columns are inferred, as they are
+        # returned as floats if they contain NULL values
+        dict_dtypes = {column: str for column in self._get_columns_text()}
+        if table_name is not None and self.get_table_columns(table_name) is not None:
+            dict_dtypes.update({column: "float64"
+                                for column, dtype in zip(*self.get_table_columns(table_name, dtype=True))
+                                if dtype is float})
+        # NULL is written as \N, so empty strings remain empty strings instead of being read as NaN
+        return pd.read_csv(buffer, dtype=dict_dtypes, keep_default_na=False, na_values=["\\N"])
+
+    def _get_columns_text(self):
+        # names of all text columns, column names have the same type in all tables
+        key = ("columns_text",)
+        with self._lock_cache:
+            if key not in self._cache_table_columns:
+                self._cache_table_columns[key] = {column.name for table in self.list_tables
+                                                  for column in table.list_columns
+                                                  if column.dtype.python_type is str}
+            return self._cache_table_columns[key]
+
+    @contextmanager
+    def _begin(self):
+        # writes join the unit of work of the current thread, otherwise they are committed on their own
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            yield connection
+            return
+        with self.engine.begin() as connection:
+            yield connection
+
+    @contextmanager
+    def _connect(self):
+        # reads within a unit of work must use its connection to see its uncommitted writes
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            yield connection
+            return
+        with self.engine.connect() as connection:
+            yield connection
+
+    def _get_statement(self, key, build, list_expanding=None):
+        # statements are built once per connection and reused with different bound parameters. The identical
+        # statement text lets SQLAlchemy reuse its compiled form and keeps values out of the SQL string
+        with self._lock_cache:
+            if key not in self._statements:
+                statement = db.text(build())
+                if list_expanding:
+                    statement = statement.bindparams(*[db.bindparam(name, expanding=True)
+                                                       for name in list_expanding])
+                self._statements[key] = statement
+            return self._statements[key]
+
+    def _set_dtypes(self, df_result, table_name):
+        # result dtypes follow the table definition instead of being inferred from the returned values, so empty
+        # results have the same dtypes as filled ones. integer columns containing NULL values are returned as floats
+        if self.get_table_columns(table_name) is None:
+            return df_result
+        list_columns, list_dtypes = self.get_table_columns(table_name, dtype=True)
+        dict_dtypes = {}
+        for column, dtype in zip(list_columns, list_dtypes):
+            if column not in df_result.columns:
+                continue
+            if dtype is int and df_result[column].isna().any():
+                dtype = float
+            dict_dtypes[column] = {int: "int64", float: "float64", str: "object"}[dtype]
+        return df_result.astype(dict_dtypes)
+
+    @staticmethod
+    def _to_python(params):
+        # numpy scalars, e.g. delivery periods taken from DataFrames, cannot be adapted by the database driver
+        if params is None:
+            return None
+        return {key: value.item() if isinstance(value, np.generic) else value for key, value in params.items()}
+
+    @staticmethod
+    def _to_params(df_in, list_columns):
+        # convert rows to parameter dicts of python types, missing values become NULL
+        df_in = df_in.loc[:, list_columns].astype(object)
+        return df_in.where(pd.notna(df_in), None).to_dict("records")
+
+    def _update_row(self, table_name, column_key, df_row):
+        list_columns_all = self.get_table_columns(table_name=table_name)
+        list_columns_pk = self.get_table_columns(table_name=table_name, pk_only=True)
+        list_columns_not_pk = [column for column in list_columns_all if column not in list_columns_pk]
+        statement = self._get_statement(
+            ("update_row", table_name),
+            lambda: f"UPDATE {table_name} SET "
+                    f"{', '.join(f'{column} = :{column}' for column in list_columns_not_pk)} "
+                    f"WHERE {column_key} = :{column_key}")
+        with self._begin() as conn:
+            conn.execute(statement, self._to_params(df_row.iloc[[0]], list_columns_not_pk + [column_key])[0])
+        self._invalidate_cache_metadata(table_name)
+
+    def _get_cached(self, key, list_tables, func):
+        # the lookup is made without holding the lock, concurrent threads may both derive the same entry. entries
+        # derived while entries were dropped may be outdated and are not stored.
+        # return a copy of the cached result, so callers may modify the returned object
+        with self._lock_cache:
+            entry = self._cache_metadata.get(key)
+            generation = self._generation_cache
+        if entry is None:
+            entry = (list_tables, func())
+            with self._lock_cache:
+                if self._generation_cache == generation:
+                    self._cache_metadata[key] = entry
+        return entry[1].copy()
+
+    def _invalidate_cache_metadata(self, table_name):
+        # modifications of versioned tables are recorded for other connections after they were written, see
+        # refresh_cache()
+        if table_name in self.db_param.LIST_TABLES_VERSIONED:
+            self._set_version_metadata(table_name)
+        with self._lock_cache:
+            self._drop_cache_metadata(table_name)
+
+    def _drop_cache_metadata(self, table_name):
+        # must be called while holding the lock
+        for key in [key for key, (list_tables, _) in self._cache_metadata.items() if table_name in list_tables]:
+            del self._cache_metadata[key]
+        self._generation_cache += 1
+
+    def _get_versions_metadata(self, list_tables):
+        statement = self._get_statement(
+            ("get_versions_metadata",),
+            lambda: f"SELECT {self.db_param.NAME_TABLE}, {self.db_param.VERSION} "
+                    f"FROM {self.db_param.NAME_TABLE_VERSIONS_METADATA} "
+                    f"WHERE {self.db_param.NAME_TABLE} IN :list_tables",
+            list_expanding=["list_tables"])
+        with self._connect() as conn:
+            dict_versions = dict(conn.execute(statement, list_tables=list(list_tables)).fetchall())
+        return {table_name: dict_versions.get(table_name, 0) for table_name in list_tables}
+
+    def _set_version_metadata(self, table_name):
+        # versions are unique instead of counted, so they are never repeated after the table was cleared
+        statement = self._get_statement(
+            ("set_version_metadata",),
+            lambda: f"INSERT INTO {self.db_param.NAME_TABLE_VERSIONS_METADATA} "
+                    f"({self.db_param.NAME_TABLE}, {self.db_param.VERSION}) VALUES (:name_table, :version) "
+                    f"ON CONFLICT ({self.db_param.NAME_TABLE}) DO UPDATE SET "
+                    f"{self.db_param.VERSION} = EXCLUDED.{self.db_param.VERSION}")
+        version = time.time_ns()
+        with self._begin() as conn:
+            conn.execute(statement, name_table=table_name, version=version)
+        with self._lock_cache:
+            self.version_metadata[table_name] = version
 
     def _init_table(self, table, clear_table=False, reformat_table=False):
         try:
@@ -624,22 +1385,78 @@ class DatabaseConnection:
 
     def _create_table(self, lemlab_table):
         metadata = db.MetaData(self.engine)
-        sql_table = db.Table(lemlab_table.name, metadata)
+        if self._is_partitioned(lemlab_table):
+            sql_table = db.Table(lemlab_table.name, metadata,
+                                 postgresql_partition_by=f"RANGE ({lemlab_table.column_partition})")
+        else:
+            sql_table = db.Table(lemlab_table.name, metadata)
         for column in lemlab_table.list_columns:
-            sql_table.append_column(db.Column(column.name, column.dtype, primary_key=column.pk))
+            if column.serial and self.engine.dialect.supports_sequences:
+                sequence = db.Sequence(f"{lemlab_table.name}_{column.name}_seq", metadata=metadata)
+                sql_table.append_column(db.Column(column.name, column.dtype, sequence,
+                                                  server_default=sequence.next_value(), index=column.index))
+                continue
+            sql_table.append_column(db.Column(column.name, column.dtype, primary_key=column.pk, index=column.index))
         metadata.create_all()
+        if self._is_partitioned(lemlab_table):
+            # rows outside of all partitions created so far are stored in the default partition
+            self.engine.execute(f"CREATE TABLE IF NOT EXISTS \"{lemlab_table.name}_default\" "
+                                f"PARTITION OF \"{lemlab_table.name}\" DEFAULT")
+            self._dict_partitions[lemlab_table.name] = set()
+
+    def _is_partitioned(self, lemlab_table):
+        return self.lem_config.get("partition_tables", False) and lemlab_table.column_partition is not None
+
+    def create_partitions(self, ts_delivery_first, ts_delivery_last):
+        """Creates the partitions of all partitioned tables covering ts_delivery_first to ts_delivery_last.
+
+        Partitions are created once per partition_interval of the lem config. Partitions already created through
+        this connection are skipped without querying the database, so the method may be called every step. A warning
+        is issued for every partition that could not be created.
+
+        :param ts_delivery_first: int, first delivery period to be covered
+        :param ts_delivery_last: int, last delivery period to be covered
+
+        :return None:
+        """
+        if not self.lem_config.get("partition_tables", False):
+            return
+        interval = self.lem_config.get("partition_interval", 86400)
+        for table in self.list_tables:
+            if not self._is_partitioned(table):
+                continue
+            set_partitions = self._dict_partitions.setdefault(table.name, set())
+            for ts_first in range(int(ts_delivery_first - ts_delivery_first % interval), int(ts_delivery_last) + 1,
+                                  interval):
+                if ts_first in set_partitions:
+                    continue
+                try:
+                    self.engine.execute(f"CREATE TABLE IF NOT EXISTS \"{table.name}_{ts_first}\" "
+                                        f"PARTITION OF \"{table.name}\" "
+                                        f"FOR VALUES FROM ({ts_first}) TO ({ts_first + interval})")
+                # fails if the default partition already holds rows of this range, these remain in the default.
+                # failed partitions are not recorded, so their creation is attempted again with the next call
+                except (Exception, db.exc.DatabaseError) as error:
+                    warnings.warn(f"Partition {table.name}_{ts_first} could not be created, its rows are stored in "
+                                  f"the default partition: {error}")
+                    continue
+                set_partitions.add(ts_first)
 
     def _clear_table(self, table_name):
         try:
             self.engine.execute(f"DELETE FROM \"{table_name}\"")
         except (Exception, db.exc.DatabaseError) as error:
             print("Error: ", error)
+        self._invalidate_cache_metadata(table_name)
 
     def _drop_table(self, table_name):
         try:
-            self.engine.execute("DROP TABLE " + table_name)
+            # partitions are dropped together with their partitioned table
+            self.engine.execute(f"DROP TABLE IF EXISTS \"{table_name}\"")
         except (Exception, db.exc.DatabaseError) as error:
             print("Error: ", error)
+        self._dict_partitions.pop(table_name, None)
+        self._invalidate_cache_metadata(table_name)
 
     def _dynamize_tables_results_markets(self, market_type):
         if market_type == "ex_ante":
@@ -723,6 +1540,8 @@ class DatabaseConnection:
         for i, table in enumerate(self.list_tables):
             if table.name == table_name:
                 self.list_tables[i].list_columns.append(_column)
+        with self._lock_cache:
+            self._cache_table_columns = {}
 
     def _dynamize_table_logs_transactions(self):
         table_name_base = self.db_param.NAME_TABLE_LOGS_TRANSACTIONS
@@ -740,7 +1559,16 @@ class DatabaseConnection:
                     db.BigInteger()))
 
     def get_table_columns(self, table_name, pk_only=False, dtype=False):
-        self.db_param.table_columns = {}
+        key = (table_name, pk_only, dtype)
+        with self._lock_cache:
+            if key not in self._cache_table_columns:
+                self._cache_table_columns[key] = self._get_table_columns(table_name, pk_only=pk_only, dtype=dtype)
+            table_columns = self._cache_table_columns[key]
+        if dtype:
+            return table_columns[0][:], table_columns[1][:]
+        return table_columns[:] if table_columns is not None else None
+
+    def _get_table_columns(self, table_name, pk_only=False, dtype=False):
         for table in self.list_tables:
             if table.name == table_name:
                 _list_columns = []
@@ -755,11 +1583,85 @@ class DatabaseConnection:
                     return _list_columns, _list_dtype
                 return _list_columns
 
-    def save_all_tables(self, path):
+    def save_all_tables(self, path, file_format="csv", size_chunk=100000, incremental=False):
+        if file_format == "parquet":
+            self._save_all_tables_parquet(path=path, size_chunk=size_chunk, incremental=incremental)
+            return
         for table in self.list_tables:
-            df_table_contents = self._query_data_free(f"SELECT * FROM \"{table.name}\"")
+            df_table_contents = self._query_data_free(
+                self._get_sql_select_table(table.name, self.get_table_columns(table.name)))
             df_table_contents.to_csv(path + f"/{table.name}.csv")
 
+    def _save_all_tables_parquet(self, path, size_chunk=100000, incremental=False):
+        # tables are streamed in chunks through a server-side cursor and written as one compressed row group per chunk
+        # tables with an increment column are saved as directories of parquet files. In incremental mode only rows
+        # added since the last snapshot are appended as a new file, all other tables are always saved completely
+        path_state = f"{path}/state_snapshot.json"
+        dict_state = {}
+        if incremental and os.path.exists(path_state):
+            with open(path_state, "r") as read_file:
+                dict_state = json.load(read_file)
+
+        for table in self.list_tables:
+            schema = pa.schema([(column.name, self._to_type_arrow(column.dtype)) for column in table.list_columns])
+            sql = self._get_sql_select_table(table.name, schema.names)
+            list_chunks_first = []
+            if table.column_increment is None:
+                path_file = f"{path}/{table.name}.parquet"
+            else:
+                path_table = f"{path}/{table.name}"
+                if not incremental or table.name not in dict_state:
+                    shutil.rmtree(path_table, ignore_errors=True)
+                    dict_state.pop(table.name, None)
+                os.makedirs(path_table, exist_ok=True)
+                if table.name in dict_state:
+                    # rows may be added later with the last exported increment value, e.g. transactions logged with
+                    # the same t_update_balance. these rows are read again and only those not yet exported are kept
+                    value_last = int(dict_state[table.name])
+                    df_last = self._query_data_free(f"{sql} WHERE {table.column_increment} = {value_last}")
+                    df_exported = pd.read_parquet(path_table, filters=[(table.column_increment, "==", value_last)])
+                    list_chunks_first.append(self._subtract_rows(df_last, df_exported, schema))
+                    sql += f" WHERE {table.column_increment} > {value_last}"
+                path_file = f"{path_table}/{len(os.listdir(path_table)):05d}.parquet"
+
+            writer = None
+            with self.engine.connect() as conn:
+                conn = conn.execution_options(stream_results=True)
+                for df_chunk in itertools.chain(list_chunks_first,
+                                                pd.read_sql_query(sql, conn, chunksize=size_chunk)):
+                    if not len(df_chunk):
+                        continue
+                    if writer is None:
+                        writer = pq.ParquetWriter(path_file, schema, compression="zstd")
+                    writer.write_table(pa.Table.from_pandas(df_chunk, schema=schema, preserve_index=False))
+                    if table.column_increment is not None:
+                        dict_state[table.name] = max(int(df_chunk[table.column_increment].max()),
+                                                     dict_state.get(table.name, 0))
+            if writer is not None:
+                writer.close()
+            elif table.column_increment is None or not os.listdir(path_table):
+                # empty tables are saved as well, so every table of the snapshot can be read
+                pq.write_table(schema.empty_table(), path_file, compression="zstd")
+
+        with open(path_state, "w+") as write_file:
+            json.dump(dict_state, write_file)
+
+    @staticmethod
+    def _subtract_rows(df_rows, df_exported, schema):
+        # returns the rows of df_rows not contained in df_exported. identical rows are numbered, so a row contained
+        # n times in df_exported is removed n times. both are converted to the snapshot schema to compare equal dtypes
+        df_rows, df_exported = [pa.Table.from_pandas(df, schema=schema, preserve_index=False).to_pandas()
+                                for df in (df_rows, df_exported)]
+        list_columns = list(schema.names)
+        df_rows["n_row"] = df_rows.groupby(list_columns, dropna=False).cumcount()
+        df_exported["n_row"] = df_exported.groupby(list_columns, dropna=False).cumcount()
+        df_rows = df_rows.merge(df_exported, on=list_columns + ["n_row"], how="left", indicator=True)
+        return df_rows[df_rows["_merge"] == "left_only"][list_columns]
+
+    @staticmethod
+    def _to_type_arrow(dtype):
+        return {int: pa.int64(), float: pa.float64(), str: pa.string(), bool: pa.bool_()}[dtype.python_type]
+
     def _dynamize_db_param(self):
         # customize database formatting here
         # create market_results tables for every requested market result type
@@ -0,0 +1,110 @@
+__author__ = "sdlumpp"
+__credits__ = []
+__license__ = ""
+__maintainer__ = "sdlumpp"
+__email__ = "sebastian.lumpp@tum.de"
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabaseConnection:
+    """asyncio variant of the DatabaseConnection API.
+
+    Every public method of the wrapped DatabaseConnection is available as a coroutine with identical arguments, e.g.
+    await db_async.post_positions(df_bids). The blocking calls are executed by a thread pool, so the database I/O of
+    many agents can be in flight at the same time, limited by max_concurrency. The pool should not be larger than the
+    connection pool of the wrapped DatabaseConnection, otherwise calls queue for connections instead of threads.
+
+    Blocking agent code that uses the wrapped DatabaseConnection itself, e.g. Prosumer.pre_clearing_activity(), can be
+    awaited with run_sync().
+    """
+
+    def __init__(self, db_conn, max_concurrency=10):
+        self.db_conn = db_conn
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.db_conn, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def method_async(*args, **kwargs):
+            return await self.run_sync(attribute, *args, **kwargs)
+        return method_async
+
+    async def run_sync(self, func, *args, **kwargs):
+        """Executes a blocking function in the thread pool and returns its result.
+
+        :param func: callable to be executed
+        :param args: positional arguments of func
+        :param kwargs: keyword arguments of func
+
+        :return: return value of func
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def gather(self, list_calls):
+        """Executes several blocking calls concurrently.
+
+        :param list_calls: list of tuples (func, kwargs)
+
+        :return: list of return values in the order of list_calls
+        """
+        return await asyncio.gather(*[self.run_sync(func, **kwargs) for func, kwargs in list_calls])
+
+    def end_connection(self):
+        self.executor.shutdown(wait=True)
+        self.db_conn.end_connection()
+
+
+class _DatabaseConnectionLatency:
+    """Stand-in for DatabaseConnection that only waits for a fixed round trip latency. Used for benchmarking."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def post_positions(self, df_bids, t_override=None):
+        time.sleep(self.latency)
+
+    def log_meter_readings_cumulative(self, df_readings_meter):
+        time.sleep(self.latency)
+
+    def get_results_market_ex_ante(self, **kwargs):
+        time.sleep(self.latency)
+        return None, None
+
+    def end_connection(self):
+        pass
+
+
+def _step_agent(db_obj):
+    # database calls of one agent in one real-time step
+    db_obj.log_meter_readings_cumulative(None)
+    db_obj.get_results_market_ex_ante(id_user="agent")
+    db_obj.post_positions(None)
+
+
+if __name__ == "__main__":
+    # compare the throughput of the synchronous and the asynchronous path for a real-time step of many agents
+    n_agents = 200
+    latency = 0.005
+    db_obj_latency = _DatabaseConnectionLatency(latency=latency)
+
+    t_start = time.perf_counter()
+    for _ in range(n_agents):
+        _step_agent(db_obj_latency)
+    t_sync = time.perf_counter() - t_start
+
+    for max_concurrency in [1, 4, 10, 32]:
+        db_async = AsyncDatabaseConnection(db_obj_latency, max_concurrency=max_concurrency)
+        t_start = time.perf_counter()
+        asyncio.run(db_async.gather([(_step_agent, {"db_obj": db_obj_latency})] * n_agents))
+        t_async = time.perf_counter() - t_start
+        db_async.end_connection()
+        print(f"{n_agents} agents, {latency * 1000:.0f} ms latency, {max_concurrency} concurrent: "
+              f"sync {n_agents / t_sync:.1f} agents/s, async {n_agents / t_async:.1f} agents/s")
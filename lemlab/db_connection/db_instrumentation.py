@@ -0,0 +1,161 @@
+__author__ = "sdlumpp"
+__credits__ = []
+__license__ = ""
+__maintainer__ = "sdlumpp"
+__email__ = "sebastian.lumpp@tum.de"
+
+import sys
+import json
+import time
+import functools
+import threading
+import numpy as np
+import pandas as pd
+
+
+class QueryInstrumentation:
+    """Records per-method query metrics of a DatabaseConnection.
+
+    The public methods of the DatabaseConnection instance are replaced by wrappers that record, per calling module
+    (e.g. settlement, clearing_ex_ante, prosumer) and method, the number of calls, the rows and bytes of the DataFrames
+    read and written and the latency of every call. Calls of public methods from within other public methods are
+    attributed to the outer call only. The instance keeps working as before, so it can be handed to agents and
+    market functions unchanged.
+
+    Metrics are collected until pop_metrics() is called, usually once per simulation step.
+    """
+
+    list_methods_excluded = ["end_connection", "get_stats_pool", "unit_of_work", "savepoint"]
+
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        for name_method in dir(type(db_conn)):
+            if name_method.startswith("_") or name_method in self.list_methods_excluded:
+                continue
+            method = getattr(db_conn, name_method)
+            if callable(method):
+                setattr(db_conn, name_method, self._wrap(name_method, method))
+
+    def pop_metrics(self):
+        """Returns the metrics recorded since the last call and resets them.
+
+        :return: dict, raw metrics by (module, method), input for merge_metrics() and log_metrics()
+        """
+        with self._lock:
+            metrics, self.metrics = self.metrics, {}
+        return metrics
+
+    def _wrap(self, name_method, method):
+        @functools.wraps(method)
+        def method_instrumented(*args, **kwargs):
+            # nested calls of public methods are part of the outer call
+            if getattr(self._local, "active", False):
+                return method(*args, **kwargs)
+            name_module = _get_name_module_calling(sys._getframe(1))
+            self._local.active = True
+            try:
+                t_start = time.perf_counter()
+                result = method(*args, **kwargs)
+                t_query = time.perf_counter() - t_start
+            finally:
+                self._local.active = False
+            rows_read, bytes_read = _get_size(result)
+            rows_written, bytes_written = _get_size(list(args) + list(kwargs.values()))
+            with self._lock:
+                metrics_method = self.metrics.setdefault((name_module, name_method), _init_metrics())
+                metrics_method["count"] += 1
+                metrics_method["rows_read"] += rows_read
+                metrics_method["rows_written"] += rows_written
+                metrics_method["bytes_read"] += bytes_read
+                metrics_method["bytes_written"] += bytes_written
+                metrics_method["t_query"].append(t_query)
+            return result
+        return method_instrumented
+
+
+def merge_metrics(list_metrics):
+    """Combines the raw metrics of several QueryInstrumentation instances, e.g. of the parallel workers.
+
+    :param list_metrics: list of dicts returned by QueryInstrumentation.pop_metrics()
+
+    :return: dict, combined raw metrics
+    """
+    metrics_merged = {}
+    for metrics in list_metrics:
+        for key, metrics_method in metrics.items():
+            metrics_method_merged = metrics_merged.setdefault(key, _init_metrics())
+            for name, value in metrics_method.items():
+                metrics_method_merged[name] += value
+    return metrics_merged
+
+
+def summarize_metrics(metrics):
+    """Condenses raw metrics into one record per module and method, sorted by total latency.
+
+    :param metrics: dict, raw metrics
+
+    :return: list of dicts with the keys module, method, count, rows_read, rows_written, bytes_read, bytes_written,
+             t_total, t_p50, t_p95 and t_p99, all times in seconds
+    """
+    list_records = []
+    for (name_module, name_method), metrics_method in metrics.items():
+        t_p50, t_p95, t_p99 = np.percentile(metrics_method["t_query"], [50, 95, 99])
+        list_records.append({"module": name_module,
+                             "method": name_method,
+                             "count": metrics_method["count"],
+                             "rows_read": metrics_method["rows_read"],
+                             "rows_written": metrics_method["rows_written"],
+                             "bytes_read": metrics_method["bytes_read"],
+                             "bytes_written": metrics_method["bytes_written"],
+                             "t_total": float(sum(metrics_method["t_query"])),
+                             "t_p50": float(t_p50),
+                             "t_p95": float(t_p95),
+                             "t_p99": float(t_p99)})
+    return sorted(list_records, key=lambda record: record["t_total"], reverse=True)
+
+
+def log_metrics(path, dict_metrics, **info):
+    """Appends metrics to a JSON lines file, one line per connection, module and method.
+
+    The file can be read with pandas.read_json(path, lines=True).
+
+    :param path: str, path of the JSON lines file
+    :param dict_metrics: dict, raw metrics by connection name
+    :param info: additional fields of every line, e.g. step and ts_delivery
+
+    :return: None
+    """
+    with open(path, "a") as write_file:
+        for name_connection, metrics in dict_metrics.items():
+            for record in summarize_metrics(metrics):
+                write_file.write(json.dumps({**info, "connection": name_connection, **record}) + "\n")
+
+
+def _init_metrics():
+    return {"count": 0, "rows_read": 0, "rows_written": 0, "bytes_read": 0, "bytes_written": 0, "t_query": []}
+
+
+def _get_name_module_calling(frame):
+    # the first lemlab module outside of the database package is the caller, e.g. lemlab.lem.settlement
+    while frame is not None:
+        name_module = frame.f_globals.get("__name__", "")
+        if name_module.startswith("lemlab.") and not name_module.startswith("lemlab.db_connection"):
+            return name_module.rsplit(".", 1)[-1]
+        frame = frame.f_back
+    return "other"
+
+
+def _get_size(obj):
+    # number of rows and bytes of a DataFrame or Series, or of those contained in a list or tuple
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj), int(np.sum(obj.memory_usage(index=True, deep=True)))
+    rows, size = 0, 0
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            if isinstance(item, (pd.DataFrame, pd.Series)):
+                rows += len(item)
+                size += int(np.sum(item.memory_usage(index=True, deep=True)))
+    return rows, size
@@ -13,11 +13,14 @@ NAME_TABLE_INFO_USER = "info_user"
 NAME_TABLE_INFO_METER = "info_meter"
 NAME_TABLE_POSITIONS_MARKET_EX_ANTE = "positions_market_ex_ante"
 NAME_TABLE_POSITIONS_MARKET_EX_ANTE_ARCHIVE = "positions_market_ex_ante_archive"
+NAME_TABLE_POSITIONS_MARKET_EX_ANTE_SUMMARY = "positions_market_ex_ante_summary"
 NAME_TABLE_STATUS_SETTLEMENT = "status_settlement"
 NAME_TABLE_READINGS_METER_CUMULATIVE = "readings_meter_cumulative"
 NAME_TABLE_READINGS_METER_DELTA = "readings_meter_delta"
 NAME_TABLE_ENERGY_BALANCING = "energy_balancing"
 NAME_TABLE_PRICES_SETTLEMENT = "prices_settlement"
+NAME_TABLE_BALANCES_SNAPSHOT = "balances_snapshot"
+NAME_TABLE_VERSIONS_METADATA = "versions_metadata"
 
 # names of tables that will be dynamically generated
 NAME_TABLE_RESULTS_MARKET_EX_ANTE_ = "results_market_ex_ante_"
@@ -26,6 +29,9 @@ NAME_TABLE_LOGS_TRANSACTIONS = "logs_transactions"
 
 NAME_ACCOUNT_USER = "market_participant"
 
+# tables whose lookups are cached by DatabaseConnection, every modification is recorded in versions_metadata
+LIST_TABLES_VERSIONED = [NAME_TABLE_INFO_USER, NAME_TABLE_INFO_METER]
+
 # Column names (sorted alphabetically)
 BALANCE_ACCOUNT = 'balance_account'
 DELTA_BALANCE = 'delta_balance'
@@ -47,11 +53,15 @@ ID_METER = 'id_meter'
 ID_METER_SUPER = 'id_meter_super'
 ID_OFFER = 'id_offer'
 ID_SOURCE = 'id_source'
+ID_TRANSACTION = 'id_transaction'
+ID_TRANSACTION_LAST = 'id_transaction_last'
 ID_USER = 'id_user'
 ID_USER_BID = 'id_user_bid'
 ID_USER_OFFER = 'id_user_offer'
 INFO_ADDITIONAL = 'info_additional'
+NAME_TABLE = 'name_table'
 NUMBER_POSITION = 'number_position'
+NUMBER_POSITIONS = 'number_positions'
 NUMBER_POSITION_BID = 'number_position_bid'
 NUMBER_POSITION_OFFER = 'number_position_offer'
 PREFERENCE_QUALITY = 'preference_quality'
@@ -65,6 +75,9 @@ PRICE_ENERGY_BID_MIN = 'price_energy_bid_min'
 PRICE_ENERGY_LEVIES_NEGATIVE = "price_energy_levies_negative"
 PRICE_ENERGY_LEVIES_POSITIVE = "price_energy_levies_positive"
 PRICE_ENERGY_MARKET = 'price_energy_market'
+PRICE_ENERGY_MAX = 'price_energy_max'
+PRICE_ENERGY_MEAN = 'price_energy_mean'
+PRICE_ENERGY_MIN = 'price_energy_min'
 PRICE_ENERGY_OFFER = 'price_energy_offer'
 PRICE_ENERGY_OFFER_MAX = 'price_energy_offer_max'
 PRICE_ENERGY_OFFER_MIN = 'price_energy_offer_min'
@@ -89,8 +102,12 @@ TYPE_POSITION = 'type_position'
 TYPE_TRANSACTION = 'type_transaction'
 T_CLEARED = 't_cleared'
 T_READING = 't_reading'
+T_SNAPSHOT = 't_snapshot'
 T_SUBMISSION = 't_submission'
+T_SUBMISSION_FIRST = 't_submission_first'
+T_SUBMISSION_LAST = 't_submission_last'
 T_UPDATE_BALANCE = 't_update_balance'
+VERSION = 'version'
 
 # Column base names to be dynamically added
 PRICE_ENERGY_MARKET_ = PRICE_ENERGY_MARKET + '_'
@@ -112,6 +129,9 @@ class LemlabColumn:
     name: str = ""
     dtype: BigInteger = 0
     pk: bool = False
+    index: bool = False
+    # numbered by the database from a sequence in the order the rows are inserted, if the database supports sequences
+    serial: bool = False
 
 
 @dataclasses.dataclass
@@ -121,6 +141,10 @@ class LemlabTable:
     list_columns: list = field(default_factory=list)
     user_accounts: str = ""
     list_rights: list = None
+    # column identifying rows added since the last incremental database snapshot, None if not incremental
+    column_increment: str = None
+    # column by which the table is range-partitioned if partitioning is activated, None if never partitioned
+    column_partition: str = None
 
     def replace(self):
         output = LemlabTable()
@@ -128,6 +152,8 @@ class LemlabTable:
         output.list_columns = self.list_columns[:]
         output.user_accounts = self.user_accounts
         output.list_rights = self.list_rights
+        output.column_increment = self.column_increment
+        output.column_partition = self.column_partition
         return output
 
 
@@ -189,9 +215,29 @@ table_positions_archive.list_columns = [LemlabColumn(ID_USER, Text()),
                                         LemlabColumn(NUMBER_POSITION, BigInteger()),
                                         LemlabColumn(STATUS_POSITION, BigInteger()),
                                         LemlabColumn(T_SUBMISSION, BigInteger()),
-                                        LemlabColumn(TS_DELIVERY, BigInteger())]
+                                        LemlabColumn(TS_DELIVERY, BigInteger(), index=True)]
 table_positions_archive.user_accounts = NAME_ACCOUNT_USER
 table_positions_archive.list_rights = ["SELECT", "INSERT", "UPDATE", "DELETE"]
+table_positions_archive.column_increment = T_SUBMISSION
+table_positions_archive.column_partition = TS_DELIVERY
+
+
+# archived positions older than the retention period are compacted into one row per delivery period,
+# position type and energy quality
+table_positions_summary = LemlabTable()
+table_positions_summary.name = NAME_TABLE_POSITIONS_MARKET_EX_ANTE_SUMMARY
+table_positions_summary.list_columns = [LemlabColumn(TS_DELIVERY, BigInteger(), True),
+                                        LemlabColumn(TYPE_POSITION, Text(), True),
+                                        LemlabColumn(QUALITY_ENERGY, Text(), True),
+                                        LemlabColumn(NUMBER_POSITIONS, BigInteger()),
+                                        LemlabColumn(QTY_ENERGY, BigInteger()),
+                                        LemlabColumn(PRICE_ENERGY_MIN, BigInteger()),
+                                        LemlabColumn(PRICE_ENERGY_MAX, BigInteger()),
+                                        LemlabColumn(PRICE_ENERGY_MEAN, BigInteger()),
+                                        LemlabColumn(T_SUBMISSION_FIRST, BigInteger()),
+                                        LemlabColumn(T_SUBMISSION_LAST, BigInteger())]
+table_positions_summary.user_accounts = NAME_ACCOUNT_USER
+table_positions_summary.list_rights = ["SELECT"]
 
 
 table_status_settlement = LemlabTable()
@@ -210,6 +256,8 @@ table_readings_meter_cumulative.list_columns = [LemlabColumn(T_READING, BigInteg
                                                 LemlabColumn(ENERGY_OUT_CUM, BigInteger())]
 table_readings_meter_cumulative.user_accounts = NAME_ACCOUNT_USER
 table_readings_meter_cumulative.list_rights = ["SELECT", "INSERT", "UPDATE"]
+table_readings_meter_cumulative.column_increment = T_READING
+table_readings_meter_cumulative.column_partition = T_READING
 
 table_readings_meter_delta = LemlabTable()
 table_readings_meter_delta.name = NAME_TABLE_READINGS_METER_DELTA
@@ -219,6 +267,7 @@ table_readings_meter_delta.list_columns = [LemlabColumn(TS_DELIVERY, BigInteger(
                                            LemlabColumn(ENERGY_OUT, BigInteger())]
 table_readings_meter_delta.user_accounts = NAME_ACCOUNT_USER
 table_readings_meter_delta.list_rights = ["SELECT"]
+table_readings_meter_delta.column_partition = TS_DELIVERY
 
 table_energy_balancing = LemlabTable()
 table_energy_balancing.name = NAME_TABLE_ENERGY_BALANCING
@@ -239,6 +288,26 @@ table_prices_settlement.list_columns = [LemlabColumn(TS_DELIVERY, BigInteger(),
 table_prices_settlement.user_accounts = NAME_ACCOUNT_USER
 table_prices_settlement.list_rights = ["SELECT"]
 
+# account balances of all transactions logged up to id_transaction_last, taken at t_snapshot. only used if balances
+# are derived from the transaction logs, see DatabaseConnection.get_balances_user()
+table_balances_snapshot = LemlabTable()
+table_balances_snapshot.name = NAME_TABLE_BALANCES_SNAPSHOT
+table_balances_snapshot.list_columns = [LemlabColumn(ID_USER, Text(), True),
+                                        LemlabColumn(BALANCE_ACCOUNT, BigInteger()),
+                                        LemlabColumn(T_SNAPSHOT, BigInteger()),
+                                        LemlabColumn(ID_TRANSACTION_LAST, BigInteger())]
+table_balances_snapshot.user_accounts = NAME_ACCOUNT_USER
+table_balances_snapshot.list_rights = ["SELECT"]
+
+# version of the contents of every table in LIST_TABLES_VERSIONED, changed with every modification of the table.
+# cached lookups of all connections are refreshed if the version differs from the one they were derived from
+table_versions_metadata = LemlabTable()
+table_versions_metadata.name = NAME_TABLE_VERSIONS_METADATA
+table_versions_metadata.list_columns = [LemlabColumn(NAME_TABLE, Text(), True),
+                                        LemlabColumn(VERSION, BigInteger())]
+table_versions_metadata.user_accounts = NAME_ACCOUNT_USER
+table_versions_metadata.list_rights = ["SELECT"]
+
 # further columns are generated dynamically in db_connection
 # additional columns: clearing prices and shares of energy qualities
 
@@ -255,6 +324,8 @@ table_results_market_ex_ante_base.list_columns = [LemlabColumn(ID_USER_OFFER, Te
                                                   LemlabColumn(TS_DELIVERY, BigInteger(), True)]
 table_results_market_ex_ante_base.user_accounts = NAME_ACCOUNT_USER
 table_results_market_ex_ante_base.list_rights = ["SELECT"]
+table_results_market_ex_ante_base.column_increment = T_CLEARED
+table_results_market_ex_ante_base.column_partition = TS_DELIVERY
 
 table_results_market_ex_post_base = LemlabTable()
 table_results_market_ex_post_base.name = NAME_TABLE_RESULTS_MARKET_EX_POST_
@@ -270,19 +341,25 @@ table_logs_transactions_base.list_columns = [LemlabColumn(ID_USER, Text()),
                                              LemlabColumn(TYPE_TRANSACTION, Text()),
                                              LemlabColumn(QTY_ENERGY, BigInteger()),
                                              LemlabColumn(DELTA_BALANCE, BigInteger()),
-                                             LemlabColumn(T_UPDATE_BALANCE, BigInteger())]
+                                             LemlabColumn(T_UPDATE_BALANCE, BigInteger(), index=True),
+                                             LemlabColumn(ID_TRANSACTION, BigInteger(), index=True, serial=True)]
 table_logs_transactions_base.user_accounts = NAME_ACCOUNT_USER
 table_logs_transactions_base.list_rights = ["SELECT"]
+table_logs_transactions_base.column_increment = T_UPDATE_BALANCE
+table_logs_transactions_base.column_partition = TS_DELIVERY
 
 # list of tables to be extended by DatabaseConnection instance containing
 # LemlabTable objects describing the tables contained in the database
 
-LIST_TABLES = [table_info_user,
+LIST_TABLES = [table_versions_metadata,
+               table_info_user,
                table_info_meter,
                table_positions_market,
                table_positions_archive,
+               table_positions_summary,
                table_readings_meter_cumulative,
                table_readings_meter_delta,
                table_status_settlement,
                table_energy_balancing,
-               table_prices_settlement]
+               table_prices_settlement,
+               table_balances_snapshot]
@@ -54,8 +54,11 @@ def market_clearing(db_obj,
     n_clearings = int(config_lem['horizon_clearing'] / config_lem['interval_clearing'])
 
     # Read offers and bids from db
+    # optionally, the database aggregates identical positions and returns the book in clearing order
+    aggregate = config_lem.get('positions_aggregate_db', False)
     bids, offers = db_obj.get_open_positions(clear_table=config_lem['positions_delete'],
-                                             archive=config_lem['positions_archive'])
+                                             archive=config_lem['positions_archive'],
+                                             aggregate=aggregate)
 
     # Jump to end of function if offers or bids are empty
     if offers.empty or bids.empty:
@@ -125,6 +128,7 @@ def market_clearing(db_obj,
                                      config_lem,
                                      offers_ts_d,
                                      bids_ts_d,
+                                     presorted=aggregate and config_retailer is None,
                                      plotting=plotting,
                                      plotting_title=plotting_title)
 
@@ -949,6 +953,7 @@ def clearing_pda(db_obj,
                  type_clearing=None,
                  shuffle=True,
                  add_premium=False,
+                 presorted=False,
                  plotting=False,
                  plotting_title=None,
                  plotting_ylim=None):
@@ -961,6 +966,9 @@ def clearing_pda(db_obj,
     @param type_clearing: clearing type that is using clearing da functionality
     @param shuffle: boolean value to shuffle bids and offers before clearing for fairness
     @param add_premium: boolean value to add premium to bid prices
+    @param presorted: boolean value, true if bids and offers are already aggregated and sorted in clearing order,
+                      e.g. by get_open_positions(aggregate=True). Aggregation, shuffling and sorting are skipped.
+                      Ignored if add_premium is true, as the premium changes the order
     @param plotting: boolean value to plot clearing results
     @param plotting_title: title of plot, ignored if plotting is false
     @param plotting_ylim: list of two values to predefine limits of y axis
@@ -984,30 +992,37 @@ def clearing_pda(db_obj,
     # Exclude bids/offers if they have zero quantity
     bids = bids[bids[db_obj.db_param.QTY_ENERGY] > 0]
     offers = offers[offers[db_obj.db_param.QTY_ENERGY] > 0]
-    # Aggregate equal positions
-    bids = _aggregate_identical_positions(db_obj=db_obj,
-                                          positions=bids,
-                                          subset=[db_obj.db_param.PRICE_ENERGY, db_obj.db_param.QUALITY_ENERGY,
-                                                  db_obj.db_param.ID_USER])
-    offers = _aggregate_identical_positions(db_obj=db_obj,
-                                            positions=offers,
-                                            subset=[db_obj.db_param.PRICE_ENERGY, db_obj.db_param.QUALITY_ENERGY,
-                                                    db_obj.db_param.ID_USER])
+    presorted = presorted and not add_premium
+    if not presorted:
+        # Aggregate equal positions
+        bids = _aggregate_identical_positions(db_obj=db_obj,
+                                              positions=bids,
+                                              subset=[db_obj.db_param.PRICE_ENERGY, db_obj.db_param.QUALITY_ENERGY,
+                                                      db_obj.db_param.ID_USER])
+        offers = _aggregate_identical_positions(db_obj=db_obj,
+                                                positions=offers,
+                                                subset=[db_obj.db_param.PRICE_ENERGY, db_obj.db_param.QUALITY_ENERGY,
+                                                        db_obj.db_param.ID_USER])
     if add_premium:
         bids[db_obj.db_param.PRICE_ENERGY] += (bids[db_obj.db_param.PRICE_ENERGY] *
                                                bids[db_obj.db_param.PREMIUM_PREFERENCE_QUALITY] / 100).astype(int)
-    if shuffle:
+    if shuffle and not presorted:
         # Shuffle all bids and offers, so that submission speed does not matter
         bids = bids.sample(frac=1).reset_index(drop=True)
         offers = offers.sample(frac=1).reset_index(drop=True)
     try:
-        # Sort values first by price and quality
-        offers_sorted = offers.sort_values(by=[db_obj.db_param.PRICE_ENERGY, db_obj.db_param.QUALITY_ENERGY],
-                                           ascending=[True, False],
+        if presorted:
+            # ties were already broken randomly by the database
+            offers_sorted = offers.reset_index(drop=True)
+            bids_sorted = bids.reset_index(drop=True)
+        else:
+            # Sort values first by price and quality
+            offers_sorted = offers.sort_values(by=[db_obj.db_param.PRICE_ENERGY, db_obj.db_param.QUALITY_ENERGY],
+                                               ascending=[True, False],
+                                               ignore_index=True)
+            bids_sorted = bids.sort_values(by=[db_obj.db_param.PRICE_ENERGY, db_obj.db_param.QUALITY_ENERGY],
+                                           ascending=[False, False],
                                            ignore_index=True)
-        bids_sorted = bids.sort_values(by=[db_obj.db_param.PRICE_ENERGY, db_obj.db_param.QUALITY_ENERGY],
-                                       ascending=[False, False],
-                                       ignore_index=True)
         # Set index of bids and offers to cumulated energy qty sums
         bids_sorted.set_index(bids_sorted[db_obj.db_param.QTY_ENERGY].cumsum(), inplace=True)
         offers_sorted.set_index(offers_sorted[db_obj.db_param.QTY_ENERGY].cumsum(), inplace=True)
@@ -1464,7 +1479,7 @@ def _aggregate_identical_positions(db_obj,
     # Drop duplicates that contain the same price, quality and id and keep the last of duplicates
     positions.drop_duplicates(subset=subset, keep='last', inplace=True)
     # reassign new quantities to qty_energy
-    positions.assign(**{db_obj.db_param.QTY_ENERGY: [positions.index[0]] + list(np.diff(positions.index))})
+    positions = positions.assign(**{db_obj.db_param.QTY_ENERGY: [positions.index[0]] + list(np.diff(positions.index))})
     # Reset index of positions
     positions.reset_index(drop=True, inplace=True)
 
@@ -5,10 +5,11 @@ __maintainer__ = "sdlumpp"
 __email__ = "sebastian.lumpp@tum.de"
 
 import json
-from bisect import bisect_left
 import pandas as pd
 import feather as ft
 import numpy as np
+from scipy import sparse
+import lemlab.db_connection.db_param as db_p
 
 """ This module contains the functions required to settle the local energy market.
     Settlement means all of the market functionality that takes place after the physical delivery of electricity
@@ -19,220 +20,221 @@ import numpy as np
     4 - calculating settlement prices (balancing prices and levies) either in advance or ex-post
     5 - calculating the value of and logging transactions based on all of the above"""
 
+# topologies of the virtual meters, valid for one version of the meter info, see _get_topology_virtual_meters()
+_cache_topology_meters = {"version": None, "topologies": {}}
+
 
 def update_complete_meter_readings(db_obj):
     """
     Check for which ts_delivery ALL meter readings have been logged and calculate energy deltas for each meter.
     Label processed steps in status_settlement
+
+    All unprocessed ts_delivery are handled in a single pass. The cumulative readings are queried once, readings at the
+    beginning and end of each ts_delivery are paired by a join and all energy deltas are logged in one upsert, so
+    the number of queries does not grow with the number of unprocessed steps.
+
+    Unprocessed ts_delivery may already have been settled provisionally, see get_list_ts_delivery_overdue(). The
+    energy deltas of these steps that changed due to late readings are returned, so that only they can be re-settled
+    with update_balance_late_readings().
     :param db_obj: instance of DatabaseConnection
 
-    :return None:
+    :return: DataFrame, ts_delivery and id_meter of the changed energy deltas of provisionally settled steps
     """
-    # return list of all timesteps, extract unprocessed steps
+    # return list of all timesteps, extract unprocessed steps and those of them already settled
     df_clearing_log = db_obj.get_status_settlement()
-    list_t_d_meter_readings_incomplete = \
-        list(df_clearing_log.loc[df_clearing_log["status_meter_readings_processed"] == 0].ts_delivery)
-
-    for ts_delivery in list_t_d_meter_readings_incomplete:
-        # get a list of meters active at the ts_delivery under consideration
-        list_meters = sorted(db_obj.get_list_all_meters(ts_delivery_active=ts_delivery))
-        # get list of meters that logged a meter reading
-        # immediately BEFORE AND AFTER the ts_delivery under consideration
-        list_meters_logged = sorted(_get_list_meters_logged(db_obj, ts_delivery))
-        # proceed only if all meters have logged values
-        # get cumulative meter readings, before and after
-        df_metering_logs_cumulative = db_obj.get_meter_readings_cumulative(
-            t_reading_first=ts_delivery,
-            t_reading_last=ts_delivery + 900)
-
-        if set(list_meters).issubset(set(list_meters_logged)):
-            df_metering_logs_cumulative_prev = \
-                df_metering_logs_cumulative[df_metering_logs_cumulative["t_reading"] == ts_delivery
-                                            ].set_index(db_obj.db_param.ID_METER)
-            df_metering_logs_cumulative_now = \
-                df_metering_logs_cumulative[df_metering_logs_cumulative["t_reading"] == ts_delivery + 900
-                                            ].set_index(db_obj.db_param.ID_METER)
-            # calculate energy delta, log deltas to database
-            df_meter_reading_delta = df_metering_logs_cumulative_now - df_metering_logs_cumulative_prev
-            df_meter_reading_delta["t_reading"] = ts_delivery
-            df_meter_reading_delta = df_meter_reading_delta.rename(columns={
-                db_obj.db_param.T_READING: db_obj.db_param.TS_DELIVERY,
-                db_obj.db_param.ENERGY_IN_CUM: db_obj.db_param.ENERGY_IN,
-                db_obj.db_param.ENERGY_OUT_CUM: db_obj.db_param.ENERGY_OUT}).reset_index()
-            db_obj.log_readings_meter_delta(df_meter_reading_delta)
-
-            # label timestep as processed
-            db_obj.set_status_settlement(pd.DataFrame().from_dict({
-                db_obj.db_param.TS_DELIVERY: [ts_delivery],
-                db_obj.db_param.STATUS_METER_READINGS_PROCESSED: [1],
-                db_obj.db_param.STATUS_SETTLEMENT_COMPLETE: [0]
-            }))
-            calculate_virtual_submeters(db_obj=db_obj, list_ts_delivery=[ts_delivery])
-        else:
-            df_metering_logs_cumulative_prev = \
-                df_metering_logs_cumulative[df_metering_logs_cumulative["t_reading"] == ts_delivery
-                                            ].set_index(db_obj.db_param.ID_METER)
-            df_metering_logs_cumulative_now = \
-                df_metering_logs_cumulative[df_metering_logs_cumulative["t_reading"] == ts_delivery + 900
-                                            ].set_index(db_obj.db_param.ID_METER)
-
-            ix_prev = df_metering_logs_cumulative_prev.index
-            ix_now = df_metering_logs_cumulative_now.index
-            ix_intersection = ix_prev.intersection(ix_now)
-
-            df_metering_logs_cumulative_prev = df_metering_logs_cumulative_prev.loc[ix_intersection]
-            df_metering_logs_cumulative_now = df_metering_logs_cumulative_now.loc[ix_intersection]
-
-            # calculate energy delta, log deltas to database
-            if len(ix_intersection):
-                df_meter_reading_delta = df_metering_logs_cumulative_now - df_metering_logs_cumulative_prev
-                df_meter_reading_delta["t_reading"] = ts_delivery
-                df_meter_reading_delta = df_meter_reading_delta.rename(columns={
-                    db_obj.db_param.T_READING: db_obj.db_param.TS_DELIVERY,
-                    db_obj.db_param.ENERGY_IN_CUM: db_obj.db_param.ENERGY_IN,
-                    db_obj.db_param.ENERGY_OUT_CUM: db_obj.db_param.ENERGY_OUT}).reset_index()
-                db_obj.log_readings_meter_delta(df_meter_reading_delta)
-                calculate_virtual_submeters(db_obj=db_obj, list_ts_delivery=[ts_delivery])
+    df_clearing_log = df_clearing_log[df_clearing_log[db_obj.db_param.STATUS_METER_READINGS_PROCESSED] == 0]
+    array_ts_delivery_incomplete = df_clearing_log[db_obj.db_param.TS_DELIVERY].to_numpy(dtype=np.int64)
+    array_ts_delivery_settled = df_clearing_log.loc[
+        df_clearing_log[db_obj.db_param.STATUS_SETTLEMENT_COMPLETE] == 1, db_obj.db_param.TS_DELIVERY
+    ].to_numpy(dtype=np.int64)
+    if not len(array_ts_delivery_incomplete):
+        return pd.DataFrame(columns=[db_obj.db_param.TS_DELIVERY, db_obj.db_param.ID_METER])
+    # energy deltas the provisional settlement was based on
+    df_delta_settled = _get_readings_delta(db_obj, array_ts_delivery_settled)
+
+    # get cumulative meter readings at the beginning and end of all unprocessed steps. only the readings at these
+    # times are queried, unprocessed steps may be far apart, e.g. if a reading of an old step is missing
+    df_metering_logs_cumulative = db_obj.get_meter_readings_cumulative(
+        t_reading_first=int(array_ts_delivery_incomplete.min()),
+        t_reading_last=int(array_ts_delivery_incomplete.max()) + 900,
+        list_t_reading=np.union1d(array_ts_delivery_incomplete, array_ts_delivery_incomplete + 900))
+    # pair the reading at the beginning of each ts_delivery with the reading at its end
+    df_prev = df_metering_logs_cumulative.rename(columns={db_obj.db_param.T_READING: db_obj.db_param.TS_DELIVERY})
+    df_prev = df_prev[df_prev[db_obj.db_param.TS_DELIVERY].isin(array_ts_delivery_incomplete)]
+    df_now = df_metering_logs_cumulative.rename(columns={db_obj.db_param.T_READING: db_obj.db_param.TS_DELIVERY})
+    df_now[db_obj.db_param.TS_DELIVERY] -= 900
+    df_meter_reading_delta = df_prev.merge(df_now, on=[db_obj.db_param.TS_DELIVERY, db_obj.db_param.ID_METER],
+                                           suffixes=("_prev", "_now"))
+    # calculate energy deltas of all meters that logged at the beginning and end of a ts_delivery
+    for column_cum, column_delta in [(db_obj.db_param.ENERGY_IN_CUM, db_obj.db_param.ENERGY_IN),
+                                     (db_obj.db_param.ENERGY_OUT_CUM, db_obj.db_param.ENERGY_OUT)]:
+        df_meter_reading_delta[column_delta] = \
+            df_meter_reading_delta[column_cum + "_now"] - df_meter_reading_delta[column_cum + "_prev"]
+    df_meter_reading_delta = df_meter_reading_delta[[db_obj.db_param.TS_DELIVERY, db_obj.db_param.ID_METER,
+                                                     db_obj.db_param.ENERGY_IN, db_obj.db_param.ENERGY_OUT]]
+    db_obj.log_readings_meter_delta(df_meter_reading_delta)
+
+    # a step is complete if all non-virtual meters active during the step logged a reading before and after it
+    info_meter = db_obj.get_info_meter()
+    info_meter = info_meter[~info_meter[db_obj.db_param.TYPE_METER].str.startswith("virtual")]
+    array_active = \
+        (info_meter[db_obj.db_param.TS_DELIVERY_FIRST].to_numpy()[None, :] <= array_ts_delivery_incomplete[:, None]) \
+        & (info_meter[db_obj.db_param.TS_DELIVERY_LAST].to_numpy()[None, :] >= array_ts_delivery_incomplete[:, None])
+    index_logged = pd.MultiIndex.from_frame(df_meter_reading_delta[[db_obj.db_param.TS_DELIVERY,
+                                                                    db_obj.db_param.ID_METER]])
+    ix_ts, ix_meter = np.nonzero(array_active)
+    array_logged = pd.MultiIndex.from_arrays([array_ts_delivery_incomplete[ix_ts],
+                                              info_meter[db_obj.db_param.ID_METER].to_numpy()[ix_meter]]
+                                             ).isin(index_logged)
+    array_missing = np.bincount(ix_ts[~array_logged], minlength=len(array_ts_delivery_incomplete))
+    list_ts_delivery_complete = [int(ts_d) for ts_d in array_ts_delivery_incomplete[array_missing == 0]]
+
+    # label complete timesteps as processed, provisionally settled steps remain settled
+    if list_ts_delivery_complete:
+        db_obj.set_status_settlement(pd.DataFrame().from_dict({
+            db_obj.db_param.TS_DELIVERY: list_ts_delivery_complete,
+            db_obj.db_param.STATUS_METER_READINGS_PROCESSED: [1] * len(list_ts_delivery_complete),
+            db_obj.db_param.STATUS_SETTLEMENT_COMPLETE: np.isin(list_ts_delivery_complete,
+                                                                array_ts_delivery_settled).astype(int)
+        }))
+    # virtual meters are calculated for all steps with new readings
+    if len(df_meter_reading_delta):
+        calculate_virtual_submeters(db_obj=db_obj,
+                                    list_ts_delivery=sorted(set(df_meter_reading_delta[db_obj.db_param.TS_DELIVERY])))
+
+    # compare the energy deltas of the provisionally settled steps to those they were settled with
+    return _get_cells_changed(db_obj, df_delta_settled, _get_readings_delta(db_obj, array_ts_delivery_settled))
 
 
 def calculate_virtual_submeters(db_obj, list_ts_delivery):
     """
     In some simulations, some plant have no physical meters. Their power flow must be implicitly calculated and
     assigned to a virtual meter.
+
+    The flows of all virtual meters are calculated for all ts_delivery at once, as the product of a sparse matrix
+    compiled from the meter tree and the matrix of metered flows, see _get_topology_virtual_meters().
     :param db_obj: instance of DatabaseConnection
     :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
 
     :return None:
     """
+    if not len(list_ts_delivery):
+        return
+    array_ts_delivery = np.unique(np.array(list_ts_delivery, dtype=np.int64))
     # get list of meter readings
-    df_readings_meter_delta = db_obj.get_meter_readings_delta(ts_delivery_first=list_ts_delivery[0],
-                                                              ts_delivery_last=list_ts_delivery[-1])
+    df_readings_meter_delta = db_obj.get_meter_readings_delta(ts_delivery_first=int(array_ts_delivery[0]),
+                                                              ts_delivery_last=int(array_ts_delivery[-1]))
+    info_meter = db_obj.get_info_meter()
+    # all registered meters and their supermeters, the order defines the columns of the topology matrices
+    index_meters = pd.Index(info_meter[db_obj.db_param.ID_METER]).append(
+        pd.Index(info_meter[db_obj.db_param.ID_METER_SUPER])).unique()
+
+    # matrices of the metered net flows and of the logged readings, meters x ts_delivery
+    ix_meter = index_meters.get_indexer(df_readings_meter_delta[db_obj.db_param.ID_METER])
+    ix_ts = np.searchsorted(array_ts_delivery, df_readings_meter_delta[db_obj.db_param.TS_DELIVERY].to_numpy())
+    ix_ts = np.minimum(ix_ts, len(array_ts_delivery) - 1)
+    mask = (ix_meter >= 0) \
+        & (array_ts_delivery[ix_ts] == df_readings_meter_delta[db_obj.db_param.TS_DELIVERY].to_numpy())
+    array_flows = np.zeros((len(index_meters), len(array_ts_delivery)), dtype=np.int64)
+    array_logged = np.zeros((len(index_meters), len(array_ts_delivery)), dtype=np.int64)
+    array_flows[ix_meter[mask], ix_ts[mask]] = \
+        df_readings_meter_delta[db_obj.db_param.ENERGY_OUT].to_numpy(dtype=np.int64)[mask] \
+        - df_readings_meter_delta[db_obj.db_param.ENERGY_IN].to_numpy(dtype=np.int64)[mask]
+    array_logged[ix_meter[mask], ix_ts[mask]] = 1
+
+    # ts_delivery with the same set of active meters share one topology
+    array_active = \
+        (info_meter[db_obj.db_param.TS_DELIVERY_FIRST].to_numpy()[None, :] <= array_ts_delivery[:, None]) \
+        & (info_meter[db_obj.db_param.TS_DELIVERY_LAST].to_numpy()[None, :] >= array_ts_delivery[:, None])
+    array_patterns, ix_pattern = np.unique(array_active, axis=0, return_inverse=True)
+
     list_readings_meter_delta = []
-    for ts_delivery in list_ts_delivery:
-        # loop through all ts deliveries
-        # get list of all meters currently active
-        df_info_meter = db_obj.get_info_meter(ts_delivery_active=ts_delivery)
-        # extract the list of virtual meters
-        list_virtual_meters = list(df_info_meter[df_info_meter["type_meter"].str.contains("virtual")]["id_meter"])
-        # init list of VM readings to be logged
-        # for all virtual meters under consideration
-        for virtual_meter in list_virtual_meters:
-            # get the associated supermeter
-            supermeter = df_info_meter.set_index("id_meter").loc[virtual_meter, "id_meter_super"]
-            # if the VM is not a grid meter (top level meter)
-            if supermeter != "0000000000":
-                # return list of associated submeters
-                df_submeters = df_info_meter[(df_info_meter["id_meter_super"] == supermeter)
-                                             & (df_info_meter["id_meter"] != virtual_meter)]
-                list_submeters = list(df_submeters["id_meter"])
-                set_readings = set(df_readings_meter_delta[(df_readings_meter_delta["id_meter"].isin(list_submeters))
-                                                           & (df_readings_meter_delta["ts_delivery"] == ts_delivery)
-                                                           ]["id_meter"])
-                mm_reading = df_readings_meter_delta[(df_readings_meter_delta["id_meter"] == supermeter) &
-                                                     (df_readings_meter_delta["ts_delivery"] == ts_delivery)]
-                if set(list_submeters).issubset(set_readings) and len(mm_reading):
-                    # determine "missing" energy
-                    # "missing" energy is attributed to the VM
-                    cum_energy = 0
-                    for meter in list(set_readings):
-                        cum_temp = df_readings_meter_delta[(df_readings_meter_delta["id_meter"] == meter) &
-                                                           (df_readings_meter_delta["ts_delivery"] == ts_delivery)]
-                        cum_energy += int(cum_temp["energy_out"]) - int(cum_temp["energy_in"])
-
-                    mm_energy = int(mm_reading["energy_out"]) - int(mm_reading["energy_in"])
-                    vm_energy = mm_energy - cum_energy
-                    # append result to list of VM readings to be logged
-                    list_readings_meter_delta.append([ts_delivery,
-                                                      _decomp_float(vm_energy, "neg"),
-                                                      _decomp_float(vm_energy, "pos"),
-                                                      virtual_meter])
-            # if the VM is a supermeter
-            else:
-                # sum the flows of all submeters to find VM (supermeter) flow
-                supermeter = virtual_meter
-                df_submeters = df_info_meter[df_info_meter["id_meter_super"] == supermeter]
-                list_submeters = list(df_submeters["id_meter"])
-                set_readings = set(df_readings_meter_delta[(df_readings_meter_delta["id_meter"].isin(list_submeters))
-                                                           & (df_readings_meter_delta["ts_delivery"] == ts_delivery)
-                                                           ]["id_meter"])
-                if set(list_submeters).issubset(set_readings) and len(set_readings):
-                    cum_energy = 0
-                    # determine missing energy flow
-                    for meter in list(set_readings):
-                        cum_temp = df_readings_meter_delta[(df_readings_meter_delta["id_meter"] == meter) &
-                                                           (df_readings_meter_delta["ts_delivery"] == ts_delivery)]
-                        cum_energy += int(cum_temp["energy_out"]) - int(cum_temp["energy_in"])
-                    vm_energy = cum_energy
-                    # append result to list of VM readings to be logged
-                    list_readings_meter_delta.append([ts_delivery,
-                                                      _decomp_float(vm_energy, "neg"),
-                                                      _decomp_float(vm_energy, "pos"),
-                                                      virtual_meter])
-        # end VM for loop
-    # end ts_d for loop
+    for i, array_pattern in enumerate(array_patterns):
+        list_virtual_meters, matrix_flows, matrix_required = \
+            _get_topology_virtual_meters(db_obj, info_meter, index_meters, array_pattern)
+        if not len(list_virtual_meters):
+            continue
+        ix_ts_pattern = np.flatnonzero(ix_pattern.ravel() == i)
+        # "missing" energy is attributed to the virtual meters, which are only calculated if all required meters
+        # logged a reading
+        array_flows_virtual = matrix_flows @ array_flows[:, ix_ts_pattern]
+        array_missing = matrix_required @ (1 - array_logged[:, ix_ts_pattern])
+        array_required = np.asarray(matrix_required.sum(axis=1)).reshape(-1, 1)
+        ix_virtual, ix_ts_valid = np.nonzero((array_missing == 0) & (array_required > 0))
+        array_energy = array_flows_virtual[ix_virtual, ix_ts_valid]
+        list_readings_meter_delta.append(pd.DataFrame({
+            db_obj.db_param.TS_DELIVERY: array_ts_delivery[ix_ts_pattern[ix_ts_valid]],
+            db_obj.db_param.ENERGY_IN: np.maximum(-array_energy, 0),
+            db_obj.db_param.ENERGY_OUT: np.maximum(array_energy, 0),
+            db_obj.db_param.ID_METER: np.array(list_virtual_meters, dtype=object)[ix_virtual]}))
 
     # log virtual meter deltas to database
     if len(list_readings_meter_delta):
-        df_meter_reading_delta = pd.DataFrame(list_readings_meter_delta,
-                                              columns=[db_obj.db_param.TS_DELIVERY, db_obj.db_param.ENERGY_IN,
-                                                       db_obj.db_param.ENERGY_OUT, db_obj.db_param.ID_METER])
-        db_obj.log_readings_meter_delta(df_meter_reading_delta)
+        db_obj.log_readings_meter_delta(pd.concat(list_readings_meter_delta, ignore_index=True))
 
 
 def determine_balancing_energy(db_obj, list_ts_delivery):
     """
     Calculate balancing energy used by each main meter.
     Balancing energy is the deviation from the ex-ante market result during ts_delivery
+
+    Traded and metered energies of all main meters and ts_delivery are aligned in dense arrays indexed by meter and
+    ts_delivery codes, so balancing energy is determined for all of them at once.
     :param db_obj: instance of DatabaseConnection
     :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
 
     :return None:
     """
+    if not len(list_ts_delivery):
+        return
+    array_ts_delivery = np.unique(np.array(list_ts_delivery, dtype=np.int64))
     # get mapping of market agent IDs to main meter
     map_id_ma_to_main_meter = db_obj.get_map_to_main_meter()
 
-    dict_bal_ener = {
-        db_obj.db_param.ID_METER: [],
-        db_obj.db_param.TS_DELIVERY: [],
-        db_obj.db_param.ENERGY_BALANCING_POSITIVE: [],
-        db_obj.db_param.ENERGY_BALANCING_NEGATIVE: []
-    }
-    list_ts_delivery = sorted(list_ts_delivery)
-    ts_d_first = list_ts_delivery[0] if len(list_ts_delivery) else 0
-    ts_d_last = list_ts_delivery[-1] if len(list_ts_delivery) else 0
-    market_results_all, _, = db_obj.get_results_market_ex_ante(ts_delivery_first=ts_d_first,
-                                                               ts_delivery_last=ts_d_last)
-    for ts_d in list_ts_delivery:
-        # return MAIN meter reading deltas and ex-ante market results
-        main_meter_readings_delta = db_obj.get_meter_readings_by_type(ts_delivery=ts_d, types_meters=[4, 5])
-        main_meter_readings_delta["energy_net"] = main_meter_readings_delta[db_obj.db_param.ENERGY_OUT] \
-            - main_meter_readings_delta[db_obj.db_param.ENERGY_IN]
-
-        market_results = market_results_all[market_results_all[db_obj.db_param.TS_DELIVERY] == ts_d]
-        # relabel market results by main meters, so comparison to energy flows can be made
-        market_results = market_results.replace({db_obj.db_param.ID_USER_BID: map_id_ma_to_main_meter,
-                                                 db_obj.db_param.ID_USER_OFFER: map_id_ma_to_main_meter})
-        # determine balancing energy per meter
-        for _, entry in main_meter_readings_delta.iterrows():
-            current_market_energy = 0
-            current_market_energy -= \
-                market_results[market_results[db_obj.db_param.ID_USER_BID] == entry.loc[db_obj.db_param.ID_METER]
-                               ][db_obj.db_param.QTY_ENERGY_TRADED].sum()
-            current_market_energy += \
-                market_results[market_results[db_obj.db_param.ID_USER_OFFER] == entry.loc[db_obj.db_param.ID_METER]
-                               ][db_obj.db_param.QTY_ENERGY_TRADED].sum()
-
-            current_balancing_energy = -1 * (current_market_energy - entry.loc["energy_net"])
-            # append result to dict
-            dict_bal_ener[db_obj.db_param.ID_METER].append(entry.loc[db_obj.db_param.ID_METER])
-            dict_bal_ener[db_obj.db_param.TS_DELIVERY].append(ts_d)
-            dict_bal_ener[db_obj.db_param.ENERGY_BALANCING_POSITIVE].append(
-                _decomp_float(float_in=current_balancing_energy, return_val="pos"))
-            dict_bal_ener[db_obj.db_param.ENERGY_BALANCING_NEGATIVE].append(
-                _decomp_float(float_in=current_balancing_energy, return_val="neg"))
-    # if any values calculated, post to database
-    if len(dict_bal_ener[db_obj.db_param.ID_METER]):
-        db_obj.log_energy_balancing(pd.DataFrame().from_dict(dict_bal_ener))
+    # return MAIN meter reading deltas and ex-ante market results of all ts_delivery
+    main_meter_readings_delta = db_obj.get_meter_readings_by_type(ts_delivery=int(array_ts_delivery[0]),
+                                                                  ts_delivery_last=int(array_ts_delivery[-1]),
+                                                                  types_meters=[4, 5])
+    main_meter_readings_delta = main_meter_readings_delta[
+        main_meter_readings_delta[db_obj.db_param.TS_DELIVERY].isin(array_ts_delivery)]
+    if not len(main_meter_readings_delta):
+        return
+    market_results, _, = db_obj.get_results_market_ex_ante(ts_delivery_first=int(array_ts_delivery[0]),
+                                                            ts_delivery_last=int(array_ts_delivery[-1]))
+    market_results = market_results[market_results[db_obj.db_param.TS_DELIVERY].isin(array_ts_delivery)]
+    # relabel market results by main meters, so comparison to energy flows can be made
+    id_meter_bid = market_results[db_obj.db_param.ID_USER_BID].map(map_id_ma_to_main_meter).fillna(
+        market_results[db_obj.db_param.ID_USER_BID])
+    id_meter_offer = market_results[db_obj.db_param.ID_USER_OFFER].map(map_id_ma_to_main_meter).fillna(
+        market_results[db_obj.db_param.ID_USER_OFFER])
+
+    # factorize meters and ts_delivery, the flat code of a (meter, ts_delivery) pair indexes the dense arrays
+    index_meters = pd.Index(main_meter_readings_delta[db_obj.db_param.ID_METER].unique())
+    n_cells = len(index_meters) * len(array_ts_delivery)
+    code_readings = \
+        np.searchsorted(array_ts_delivery, main_meter_readings_delta[db_obj.db_param.TS_DELIVERY].to_numpy()) \
+        * len(index_meters) + index_meters.get_indexer(main_meter_readings_delta[db_obj.db_param.ID_METER])
+    code_ts_results = np.searchsorted(array_ts_delivery, market_results[db_obj.db_param.TS_DELIVERY].to_numpy()) \
+        * len(index_meters)
+    qty_traded = market_results[db_obj.db_param.QTY_ENERGY_TRADED].to_numpy(dtype=np.float64)
+
+    # market energy per cell: offered energy is sold, bid energy is bought
+    array_market_energy = np.zeros(n_cells)
+    for id_meter, sign in [(id_meter_offer, 1), (id_meter_bid, -1)]:
+        ix_meter = index_meters.get_indexer(id_meter)
+        mask = ix_meter >= 0
+        array_market_energy += sign * np.bincount(code_ts_results[mask] + ix_meter[mask],
+                                                  weights=qty_traded[mask], minlength=n_cells)
+
+    # balancing energy is the deviation of the metered net energy from the market energy
+    energy_net = main_meter_readings_delta[db_obj.db_param.ENERGY_OUT].to_numpy(dtype=np.float64) \
+        - main_meter_readings_delta[db_obj.db_param.ENERGY_IN].to_numpy(dtype=np.float64)
+    array_balancing_energy = np.round(energy_net - array_market_energy[code_readings])
+    db_obj.log_energy_balancing(pd.DataFrame({
+        db_obj.db_param.ID_METER: main_meter_readings_delta[db_obj.db_param.ID_METER].to_numpy(),
+        db_obj.db_param.TS_DELIVERY: main_meter_readings_delta[db_obj.db_param.TS_DELIVERY].to_numpy(),
+        db_obj.db_param.ENERGY_BALANCING_POSITIVE: np.clip(array_balancing_energy, 0, None).astype(np.int64),
+        db_obj.db_param.ENERGY_BALANCING_NEGATIVE: np.clip(-array_balancing_energy, 0, None).astype(np.int64)}))
 
 
 def update_balance_balancing_costs(db_obj, t_now, lem_config, list_ts_delivery, id_retailer="retailer01"):
@@ -248,135 +250,76 @@ def update_balance_balancing_costs(db_obj, t_now, lem_config, list_ts_delivery,
     :return None:
 
     """
-    # get mapping from meters to users
-    dict_map_to_user = db_obj.get_mapping_to_user()
-    # construct transaction dict including dynamic quality columns
-    dict_transactions = {
-        db_obj.db_param.ID_USER: [],
-        db_obj.db_param.TS_DELIVERY: [],
-        db_obj.db_param.PRICE_ENERGY_MARKET: [],
-        db_obj.db_param.TYPE_TRANSACTION: [],
-        db_obj.db_param.QTY_ENERGY: [],
-        db_obj.db_param.DELTA_BALANCE: [],
-        db_obj.db_param.T_UPDATE_BALANCE: [],
-    }
-    for quality in lem_config["types_quality"]:
-        dict_transactions.update({db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]: []})
-
-    for ts_d in list_ts_delivery:
-        # return relevant settlement prices
-        settlement_prices = db_obj.get_prices_settlement(ts_delivery_first=ts_d)
-        pos_bal_ener_price = int(settlement_prices[db_obj.db_param.PRICE_ENERGY_BALANCING_POSITIVE])
-        neg_bal_ener_price = int(settlement_prices[db_obj.db_param.PRICE_ENERGY_BALANCING_NEGATIVE])
-        # return balancing energies
-        balancing_energies = db_obj.get_energy_balancing(ts_delivery=ts_d)
-
-        # repeat calculation for each balancing energy recorded
-        for _, entry in balancing_energies.iterrows():
-            if entry.loc[db_obj.db_param.ENERGY_BALANCING_POSITIVE] != 0:
-                transaction_value = entry.loc[db_obj.db_param.ENERGY_BALANCING_POSITIVE] * pos_bal_ener_price
-
-                # credit retailer
-                dict_transactions[db_obj.db_param.ID_USER].append(id_retailer)
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(pos_bal_ener_price)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("balancing")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(
-                    -1 * entry.loc[db_obj.db_param.ENERGY_BALANCING_POSITIVE])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].append(0)
-
-                # debit consumer
-                dict_transactions[db_obj.db_param.ID_USER].append(dict_map_to_user[entry.loc[db_obj.db_param.ID_METER]])
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(pos_bal_ener_price)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("balancing")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(
-                    entry.loc[db_obj.db_param.ENERGY_BALANCING_POSITIVE])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(-1 * transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].append(0)
-
-            elif entry.loc[db_obj.db_param.ENERGY_BALANCING_NEGATIVE] != 0:
-                transaction_value = entry.loc[db_obj.db_param.ENERGY_BALANCING_NEGATIVE] * neg_bal_ener_price
-                # credit retailer
-                dict_transactions[db_obj.db_param.ID_USER].append(id_retailer)
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(neg_bal_ener_price)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("balancing")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(
-                    entry.loc[db_obj.db_param.ENERGY_BALANCING_NEGATIVE])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].append(0)
-
-                # debit consumer
-                dict_transactions[db_obj.db_param.ID_USER].append(
-                    dict_map_to_user[entry.loc[db_obj.db_param.ID_METER]])
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(neg_bal_ener_price)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("balancing")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(
-                    -1 * entry.loc[db_obj.db_param.ENERGY_BALANCING_NEGATIVE])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(
-                    -1 * transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].append(0)
-
-    # if any balancing energy transactions recorded, post to DB
-    if len(dict_transactions[db_obj.db_param.ID_USER]):
-        db_obj.log_transactions(pd.DataFrame.from_dict(dict_transactions))
-        db_obj.update_balance_user(pd.DataFrame.from_dict(dict_transactions))
+    _log_transactions(db_obj, get_transactions_balancing(db_obj=db_obj, t_now=t_now, lem_config=lem_config,
+                                                         list_ts_delivery=list_ts_delivery, id_retailer=id_retailer))
+
+
+def get_transactions_balancing(db_obj, t_now, lem_config, list_ts_delivery, id_retailer="retailer01"):
+    """
+    Determine the balancing energy transactions of all ts_delivery at once.
+
+    :param db_obj: instance of DatabaseConnection
+    :param t_now: integer, unix timestamp current time
+    :param lem_config: dictionary containing configuration of LEM
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
+    :param id_retailer: string, retailer id, number, as retailer needs to be credited/debited
+
+    :return: DataFrame, transactions of users and retailer, see _build_transactions()
+    """
+    if not len(list_ts_delivery):
+        return None
+    return _calc_transactions_balancing(_get_charges_balancing(db_obj, list_ts_delivery),
+                                        lem_config=lem_config, t_now=t_now, id_retailer=id_retailer)
 
 
 def set_prices_settlement(db_obj, path_simulation, list_ts_delivery):
     """
     Determine levy energy debit and credit and add transactions to database.
 
+    The prices of all ts_delivery are determined at once and logged with a single upsert.
+
     :param db_obj: instance of DatabaseConnection
     :param path_simulation: string, path to simulation_results folder
     :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
 
     :return None:
     """
+    if not len(list_ts_delivery):
+        return
     # load lem config file
     with open(f"{path_simulation}/lem/config_account.json", "r") as read_file:
         config_dict = json.load(read_file)
     # conversion factor from off chain to on chain currency
     euro_kwh_to_sigma_wh = db_obj.db_param.EURO_TO_SIGMA / 1000
-
-    for ts_delivery in list_ts_delivery:
-        # default, set settlement prices to fixed value in config
-        price_bal_pos = config_dict["price_energy_balancing_positive"] * euro_kwh_to_sigma_wh
-        price_bal_neg = config_dict["price_energy_balancing_negative"] * euro_kwh_to_sigma_wh
-        price_levies_pos = config_dict["price_energy_levies_positive"] * euro_kwh_to_sigma_wh
-        price_levies_neg = config_dict["price_energy_levies_negative"] * euro_kwh_to_sigma_wh
-        # if config requires settlement prices to be loaded from a file, override default
-        if config_dict["bal_energy_pricing_mechanism"] == "file":
-            df_bal_prices = ft.read_dataframe(f"{path_simulation}/lem/balancing_prices.ft"
-                                              ).set_index("timestamp")
-            price_bal_pos = df_bal_prices.loc[ts_delivery, "price_balancing_energy_positive"] * euro_kwh_to_sigma_wh
-            price_bal_neg = df_bal_prices.loc[ts_delivery, "price_balancing_energy_negative"] * euro_kwh_to_sigma_wh
-        if config_dict["levy_pricing_mechanism"] == "file":
-            df_levy_prices = ft.read_dataframe(f"{path_simulation}/lem/levy_prices.ft"
-                                               ).set_index("timestamp")
-            price_levies_pos = df_levy_prices.loc[ts_delivery, "price_energy_levies_positive"] * euro_kwh_to_sigma_wh
-            price_levies_neg = df_levy_prices.loc[ts_delivery, "price_energy_levies_negative"] * euro_kwh_to_sigma_wh
-
-        dict_settlement_prices = {
-            db_obj.db_param.TS_DELIVERY: [ts_delivery],
-            db_obj.db_param.PRICE_ENERGY_BALANCING_POSITIVE: [price_bal_pos],
-            db_obj.db_param.PRICE_ENERGY_BALANCING_NEGATIVE: [price_bal_neg],
-            db_obj.db_param.PRICE_ENERGY_LEVIES_POSITIVE: [price_levies_pos],
-            db_obj.db_param.PRICE_ENERGY_LEVIES_NEGATIVE: [price_levies_neg]
-        }
-        # log settlement prices to the DB
-        db_obj.set_prices_settlement(pd.DataFrame().from_dict(dict_settlement_prices))
+    array_ts_delivery = np.array(list_ts_delivery, dtype=np.int64)
+
+    # default, set settlement prices to fixed value in config
+    df_settlement_prices = pd.DataFrame({
+        db_obj.db_param.TS_DELIVERY: array_ts_delivery,
+        db_obj.db_param.PRICE_ENERGY_BALANCING_POSITIVE:
+            config_dict["price_energy_balancing_positive"] * euro_kwh_to_sigma_wh,
+        db_obj.db_param.PRICE_ENERGY_BALANCING_NEGATIVE:
+            config_dict["price_energy_balancing_negative"] * euro_kwh_to_sigma_wh,
+        db_obj.db_param.PRICE_ENERGY_LEVIES_POSITIVE:
+            config_dict["price_energy_levies_positive"] * euro_kwh_to_sigma_wh,
+        db_obj.db_param.PRICE_ENERGY_LEVIES_NEGATIVE:
+            config_dict["price_energy_levies_negative"] * euro_kwh_to_sigma_wh})
+    # if config requires settlement prices to be loaded from a file, override default
+    if config_dict["bal_energy_pricing_mechanism"] == "file":
+        df_bal_prices = ft.read_dataframe(f"{path_simulation}/lem/balancing_prices.ft").set_index("timestamp")
+        df_settlement_prices[db_obj.db_param.PRICE_ENERGY_BALANCING_POSITIVE] = \
+            df_bal_prices.loc[array_ts_delivery, "price_balancing_energy_positive"].to_numpy() * euro_kwh_to_sigma_wh
+        df_settlement_prices[db_obj.db_param.PRICE_ENERGY_BALANCING_NEGATIVE] = \
+            df_bal_prices.loc[array_ts_delivery, "price_balancing_energy_negative"].to_numpy() * euro_kwh_to_sigma_wh
+    if config_dict["levy_pricing_mechanism"] == "file":
+        df_levy_prices = ft.read_dataframe(f"{path_simulation}/lem/levy_prices.ft").set_index("timestamp")
+        df_settlement_prices[db_obj.db_param.PRICE_ENERGY_LEVIES_POSITIVE] = \
+            df_levy_prices.loc[array_ts_delivery, "price_energy_levies_positive"].to_numpy() * euro_kwh_to_sigma_wh
+        df_settlement_prices[db_obj.db_param.PRICE_ENERGY_LEVIES_NEGATIVE] = \
+            df_levy_prices.loc[array_ts_delivery, "price_energy_levies_negative"].to_numpy() * euro_kwh_to_sigma_wh
+
+    # log settlement prices to the DB
+    db_obj.set_prices_settlement(df_settlement_prices)
 
 
 def update_balance_levies(db_obj, t_now, lem_config, list_ts_delivery, id_retailer="retailer01"):
@@ -391,80 +334,26 @@ def update_balance_levies(db_obj, t_now, lem_config, list_ts_delivery, id_retail
 
     :return None:
     """
-    # get mapping from meter to user
-    dict_map_to_user = db_obj.get_mapping_to_user()
-    # construct transaction dict including dynamic quality columns
-    dict_transactions = {
-        db_obj.db_param.ID_USER: [],
-        db_obj.db_param.TS_DELIVERY: [],
-        db_obj.db_param.PRICE_ENERGY_MARKET: [],
-        db_obj.db_param.TYPE_TRANSACTION: [],
-        db_obj.db_param.QTY_ENERGY: [],
-        db_obj.db_param.DELTA_BALANCE: [],
-        db_obj.db_param.T_UPDATE_BALANCE: [],
-    }
-    for quality in lem_config["types_quality"]:
-        dict_transactions.update({db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]: []})
-
-    for ts_d in list_ts_delivery:
-        # get meter readings and levy prices
-        meter_readings_delta = db_obj.get_meter_readings_by_type(ts_delivery=ts_d, types_meters=[4, 5])
-        settlement_prices = db_obj.get_prices_settlement(ts_delivery_first=ts_d)
-        levies_pos = int(settlement_prices[db_obj.db_param.PRICE_ENERGY_LEVIES_POSITIVE])
-        levies_neg = int(settlement_prices[db_obj.db_param.PRICE_ENERGY_LEVIES_NEGATIVE])
-        # for each main meter reading, construct transaction
-        for _, entry in meter_readings_delta.iterrows():
-            if entry.loc[db_obj.db_param.ENERGY_OUT] != 0 and levies_pos != 0:
-                transaction_value = entry.loc[db_obj.db_param.ENERGY_OUT] * levies_pos
-                # credit retailer
-                dict_transactions[db_obj.db_param.ID_USER].append(id_retailer)
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(levies_pos)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("levies")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(- 1 * entry.loc[db_obj.db_param.ENERGY_OUT])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].append(0)
-
-                # debit consumer
-                dict_transactions[db_obj.db_param.ID_USER].append(dict_map_to_user[entry.loc[db_obj.db_param.ID_METER]])
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(levies_pos)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("levies")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(entry.loc[db_obj.db_param.ENERGY_OUT])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(-1 * transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].append(0)
-
-            elif int(entry.loc[db_obj.db_param.ENERGY_IN]) != 0 and levies_neg != 0:
-                transaction_value = entry.loc[db_obj.db_param.ENERGY_IN] * levies_neg
-                # credit retailer
-                dict_transactions[db_obj.db_param.ID_USER].append(id_retailer)
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(levies_neg)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("levies")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(entry.loc[db_obj.db_param.ENERGY_IN])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].append(0)
-
-                # debit consumer
-                dict_transactions[db_obj.db_param.ID_USER].append(dict_map_to_user[entry.loc[db_obj.db_param.ID_METER]])
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(levies_neg)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("levies")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(-1 * entry.loc[db_obj.db_param.ENERGY_IN])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(-1 * transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].append(0)
-    # post transactions, if any
-    if len(dict_transactions[db_obj.db_param.ID_USER]):
-        db_obj.log_transactions(pd.DataFrame.from_dict(dict_transactions))
-        db_obj.update_balance_user(pd.DataFrame.from_dict(dict_transactions))
+    _log_transactions(db_obj, get_transactions_levies(db_obj=db_obj, t_now=t_now, lem_config=lem_config,
+                                                      list_ts_delivery=list_ts_delivery, id_retailer=id_retailer))
+
+
+def get_transactions_levies(db_obj, t_now, lem_config, list_ts_delivery, id_retailer="retailer01"):
+    """
+    Determine the levy transactions of all ts_delivery at once.
+
+    :param db_obj: instance of DatabaseConnection
+    :param t_now: integer, unix timestamp current time
+    :param lem_config: dictionary containing configuration of LEM
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
+    :param id_retailer: string, retailer id, number, as retailer needs to be credited/debited
+
+    :return: DataFrame, transactions of users and retailer, see _build_transactions()
+    """
+    if not len(list_ts_delivery):
+        return None
+    return _calc_transactions_levies(_get_charges_levies(db_obj, list_ts_delivery),
+                                     lem_config=lem_config, t_now=t_now, id_retailer=id_retailer)
 
 
 def determine_prices_ex_post_markets(db_obj, path_simulation, lem_config, list_ts_delivery):
@@ -489,6 +378,9 @@ def set_community_price(db_obj, path_simulation, lem_config, list_ts_delivery):
     """
     Determine and log community pricing for each pricing type
 
+    Qualities and prices of all ts_delivery are determined at once. The prices are interpolated on the pricing curves
+    for the local shares of all ts_delivery in one array operation.
+
     :param db_obj: instance of DatabaseConnection
     :param path_simulation: string, path to simulation_results folder
     :param lem_config: dictionary containing configuration of LEM
@@ -496,107 +388,89 @@ def set_community_price(db_obj, path_simulation, lem_config, list_ts_delivery):
 
     :return None:
     """
+    if not len(list_ts_delivery):
+        return
     # get currency conversion factor
     euro_kwh_to_sigma_wh = db_obj.db_param.EURO_TO_SIGMA / 1000
+    list_share_quality = [db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]
+                          for quality in lem_config["types_quality"]]
 
     # set up result dictionary format and load pricing curves as lookup tables
-    dict_results_ex_post = {db_obj.db_param.TS_DELIVERY: []}
+    dict_results_ex_post = {db_obj.db_param.TS_DELIVERY: list(list_ts_delivery)}
     dict_lookup_tables = {}
 
     for type_pricing in lem_config["types_pricing_ex_post"]:
         with open(f"{path_simulation}/lem/{lem_config['types_pricing_ex_post'][type_pricing]}.json",
                   "r") as read_file:
             dict_lookup_tables[lem_config['types_pricing_ex_post'][type_pricing]] = json.load(read_file)
-        dict_results_ex_post.update({db_obj.db_param.PRICE_ENERGY_MARKET_
-                                     + lem_config['types_pricing_ex_post'][type_pricing]: []})
-
-    for quality in lem_config["types_quality"]:
-        dict_results_ex_post.update({db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]: []})
 
     # get required mappings
     info_meter = db_obj.get_info_meter()
     map_submeter_to_main = dict([(i, a) for i, a in zip(info_meter["id_meter"], info_meter["id_meter_super"])])
     map_quality = db_obj.get_map_meter_to_quality()
 
-    for ts_d in list_ts_delivery:
-        # return meter energy flows
-        dict_results_ex_post[db_obj.db_param.TS_DELIVERY].append(ts_d)
+    # return meter energy flows of all ts_delivery
+    main_meter_flows = _get_readings_main_meters(db_obj, list_ts_delivery)
+    submeter_flows = db_obj.get_meter_readings_by_type(ts_delivery=min(list_ts_delivery),
+                                                       ts_delivery_last=max(list_ts_delivery),
+                                                       types_meters=[0, 1])
+    submeter_flows = submeter_flows[submeter_flows[db_obj.db_param.TS_DELIVERY].isin(list_ts_delivery)]
+
+    # determine energy exchange across market boundaries
+    df_outside_flow = main_meter_flows.groupby(db_obj.db_param.TS_DELIVERY)[
+        [db_obj.db_param.ENERGY_IN, db_obj.db_param.ENERGY_OUT]].sum()
+    outside_flow = (df_outside_flow[db_obj.db_param.ENERGY_IN] - df_outside_flow[db_obj.db_param.ENERGY_OUT]
+                    ).clip(lower=0)
+
+    ###
+    # Calculate community exchange qualities
+    ###
+    # split up produced energy by quality and assign each submeter to its main meter
+    qualities = submeter_flows[db_obj.db_param.ID_METER].map(map_quality)
+    df_flows = pd.DataFrame({db_obj.db_param.TS_DELIVERY: submeter_flows[db_obj.db_param.TS_DELIVERY],
+                             "id_meter_main": submeter_flows[db_obj.db_param.ID_METER].map(
+                                 map_submeter_to_main).fillna(submeter_flows[db_obj.db_param.ID_METER])})
+    for quality, share_quality in zip(lem_config["types_quality"].values(), list_share_quality):
+        df_flows[share_quality] = submeter_flows[db_obj.db_param.ENERGY_OUT].where(qualities == quality)
+    df_flows[db_obj.db_param.ENERGY_OUT] = submeter_flows[db_obj.db_param.ENERGY_OUT]
+    # group by timestep and main meter and add main meter flows out
+    df_flows = df_flows.groupby([db_obj.db_param.TS_DELIVERY, "id_meter_main"]).sum()
+    energy_out_main_meter = main_meter_flows.set_index([db_obj.db_param.TS_DELIVERY, db_obj.db_param.ID_METER])[
+        db_obj.db_param.ENERGY_OUT].reindex(df_flows.index).to_numpy()
+
+    # make quality flows percentages of the main meter flows out
+    for share_quality in list_share_quality:
+        share = df_flows[share_quality].to_numpy() / df_flows[db_obj.db_param.ENERGY_OUT].to_numpy()
+        df_flows[share_quality] = np.where(share == np.inf, 0, share) * energy_out_main_meter
+    df_flows["energy_out_main_meter"] = energy_out_main_meter
+
+    # sum up over all main meters of each timestep and add flows from outside the market to non-local quality
+    final_qualities = df_flows[list_share_quality + ["energy_out_main_meter"]].fillna(0).groupby(
+        level=db_obj.db_param.TS_DELIVERY).sum()
+    outside_flow = outside_flow.reindex(final_qualities.index).fillna(0)
+    final_qualities[db_obj.db_param.SHARE_QUALITY_ + "na"] += outside_flow
+    final_qualities["energy_out_main_meter"] += outside_flow
+    total_e_out = final_qualities["energy_out_main_meter"].to_numpy()
+    total_e_out = np.where(total_e_out != 0, total_e_out, 0.1)
+    # timesteps without submeter flows are of quality 0
+    for share_quality in list_share_quality:
+        dict_results_ex_post[share_quality] = (final_qualities[share_quality] / total_e_out * 100
+                                               ).reindex(list_ts_delivery).fillna(0).to_numpy()
+
+    ###
+    # Determine community price
+    ###
+    local_share = 1 - dict_results_ex_post[db_obj.db_param.SHARE_QUALITY_ + "na"] / 100  # share of all non-local
+    for type_pricing in lem_config["types_pricing_ex_post"]:
+        lookup_table = dict_lookup_tables[lem_config['types_pricing_ex_post'][type_pricing]]
+        dict_results_ex_post[db_obj.db_param.PRICE_ENERGY_MARKET_ + lem_config['types_pricing_ex_post'][type_pricing]] \
+            = _lookup(local_share, lookup_table["supply_demand_ratio"], lookup_table["price"]) * euro_kwh_to_sigma_wh
 
-        main_meter_flows = db_obj.get_meter_readings_by_type(ts_delivery=ts_d,
-                                                             types_meters=[4, 5])
-        submeter_flows = db_obj.get_meter_readings_by_type(ts_delivery=ts_d,
-                                                           types_meters=[0, 1])
-        # determine energy exchange across market boundaries
-        df_outside_flow = main_meter_flows.groupby("ts_delivery").sum()
-        if len(main_meter_flows):
-            outside_flow = df_outside_flow.iloc[0]["energy_in"] - df_outside_flow.iloc[0]["energy_out"]
-            outside_flow = max(outside_flow, 0)
-        else:
-            outside_flow = 0
-        ###
-        # Calculate community exchange qualities
-        ###
-        # add column containing meter qualities
-        submeter_flows["quality"] = submeter_flows["id_meter"]
-        submeter_flows = submeter_flows.replace({"quality": map_quality})
-        # split up produced energy by quality
-        for quality in lem_config["types_quality"]:
-            submeter_flows.loc[
-                submeter_flows["quality"] == lem_config["types_quality"][quality],
-                db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]] =\
-                submeter_flows["energy_out"]
-
-        # add column containing main meter ids
-        submeter_flows["id_meter_main"] = submeter_flows["id_meter"]
-        submeter_flows = submeter_flows.replace({"id_meter_main": map_submeter_to_main})
-        # group by timestep and main meter
-        submeter_flows = submeter_flows.groupby("id_meter_main").sum()
-        # add main meter flows out
-        submeter_flows["energy_out_main_meter"] = submeter_flows.index
-        map_meter_main_to_energy_out = dict([(i, a) for i, a in zip(main_meter_flows[db_obj.db_param.ID_METER],
-                                                                    main_meter_flows[db_obj.db_param.ENERGY_OUT])])
-        submeter_flows = submeter_flows.replace({"energy_out_main_meter": map_meter_main_to_energy_out})
-
-        # make quality flows percentages
-        for quality in lem_config["types_quality"]:
-            submeter_flows[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]] = \
-                submeter_flows[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]].\
-                div((submeter_flows["energy_out"])).replace(np.inf, 0)*submeter_flows["energy_out_main_meter"]
-
-        final_qualities = submeter_flows.fillna(0).copy()
-        final_qualities["temp"] = 1
-        final_qualities = final_qualities.groupby("temp").sum()
-
-        if len(final_qualities):
-            final_qualities.loc[1, "share_quality_na"] += outside_flow
-            final_qualities.loc[1, "energy_out_main_meter"] += outside_flow
-
-        for quality in lem_config["types_quality"]:
-            q = db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]
-            if len(final_qualities):
-                total_e_out = final_qualities.loc[1, "energy_out_main_meter"] \
-                    if final_qualities.loc[1, "energy_out_main_meter"] != 0 else 0.1
-                quality = final_qualities.loc[1, q] / total_e_out * 100
-            else:
-                quality = 0
-            dict_results_ex_post[q].append(quality)
-
-        ###
-        # Determine community price
-        ###
-        # initialize feed-in and consumption
-        for type_pricing in lem_config["types_pricing_ex_post"]:
-            lookup_supply_ratio = \
-                dict_lookup_tables[lem_config['types_pricing_ex_post'][type_pricing]]["supply_demand_ratio"]
-            lookup_price = \
-                dict_lookup_tables[lem_config['types_pricing_ex_post'][type_pricing]]["price"]
-
-            local_share = 1 - dict_results_ex_post["share_quality_na"][-1]/100    # share of all non-local ("NA")
-            price = _lookup(local_share, lookup_supply_ratio, lookup_price) * euro_kwh_to_sigma_wh
-            dict_results_ex_post[db_obj.db_param.PRICE_ENERGY_MARKET_
-                                 + lem_config['types_pricing_ex_post'][type_pricing]].append(price)
-    if len(list_ts_delivery) and len(dict_results_ex_post[db_obj.db_param.TS_DELIVERY]):
-        db_obj.log_results_market_ex_post(pd.DataFrame(dict_results_ex_post))
+    # keep column order of results table, prices before qualities
+    list_columns = [db_obj.db_param.TS_DELIVERY] \
+        + [db_obj.db_param.PRICE_ENERGY_MARKET_ + lem_config['types_pricing_ex_post'][type_pricing]
+           for type_pricing in lem_config["types_pricing_ex_post"]] + list_share_quality
+    db_obj.log_results_market_ex_post(pd.DataFrame(dict_results_ex_post)[list_columns])
 
 
 def update_balance_ex_post(db_obj, id_retailer, t_now, list_ts_delivery, lem_config):
@@ -611,94 +485,162 @@ def update_balance_ex_post(db_obj, id_retailer, t_now, list_ts_delivery, lem_con
 
     :return None:
     """
-    # get mapping from meter to user
+    _log_transactions(db_obj, get_transactions_ex_post(db_obj=db_obj, t_now=t_now, lem_config=lem_config,
+                                                       list_ts_delivery=list_ts_delivery, id_retailer=id_retailer))
+
+
+def get_transactions_ex_post(db_obj, t_now, lem_config, list_ts_delivery, id_retailer="retailer01"):
+    """
+    Determine the ex-post market transactions of all ts_delivery at once.
+
+    :param db_obj: instance of DatabaseConnection
+    :param t_now: integer, unix timestamp current time
+    :param lem_config: dictionary containing configuration of LEM
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
+    :param id_retailer: string, retailer id, number, as retailer needs to be credited/debited
+
+    :return: DataFrame, transactions of users and retailer, see _build_transactions()
+    """
+    if not len(list_ts_delivery):
+        return None
+    return _calc_transactions_ex_post(_get_charges_ex_post(db_obj, lem_config, list_ts_delivery),
+                                      lem_config=lem_config, t_now=t_now, id_retailer=id_retailer)
+
+
+def update_balance_settlement(db_obj, t_now, lem_config, list_ts_delivery, id_retailer="retailer01", pool=None):
+    """
+    Determine all settlement transactions of the ts_delivery and add them to the database in one pass.
+
+    If an ex-ante market is configured, balancing energy and levies are settled, as trading costs are settled during
+    the ex-ante clearing. Otherwise, the first ex-post market and levies are settled.
+
+    The charges of different main meters are independent once the prices are known. If a process pool is given, the
+    main meters are split into lem_config["settlement_processes"] groups whose transactions are calculated by the
+    pool. All data is queried and all transactions are logged by the calling process, so the workers need no
+    database connection.
+
+    :param db_obj: instance of DatabaseConnection
+    :param t_now: integer, unix timestamp current time
+    :param lem_config: dictionary containing configuration of LEM
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
+    :param id_retailer: string, retailer id, number, as retailer needs to be credited/debited
+    :param pool: multiprocessing.Pool calculating the transactions of the groups of main meters, None to calculate
+                 them in the calling process
+
+    :return None:
+    """
+    if not len(list_ts_delivery):
+        return
+    if lem_config["types_clearing_ex_ante"]:
+        list_charges = [(_calc_transactions_balancing, _get_charges_balancing(db_obj, list_ts_delivery)),
+                        (_calc_transactions_levies, _get_charges_levies(db_obj, list_ts_delivery))]
+    else:
+        list_charges = [(_calc_transactions_ex_post, _get_charges_ex_post(db_obj, lem_config, list_ts_delivery)),
+                        (_calc_transactions_levies, _get_charges_levies(db_obj, list_ts_delivery))]
+
+    n_groups = lem_config.get("settlement_processes", 1) if pool is not None else 1
+    list_inputs = []
+    for calc_transactions, df_charges in list_charges:
+        # all charges of a main meter are in the same group
+        codes_group = pd.factorize(df_charges[db_obj.db_param.ID_METER])[0] % n_groups
+        list_inputs += [(calc_transactions, df_charges[codes_group == group], lem_config, t_now, id_retailer)
+                        for group in range(n_groups)]
+    if pool is not None:
+        list_transactions = pool.starmap(_par_calc_transactions, list_inputs)
+    else:
+        list_transactions = [_par_calc_transactions(*inputs) for inputs in list_inputs]
+    _log_transactions(db_obj, pd.concat(list_transactions, ignore_index=True))
+
+
+def update_balance_late_readings(db_obj, t_now, path_simulation, lem_config, cells_changed,
+                                 id_retailer="retailer01"):
+    """
+    Re-settle the energy deltas of provisionally settled ts_delivery that changed due to late meter readings.
+
+    Only the affected transactions are recomputed: balancing energy and levies of the users whose main meters changed
+    and, as the community price of the ts_delivery changes with any of its meters, the ex-post market transactions of
+    all users of the affected ts_delivery. The difference between the recomputed and the already logged transactions
+    is logged as correcting entries of the same transaction types, so the sum of all entries of a user equals the
+    settlement with the complete readings.
+
+    :param db_obj: instance of DatabaseConnection
+    :param t_now: integer, unix timestamp current time
+    :param path_simulation: string, path to simulation_results folder
+    :param lem_config: dictionary containing configuration of LEM
+    :param cells_changed: DataFrame, ts_delivery and id_meter of the changed energy deltas as returned by
+                          update_complete_meter_readings()
+    :param id_retailer: string, retailer id, number, as retailer needs to be credited/debited
+
+    :return None:
+    """
+    if cells_changed is None or not len(cells_changed):
+        return
+    list_ts_delivery = sorted(int(ts_d) for ts_d in set(cells_changed[db_obj.db_param.TS_DELIVERY]))
+    # users whose main meters changed
+    list_main_meters = db_obj.get_list_main_meters()
     dict_map_to_user = db_obj.get_mapping_to_user()
+    list_users_changed = list(set(
+        cells_changed.loc[cells_changed[db_obj.db_param.ID_METER].isin(list_main_meters), db_obj.db_param.ID_METER]
+        .map(dict_map_to_user)))
+
+    # recompute balancing energy and community prices of the affected ts_delivery
+    if lem_config["types_clearing_ex_post"]:
+        set_community_price(db_obj=db_obj, path_simulation=path_simulation, lem_config=lem_config,
+                            list_ts_delivery=list_ts_delivery)
+    if lem_config["types_clearing_ex_ante"]:
+        determine_balancing_energy(db_obj=db_obj, list_ts_delivery=list_ts_delivery)
+        list_get_transactions = [(get_transactions_balancing, "balancing", list_users_changed),
+                                 (get_transactions_levies, "levies", list_users_changed)]
+    else:
+        list_get_transactions = [(get_transactions_ex_post, "market", None),
+                                 (get_transactions_levies, "levies", list_users_changed)]
+
+    # recomputed and logged transactions of the affected users, the retailer mirrors them
+    logs_transactions = db_obj.get_logs_transactions(ts_delivery_first=min(list_ts_delivery),
+                                                     ts_delivery_last=max(list_ts_delivery))
+    logs_transactions = logs_transactions[logs_transactions[db_obj.db_param.TS_DELIVERY].isin(list_ts_delivery)
+                                          & (logs_transactions[db_obj.db_param.ID_USER] != id_retailer)]
+    list_transactions_new, list_transactions_logged = [], []
+    for get_transactions, type_transaction, list_users in list_get_transactions:
+        transactions_new = get_transactions(db_obj=db_obj, t_now=t_now, lem_config=lem_config,
+                                            list_ts_delivery=list_ts_delivery, id_retailer=id_retailer)
+        transactions_new = transactions_new[transactions_new[db_obj.db_param.ID_USER] != id_retailer]
+        transactions_logged = logs_transactions[logs_transactions[db_obj.db_param.TYPE_TRANSACTION]
+                                                == type_transaction]
+        if list_users is not None:
+            transactions_new = transactions_new[transactions_new[db_obj.db_param.ID_USER].isin(list_users)]
+            transactions_logged = transactions_logged[transactions_logged[db_obj.db_param.ID_USER].isin(list_users)]
+        list_transactions_new.append(transactions_new)
+        list_transactions_logged.append(transactions_logged)
+
+    _log_transactions(db_obj, _get_transactions_correcting(db_obj=db_obj,
+                                                           lem_config=lem_config,
+                                                           transactions_new=pd.concat(list_transactions_new),
+                                                           transactions_logged=pd.concat(list_transactions_logged),
+                                                           t_now=t_now,
+                                                           id_retailer=id_retailer))
+
+
+def set_status_settled(db_obj, list_ts_delivery, list_ts_delivery_provisional=None):
+    """
+    Label all settled ts_delivery as complete in status_settlement with a single upsert.
 
-    # construct transaction dict including dynamic quality columns
-    dict_transactions = {
-        db_obj.db_param.ID_USER: [],
-        db_obj.db_param.TS_DELIVERY: [],
-        db_obj.db_param.PRICE_ENERGY_MARKET: [],
-        db_obj.db_param.TYPE_TRANSACTION: [],
-        db_obj.db_param.QTY_ENERGY: [],
-        db_obj.db_param.DELTA_BALANCE: [],
-        db_obj.db_param.T_UPDATE_BALANCE: [],
-    }
-    for quality in lem_config["types_quality"]:
-        dict_transactions.update({db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]: []})
-
-    for ts_d in list_ts_delivery:
-        # get energy flows and ex-post prices
-        meter_readings_delta = db_obj.get_meter_readings_by_type(ts_delivery=ts_d, types_meters=[4, 5])
-        ex_post_prices = db_obj.get_results_market_ex_post(ts_delivery_first=ts_d)
-        price = int(ex_post_prices[db_obj.db_param.PRICE_ENERGY_MARKET_
-                                   + lem_config['types_pricing_ex_post'][0]])
-        # get qualities of ex-post result for this ts_delivery
-        shares_quality = {}
-        for quality in lem_config["types_quality"]:
-            shares_quality[lem_config["types_quality"][quality]] =\
-                ex_post_prices[db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]][0]
-        # for each main meter reading, update balance
-        for _, entry in meter_readings_delta.iterrows():
-            if entry.loc[db_obj.db_param.ENERGY_OUT] != 0:
-                transaction_value = entry.loc[db_obj.db_param.ENERGY_OUT] * price
-                # credit retailer
-                dict_transactions[db_obj.db_param.ID_USER].append(id_retailer)
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(price)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("market")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(-1 * entry.loc[db_obj.db_param.ENERGY_OUT])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(-1 * transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_
-                                      + lem_config["types_quality"][quality]
-                                      ].append(shares_quality[lem_config["types_quality"][quality]])
-
-                # debit consumer
-                dict_transactions[db_obj.db_param.ID_USER].append(dict_map_to_user[entry.loc[db_obj.db_param.ID_METER]])
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(price)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("market")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(entry.loc[db_obj.db_param.ENERGY_OUT])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_
-                                      + lem_config["types_quality"][quality]
-                                      ].append(shares_quality[lem_config["types_quality"][quality]])
-
-            elif int(entry.loc[db_obj.db_param.ENERGY_IN]) != 0:
-                transaction_value = entry.loc[db_obj.db_param.ENERGY_IN] * price
-                # credit retailer
-                dict_transactions[db_obj.db_param.ID_USER].append(id_retailer)
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(price)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("market")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(entry.loc[db_obj.db_param.ENERGY_IN])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_
-                                      + lem_config["types_quality"][quality]
-                                      ].append(shares_quality[lem_config["types_quality"][quality]])
-
-                # debit consumer
-                dict_transactions[db_obj.db_param.ID_USER].append(dict_map_to_user[entry.loc[db_obj.db_param.ID_METER]])
-                dict_transactions[db_obj.db_param.TS_DELIVERY].append(ts_d)
-                dict_transactions[db_obj.db_param.PRICE_ENERGY_MARKET].append(price)
-                dict_transactions[db_obj.db_param.TYPE_TRANSACTION].append("market")
-                dict_transactions[db_obj.db_param.QTY_ENERGY].append(-1 * entry.loc[db_obj.db_param.ENERGY_IN])
-                dict_transactions[db_obj.db_param.DELTA_BALANCE].append(-1 * transaction_value)
-                dict_transactions[db_obj.db_param.T_UPDATE_BALANCE].append(t_now)
-                for quality in lem_config["types_quality"]:
-                    dict_transactions[db_obj.db_param.SHARE_QUALITY_
-                                      + lem_config["types_quality"][quality]
-                                      ].append(shares_quality[lem_config["types_quality"][quality]])
-    # if any recorded, log transactions to database
-    if len(dict_transactions[db_obj.db_param.ID_USER]):
-        db_obj.log_transactions(pd.DataFrame.from_dict(dict_transactions))
-        db_obj.update_balance_user(pd.DataFrame.from_dict(dict_transactions))
+    :param db_obj: instance of DatabaseConnection
+    :param list_ts_delivery: list of integers, unix timestamps of settled ts_deliveries
+    :param list_ts_delivery_provisional: list of integers, unix timestamps of the settled ts_deliveries with missing
+                                         meter readings, see get_list_ts_delivery_overdue(). Their meter readings
+                                         remain unprocessed, so that late readings are re-settled.
+
+    :return None:
+    """
+    if not len(list_ts_delivery):
+        return
+    db_obj.set_status_settlement(pd.DataFrame().from_dict({
+        db_obj.db_param.TS_DELIVERY: list(list_ts_delivery),
+        db_obj.db_param.STATUS_METER_READINGS_PROCESSED:
+            (~np.isin(list_ts_delivery, list_ts_delivery_provisional or [])).astype(int),
+        db_obj.db_param.STATUS_SETTLEMENT_COMPLETE: [1] * len(list_ts_delivery)
+    }))
 
 
 def get_list_ts_delivery_ready(db_obj):
@@ -716,11 +658,414 @@ def get_list_ts_delivery_ready(db_obj):
                                  ].ts_delivery)
     return list_ts_delivery_ready
 
+
+def get_list_ts_delivery_overdue(db_obj, t_now, wait_max):
+    """
+    Returns list of unsettled timesteps whose meter readings are still incomplete after the maximum waiting time.
+
+    These timesteps are settled provisionally with the readings available. Readings arriving later are re-settled with
+    update_balance_late_readings() until the final cut-off, see close_ts_delivery_provisional().
+
+    :param db_obj: instance of DatabaseConnection
+    :param t_now: integer, unix timestamp current time
+    :param wait_max: integer, seconds after the end of a ts_delivery after which it is settled with missing readings
+
+    :return: list of integers, unix timestamps of the overdue ts_deliveries
+    """
+    df_clearing_log = db_obj.get_status_settlement()
+    return list(df_clearing_log.loc[(df_clearing_log[db_obj.db_param.STATUS_METER_READINGS_PROCESSED] == 0)
+                                    & (df_clearing_log[db_obj.db_param.STATUS_SETTLEMENT_COMPLETE] == 0)
+                                    & (df_clearing_log[db_obj.db_param.TS_DELIVERY] + 900 + wait_max <= t_now)
+                                    ].ts_delivery)
+
+
+def close_ts_delivery_provisional(db_obj, t_now, late_max):
+    """
+    Labels the meter readings of provisionally settled timesteps as processed after the final cut-off for late readings.
+
+    Readings of these timesteps that arrive after the cut-off are not re-settled. Otherwise, timesteps whose missing
+    readings never arrive would be checked for complete readings with every call of update_complete_meter_readings().
+
+    :param db_obj: instance of DatabaseConnection
+    :param t_now: integer, unix timestamp current time
+    :param late_max: integer, seconds after the end of a ts_delivery after which its late readings are not re-settled
+
+    :return: list of integers, unix timestamps of the closed ts_deliveries
+    """
+    df_clearing_log = db_obj.get_status_settlement()
+    list_ts_delivery_closed = [int(ts_d) for ts_d in df_clearing_log.loc[
+        (df_clearing_log[db_obj.db_param.STATUS_METER_READINGS_PROCESSED] == 0)
+        & (df_clearing_log[db_obj.db_param.STATUS_SETTLEMENT_COMPLETE] == 1)
+        & (df_clearing_log[db_obj.db_param.TS_DELIVERY] + 900 + late_max <= t_now)].ts_delivery]
+    if list_ts_delivery_closed:
+        db_obj.set_status_settlement(pd.DataFrame().from_dict({
+            db_obj.db_param.TS_DELIVERY: list_ts_delivery_closed,
+            db_obj.db_param.STATUS_METER_READINGS_PROCESSED: [1] * len(list_ts_delivery_closed),
+            db_obj.db_param.STATUS_SETTLEMENT_COMPLETE: [1] * len(list_ts_delivery_closed)
+        }))
+    return list_ts_delivery_closed
+
 ########################################################################################################################
 # Internal methods and functions
 ########################################################################################################################
 
 
+def _get_charges_balancing(db_obj, list_ts_delivery):
+    """
+    Static internal method:
+    Return the balancing energies of all main meters of the ts_delivery with their users and settlement prices.
+
+    :param db_obj: instance of DatabaseConnection
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
+
+    :return: DataFrame, input of _calc_transactions_balancing()
+    """
+    balancing_energies = db_obj.get_energy_balancing(ts_delivery=min(list_ts_delivery),
+                                                     ts_delivery_last=max(list_ts_delivery))
+    balancing_energies = balancing_energies[balancing_energies[db_obj.db_param.TS_DELIVERY].isin(list_ts_delivery)]
+    return _merge_users(db_obj, _merge_prices_settlement(db_obj, balancing_energies, list_ts_delivery))
+
+
+def _get_charges_levies(db_obj, list_ts_delivery):
+    """
+    Static internal method:
+    Return the energy flows of all main meters of the ts_delivery with their users and settlement prices.
+
+    :param db_obj: instance of DatabaseConnection
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
+
+    :return: DataFrame, input of _calc_transactions_levies()
+    """
+    meter_readings_delta = _get_readings_main_meters(db_obj, list_ts_delivery)
+    return _merge_users(db_obj, _merge_prices_settlement(db_obj, meter_readings_delta, list_ts_delivery))
+
+
+def _get_charges_ex_post(db_obj, lem_config, list_ts_delivery):
+    """
+    Static internal method:
+    Return the energy flows of all main meters of the ts_delivery with their users, ex-post prices and qualities.
+
+    :param db_obj: instance of DatabaseConnection
+    :param lem_config: dictionary containing configuration of LEM
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
+
+    :return: DataFrame, input of _calc_transactions_ex_post()
+    """
+    meter_readings_delta = _get_readings_main_meters(db_obj, list_ts_delivery)
+    ex_post_prices = db_obj.get_results_market_ex_post(ts_delivery_first=min(list_ts_delivery),
+                                                       ts_delivery_last=max(list_ts_delivery))
+    column_price = db_obj.db_param.PRICE_ENERGY_MARKET_ + lem_config['types_pricing_ex_post'][0]
+    list_columns_quality = [db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]
+                            for quality in lem_config["types_quality"]]
+    meter_readings_delta = meter_readings_delta.merge(
+        ex_post_prices[[db_obj.db_param.TS_DELIVERY, column_price] + list_columns_quality],
+        on=db_obj.db_param.TS_DELIVERY, how="left")
+    return _merge_users(db_obj, meter_readings_delta)
+
+
+def _calc_transactions_balancing(balancing_energies, lem_config, t_now, id_retailer):
+    """
+    Static internal method:
+    Calculate the balancing energy transactions. Does not access the database, see update_balance_settlement().
+
+    :param balancing_energies: DataFrame, balancing energies as returned by _get_charges_balancing()
+    :param lem_config: dictionary containing configuration of LEM
+    :param t_now: integer, unix timestamp current time
+    :param id_retailer: string, retailer id
+
+    :return: DataFrame, transactions of users and retailer, see _build_transactions()
+    """
+    energy_pos = balancing_energies[db_p.ENERGY_BALANCING_POSITIVE].to_numpy()
+    energy_neg = balancing_energies[db_p.ENERGY_BALANCING_NEGATIVE].to_numpy()
+    price_pos = balancing_energies[db_p.PRICE_ENERGY_BALANCING_POSITIVE].to_numpy()
+    price_neg = balancing_energies[db_p.PRICE_ENERGY_BALANCING_NEGATIVE].to_numpy()
+    # positive balancing energy is debited at the positive price, otherwise negative balancing energy is credited
+    is_pos = energy_pos != 0
+    price = np.where(is_pos, price_pos, price_neg)
+    qty_energy = np.where(is_pos, energy_pos, -energy_neg)
+    return _build_transactions(lem_config=lem_config,
+                               df_charges=balancing_energies[is_pos | (energy_neg != 0)],
+                               price=price[is_pos | (energy_neg != 0)],
+                               qty_energy=qty_energy[is_pos | (energy_neg != 0)],
+                               delta_balance=-(np.where(is_pos, energy_pos, energy_neg) * price
+                                               )[is_pos | (energy_neg != 0)],
+                               type_transaction="balancing",
+                               t_now=t_now,
+                               id_retailer=id_retailer)
+
+
+def _calc_transactions_levies(meter_readings_delta, lem_config, t_now, id_retailer):
+    """
+    Static internal method:
+    Calculate the levy transactions. Does not access the database, see update_balance_settlement().
+
+    :param meter_readings_delta: DataFrame, main meter energy flows as returned by _get_charges_levies()
+    :param lem_config: dictionary containing configuration of LEM
+    :param t_now: integer, unix timestamp current time
+    :param id_retailer: string, retailer id
+
+    :return: DataFrame, transactions of users and retailer, see _build_transactions()
+    """
+    energy_out = meter_readings_delta[db_p.ENERGY_OUT].to_numpy()
+    energy_in = meter_readings_delta[db_p.ENERGY_IN].to_numpy()
+    levies_pos = meter_readings_delta[db_p.PRICE_ENERGY_LEVIES_POSITIVE].to_numpy()
+    levies_neg = meter_readings_delta[db_p.PRICE_ENERGY_LEVIES_NEGATIVE].to_numpy()
+    # levies are debited for drawn energy, otherwise for fed-in energy
+    is_out = (energy_out != 0) & (levies_pos != 0)
+    is_in = ~is_out & (energy_in != 0) & (levies_neg != 0)
+    price = np.where(is_out, levies_pos, levies_neg)
+    qty_energy = np.where(is_out, energy_out, -energy_in)
+    return _build_transactions(lem_config=lem_config,
+                               df_charges=meter_readings_delta[is_out | is_in],
+                               price=price[is_out | is_in],
+                               qty_energy=qty_energy[is_out | is_in],
+                               delta_balance=-(np.where(is_out, energy_out, energy_in) * price)[is_out | is_in],
+                               type_transaction="levies",
+                               t_now=t_now,
+                               id_retailer=id_retailer)
+
+
+def _calc_transactions_ex_post(meter_readings_delta, lem_config, t_now, id_retailer):
+    """
+    Static internal method:
+    Calculate the ex-post market transactions. Does not access the database, see update_balance_settlement().
+
+    :param meter_readings_delta: DataFrame, main meter energy flows as returned by _get_charges_ex_post()
+    :param lem_config: dictionary containing configuration of LEM
+    :param t_now: integer, unix timestamp current time
+    :param id_retailer: string, retailer id
+
+    :return: DataFrame, transactions of users and retailer, see _build_transactions()
+    """
+    column_price = db_p.PRICE_ENERGY_MARKET_ + lem_config['types_pricing_ex_post'][0]
+    list_columns_quality = [db_p.SHARE_QUALITY_ + lem_config["types_quality"][quality]
+                            for quality in lem_config["types_quality"]]
+    energy_out = meter_readings_delta[db_p.ENERGY_OUT].to_numpy()
+    energy_in = meter_readings_delta[db_p.ENERGY_IN].to_numpy()
+    price = meter_readings_delta[column_price].to_numpy(dtype=np.int64)
+    # drawn energy is bought, otherwise fed-in energy is sold
+    is_out = energy_out != 0
+    is_in = ~is_out & (energy_in != 0)
+    qty_energy = np.where(is_out, energy_out, -energy_in)
+    return _build_transactions(lem_config=lem_config,
+                               df_charges=meter_readings_delta[is_out | is_in],
+                               price=price[is_out | is_in],
+                               qty_energy=qty_energy[is_out | is_in],
+                               delta_balance=(qty_energy * price)[is_out | is_in],
+                               type_transaction="market",
+                               t_now=t_now,
+                               id_retailer=id_retailer,
+                               list_columns_quality=list_columns_quality)
+
+
+def _par_calc_transactions(calc_transactions, df_charges, lem_config, t_now, id_retailer):
+    """
+    Static internal method:
+    Calculate the transactions of a group of main meters, executed by the workers of update_balance_settlement().
+
+    :param calc_transactions: function, one of _calc_transactions_balancing, _levies or _ex_post
+    :param df_charges: DataFrame, charges of the main meters of the group
+    :param lem_config: dictionary containing configuration of LEM
+    :param t_now: integer, unix timestamp current time
+    :param id_retailer: string, retailer id
+
+    :return: DataFrame, transactions of users and retailer
+    """
+    return calc_transactions(df_charges, lem_config=lem_config, t_now=t_now, id_retailer=id_retailer)
+
+
+def _merge_users(db_obj, df_in):
+    """
+    Static internal method:
+    Add the user of the meter of each row.
+
+    :param db_obj: instance of DatabaseConnection
+    :param df_in: DataFrame with an id_meter column
+
+    :return: DataFrame, df_in including the id_user column
+    """
+    df_in = df_in.copy()
+    df_in[db_obj.db_param.ID_USER] = df_in[db_obj.db_param.ID_METER].map(db_obj.get_mapping_to_user())
+    return df_in
+
+
+def _get_readings_main_meters(db_obj, list_ts_delivery):
+    """
+    Return the energy flows of all main meters for the ts_delivery with a single query.
+
+    :param db_obj: instance of DatabaseConnection
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be returned
+
+    :return: DataFrame, meter reading deltas
+    """
+    meter_readings_delta = db_obj.get_meter_readings_by_type(ts_delivery=min(list_ts_delivery),
+                                                             ts_delivery_last=max(list_ts_delivery),
+                                                             types_meters=[4, 5])
+    return meter_readings_delta[meter_readings_delta[db_obj.db_param.TS_DELIVERY].isin(list_ts_delivery)]
+
+
+def _merge_prices_settlement(db_obj, df_in, list_ts_delivery):
+    """
+    Add the settlement prices of the ts_delivery of each row, queried for all ts_delivery at once.
+
+    :param db_obj: instance of DatabaseConnection
+    :param df_in: DataFrame with a ts_delivery column
+    :param list_ts_delivery: list of integers, unix timestamps of ts_deliveries to be processed
+
+    :return: DataFrame, df_in including the settlement price columns
+    """
+    prices_settlement = db_obj.get_prices_settlement(ts_delivery_first=min(list_ts_delivery),
+                                                     ts_delivery_last=max(list_ts_delivery))
+    df_in = df_in.merge(prices_settlement, on=db_obj.db_param.TS_DELIVERY, how="left")
+    list_columns_price = [column for column in prices_settlement.columns if column != db_obj.db_param.TS_DELIVERY]
+    # every ts_delivery to be settled must have settlement prices
+    df_in[list_columns_price] = df_in[list_columns_price].astype(np.int64)
+    return df_in
+
+
+def _build_transactions(lem_config, df_charges, price, qty_energy, delta_balance, type_transaction, t_now,
+                        id_retailer, list_columns_quality=None):
+    """
+    Static internal method:
+    Build the transactions of the users and the retailer for a set of charges, column-wise.
+
+    Each charge results in a transaction of the charged user and an opposite transaction of the retailer. Does not
+    access the database, so it can be executed by the workers of update_balance_settlement().
+
+    :param lem_config: dictionary containing configuration of LEM
+    :param df_charges: DataFrame, one row per charge containing id_user and ts_delivery
+    :param price: array, price of each charge
+    :param qty_energy: array, energy of each charge from the perspective of the user
+    :param delta_balance: array, balance change of each charge from the perspective of the user
+    :param type_transaction: string, type of the transactions, e.g. "balancing"
+    :param t_now: integer, unix timestamp current time
+    :param id_retailer: string, retailer id
+    :param list_columns_quality: list of quality share columns to be taken from df_charges, shares are 0 if None
+
+    :return: DataFrame, transactions in logs_transactions format, retailer and user transaction of a charge in
+             consecutive rows
+    """
+    n_charges = len(df_charges)
+    # interleave the transactions of the retailer and the user
+    df_transactions = pd.DataFrame({
+        db_p.ID_USER: np.column_stack([np.full(n_charges, id_retailer, dtype=object),
+                                       df_charges[db_p.ID_USER].to_numpy(dtype=object)]).ravel(),
+        db_p.TS_DELIVERY: np.repeat(df_charges[db_p.TS_DELIVERY].to_numpy(), 2),
+        db_p.PRICE_ENERGY_MARKET: np.repeat(price, 2),
+        db_p.TYPE_TRANSACTION: type_transaction,
+        db_p.QTY_ENERGY: np.column_stack([-qty_energy, qty_energy]).ravel(),
+        db_p.DELTA_BALANCE: np.column_stack([-delta_balance, delta_balance]).ravel(),
+        db_p.T_UPDATE_BALANCE: t_now,
+    }, index=range(2 * n_charges))
+    for quality in lem_config["types_quality"]:
+        column = db_p.SHARE_QUALITY_ + lem_config["types_quality"][quality]
+        df_transactions[column] = np.repeat(df_charges[column].to_numpy(), 2) \
+            if list_columns_quality is not None and column in list_columns_quality else 0
+    return df_transactions
+
+
+def _log_transactions(db_obj, df_transactions):
+    """
+    Static internal method:
+    Log transactions and update the balances of the users, if any transactions were recorded.
+
+    :param db_obj: instance of DatabaseConnection
+    :param df_transactions: DataFrame of transactions or None
+
+    :return None:
+    """
+    if df_transactions is not None and len(df_transactions):
+        db_obj.log_transactions(df_transactions)
+        db_obj.update_balance_user(df_transactions)
+
+
+def _get_transactions_correcting(db_obj, lem_config, transactions_new, transactions_logged, t_now, id_retailer):
+    """
+    Static internal method:
+    Build correcting entries for the differences between recomputed and logged user transactions.
+
+    The entries are built per user, ts_delivery and transaction type, together with the opposite entries of the
+    retailer. Prices and quality shares are those of the recomputed transactions.
+
+    :param db_obj: instance of DatabaseConnection
+    :param lem_config: dictionary containing configuration of LEM
+    :param transactions_new: DataFrame, recomputed user transactions
+    :param transactions_logged: DataFrame, logged user transactions of the same users, ts_delivery and types
+    :param t_now: integer, unix timestamp current time
+    :param id_retailer: string, retailer id
+
+    :return: DataFrame, correcting transactions in logs_transactions format
+    """
+    list_keys = [db_obj.db_param.ID_USER, db_obj.db_param.TS_DELIVERY, db_obj.db_param.TYPE_TRANSACTION]
+    list_columns_quality = [db_obj.db_param.SHARE_QUALITY_ + lem_config["types_quality"][quality]
+                            for quality in lem_config["types_quality"]]
+    list_columns_sum = [db_obj.db_param.QTY_ENERGY, db_obj.db_param.DELTA_BALANCE]
+    df_new = transactions_new.groupby(list_keys).agg(
+        {**{column: "sum" for column in list_columns_sum},
+         **{column: "first" for column in [db_obj.db_param.PRICE_ENERGY_MARKET] + list_columns_quality}})
+    df_logged = transactions_logged.groupby(list_keys).agg(
+        {**{column: "sum" for column in list_columns_sum}, db_obj.db_param.PRICE_ENERGY_MARKET: "first"})
+    df_corrections = df_new.join(df_logged, how="outer", rsuffix="_logged")
+    df_corrections[list_columns_sum] = df_corrections[list_columns_sum].fillna(0).to_numpy() \
+        - df_corrections[[column + "_logged" for column in list_columns_sum]].fillna(0).to_numpy()
+    # charges that no longer apply are reversed at their logged price
+    df_corrections[db_obj.db_param.PRICE_ENERGY_MARKET] = df_corrections[db_obj.db_param.PRICE_ENERGY_MARKET].fillna(
+        df_corrections[db_obj.db_param.PRICE_ENERGY_MARKET + "_logged"])
+    df_corrections[list_columns_quality] = df_corrections[list_columns_quality].fillna(0)
+    df_corrections = df_corrections[(df_corrections[list_columns_sum] != 0).any(axis=1)].reset_index()
+
+    list_transactions = []
+    for type_transaction, df_charges in df_corrections.groupby(db_obj.db_param.TYPE_TRANSACTION):
+        list_transactions.append(_build_transactions(
+            lem_config=lem_config,
+            df_charges=df_charges,
+            price=df_charges[db_obj.db_param.PRICE_ENERGY_MARKET].to_numpy(dtype=np.int64),
+            qty_energy=df_charges[db_obj.db_param.QTY_ENERGY].to_numpy(dtype=np.int64),
+            delta_balance=df_charges[db_obj.db_param.DELTA_BALANCE].to_numpy(dtype=np.int64),
+            type_transaction=type_transaction,
+            t_now=t_now,
+            id_retailer=id_retailer,
+            list_columns_quality=list_columns_quality))
+    return pd.concat(list_transactions, ignore_index=True) if list_transactions else None
+
+
+def _get_readings_delta(db_obj, array_ts_delivery):
+    """
+    Static internal method:
+    Return the energy deltas of all meters for the ts_delivery with a single query.
+
+    :param db_obj: instance of DatabaseConnection
+    :param array_ts_delivery: array of integers, unix timestamps of ts_deliveries to be returned
+
+    :return: DataFrame, meter reading deltas, None if no ts_delivery is given
+    """
+    if not len(array_ts_delivery):
+        return None
+    meter_readings_delta = db_obj.get_meter_readings_delta(ts_delivery_first=int(np.min(array_ts_delivery)),
+                                                           ts_delivery_last=int(np.max(array_ts_delivery)))
+    return meter_readings_delta[meter_readings_delta[db_obj.db_param.TS_DELIVERY].isin(array_ts_delivery)]
+
+
+def _get_cells_changed(db_obj, df_delta_before, df_delta_after):
+    """
+    Static internal method:
+    Compare two sets of energy deltas and return the meters and ts_delivery whose deltas were added or changed.
+
+    :param db_obj: instance of DatabaseConnection
+    :param df_delta_before: DataFrame, meter reading deltas before the update or None
+    :param df_delta_after: DataFrame, meter reading deltas after the update or None
+
+    :return: DataFrame, ts_delivery and id_meter of the changed deltas
+    """
+    list_keys = [db_obj.db_param.TS_DELIVERY, db_obj.db_param.ID_METER]
+    if df_delta_after is None:
+        return pd.DataFrame(columns=list_keys)
+    df_compare = df_delta_after.merge(df_delta_before, on=list_keys, how="left", suffixes=("", "_before"))
+    is_changed = (df_compare[db_obj.db_param.ENERGY_IN] != df_compare[db_obj.db_param.ENERGY_IN + "_before"]) \
+        | (df_compare[db_obj.db_param.ENERGY_OUT] != df_compare[db_obj.db_param.ENERGY_OUT + "_before"])
+    return df_compare.loc[is_changed, list_keys].reset_index(drop=True)
+
+
 def _get_list_meters_logged(db_obj, ts_delivery):
     """
     Get list of meters that logged a meter reading at the BEGINNING AND END of the ts_delivery being examined
@@ -740,26 +1085,80 @@ def _get_list_meters_logged(db_obj, ts_delivery):
     return list(set(list_logged_before).intersection(list_logged_after))
 
 
+def _get_topology_virtual_meters(db_obj, info_meter, index_meters, array_active):
+    """
+    Static internal method:
+    Compile the meter tree into sparse matrices that map metered flows to the flows of the virtual meters.
+
+    The flow of a virtual submeter is the flow of its supermeter minus the flows of all other submeters of that
+    supermeter. The flow of a virtual supermeter (grid meter) is the sum of the flows of its submeters. Topologies are
+    cached by set of active meters until the meter info is modified through any connection, see
+    DatabaseConnection.version_metadata.
+
+    :param db_obj: instance of DatabaseConnection
+    :param info_meter: DataFrame, info of all registered meters
+    :param index_meters: pandas Index, meter ids defining the columns of the matrices
+    :param array_active: boolean array, True for the rows of info_meter that are active
+
+    :return: tuple, list of active virtual meter ids, sparse matrix of flow coefficients (virtual meters x meters),
+             sparse matrix of the meters that must have logged a reading (virtual meters x meters)
+    """
+    version = (id(db_obj), db_obj.version_metadata.get(db_obj.db_param.NAME_TABLE_INFO_METER, 0))
+    if _cache_topology_meters["version"] != version:
+        _cache_topology_meters["version"] = version
+        _cache_topology_meters["topologies"] = {}
+    key = array_active.tobytes()
+    if key in _cache_topology_meters["topologies"]:
+        return _cache_topology_meters["topologies"][key]
+
+    info_meter_active = info_meter[array_active]
+    dict_submeters = info_meter_active.groupby(db_obj.db_param.ID_METER_SUPER)[db_obj.db_param.ID_METER].apply(list)
+    df_virtual_meters = info_meter_active[info_meter_active[db_obj.db_param.TYPE_METER].str.contains("virtual")]
+    list_virtual_meters = list(df_virtual_meters[db_obj.db_param.ID_METER])
+    list_rows, list_meters, list_coefficients = [], [], []
+    for i, (virtual_meter, supermeter) in enumerate(zip(df_virtual_meters[db_obj.db_param.ID_METER],
+                                                        df_virtual_meters[db_obj.db_param.ID_METER_SUPER])):
+        if supermeter != "0000000000":
+            list_members = [(supermeter, 1)] + [(meter, -1) for meter in dict_submeters.get(supermeter, [])
+                                                if meter != virtual_meter]
+        else:
+            list_members = [(meter, 1) for meter in dict_submeters.get(virtual_meter, [])]
+        for meter, coefficient in list_members:
+            list_rows.append(i)
+            list_meters.append(meter)
+            list_coefficients.append(coefficient)
+    shape = (len(list_virtual_meters), len(index_meters))
+    array_rows = np.array(list_rows, dtype=np.int64)
+    array_columns = index_meters.get_indexer(list_meters).astype(np.int64)
+    matrix_flows = sparse.csr_matrix((np.array(list_coefficients, dtype=np.int64), (array_rows, array_columns)),
+                                     shape=shape)
+    matrix_required = sparse.csr_matrix((np.ones(len(list_rows), dtype=np.int64), (array_rows, array_columns)),
+                                        shape=shape)
+    _cache_topology_meters["topologies"][key] = (list_virtual_meters, matrix_flows, matrix_required)
+    return _cache_topology_meters["topologies"][key]
+
+
 def _lookup(x, x_axis, y_axis):
     """
     Static internal method:
-    Perform lookup on provided table. Find y-value for desired x-value
+    Perform lookup on provided table. Find y-values for desired x-values by linear interpolation
 
-    :param x: x-value to look up
+    :param x: array of x-values to look up
     :param x_axis: x-axis of lookup table
     :param y_axis: y-value of lookup table
 
-    :return: float, y-value corresponding to x-value input
+    :return: array of floats, y-values corresponding to x-value input
     """
-    if x <= x_axis[0]:
-        return y_axis[0]
-    if x >= x_axis[-1]:
-        return y_axis[-1]
-
-    i = bisect_left(x_axis, x)
-    k = (x - x_axis[i - 1]) / (x_axis[i] - x_axis[i - 1])
-    y = k * (y_axis[i] - y_axis[i - 1]) + y_axis[i - 1]
-    return y
+    x = np.asarray(x, dtype=float)
+    x_axis = np.asarray(x_axis, dtype=float)
+    y_axis = np.asarray(y_axis, dtype=float)
+    # index of the first point of the x-axis not smaller than x, kept inside the table for the clipped values
+    i = np.clip(np.searchsorted(x_axis, x, side="left"), 1, len(x_axis) - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k = (x - x_axis[i - 1]) / (x_axis[i] - x_axis[i - 1])
+        y = k * (y_axis[i] - y_axis[i - 1]) + y_axis[i - 1]
+    y = np.where(x >= x_axis[-1], y_axis[-1], y)
+    return np.where(x <= x_axis[0], y_axis[0], y)
 
 
 def _decomp_float(float_in, return_val="pos", dec_places=0):
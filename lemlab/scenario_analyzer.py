@@ -125,13 +125,12 @@ class ScenarioAnalyzer:
         print("*** CREATING PLOT OF VIRTUAL POWERFLOW ***")
 
         # Get IDs of all main meters (1=utility with multiple submeters, 2=utility meter)
-        df_meter_info = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_INFO_METER}.csv", index_col=0)
+        df_meter_info = self.__read_table_snapshot(db_p.NAME_TABLE_INFO_METER)
         list_main_meters = list(df_meter_info[df_meter_info[db_p.TYPE_METER].isin(
             ["grid meter", "virtual grid meter"])][db_p.ID_METER])
 
         # Get power flows of all meters in list_main_meters
-        df_meter_readings_delta = pd.read_csv(f"{self.path_results}/db_snapshot/"
-                                              f"{db_p.NAME_TABLE_READINGS_METER_DELTA}.csv", index_col=0)
+        df_meter_readings_delta = self.__read_table_snapshot(db_p.NAME_TABLE_READINGS_METER_DELTA)
 
         df_results = df_meter_readings_delta[df_meter_readings_delta[db_p.ID_METER].isin(list_main_meters)]
         df_results = df_results.groupby(db_p.TS_DELIVERY).sum() * self.conv_to_kW
@@ -172,13 +171,12 @@ class ScenarioAnalyzer:
         """This function calculates the degree of energy independency of the simulated LEM"""
 
         # Get IDs of all main meters (1=utility with multiple submeters, 2=utility meter)
-        df_meter_info = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_INFO_METER}.csv", index_col=0)
+        df_meter_info = self.__read_table_snapshot(db_p.NAME_TABLE_INFO_METER)
         list_submeters = list(df_meter_info[df_meter_info[db_p.TYPE_METER].isin(
             ["plant submeter", "virtual plant submeter", ""])][db_p.ID_METER])
 
         # Get power flows of all meters in list_main_meters
-        df_meter_readings_delta = pd.read_csv(f"{self.path_results}/db_snapshot/"
-                                              f"{db_p.NAME_TABLE_READINGS_METER_DELTA}.csv", index_col=0)
+        df_meter_readings_delta = self.__read_table_snapshot(db_p.NAME_TABLE_READINGS_METER_DELTA)
 
         df_results1 = df_meter_readings_delta[df_meter_readings_delta[db_p.ID_METER].isin(list_submeters)]
         df_results1 = df_results1.groupby(db_p.TS_DELIVERY).sum()
@@ -193,8 +191,7 @@ class ScenarioAnalyzer:
         list_main_meters = list(df_meter_info[df_meter_info[db_p.TYPE_METER].isin(
             ["grid meter", "virtual grid meter"])][db_p.ID_METER])
         # Get power flows of all meters in list_main_meters
-        df_meter_readings_delta = pd.read_csv(f"{self.path_results}/db_snapshot/"
-                                              f"{db_p.NAME_TABLE_READINGS_METER_DELTA}.csv", index_col=0)
+        df_meter_readings_delta = self.__read_table_snapshot(db_p.NAME_TABLE_READINGS_METER_DELTA)
         df_results = df_meter_readings_delta[df_meter_readings_delta[db_p.ID_METER].isin(list_main_meters)]
         df_results = df_results.groupby(db_p.TS_DELIVERY).sum()
         df_results.columns = ["negative_flow_kW", "positive_flow_kW"]
@@ -264,7 +261,7 @@ class ScenarioAnalyzer:
                                            "cost_bought_€", "balance_€"]).set_index(db_p.ID_USER)
 
         # Look up each participant's main meter id
-        df_meters = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_INFO_METER}.csv", index_col=0, dtype={"id_user": str})
+        df_meters = self.__read_table_snapshot(db_p.NAME_TABLE_INFO_METER, dtype={"id_user": str})
         df_temp = df_meters[df_meters[db_p.TYPE_METER].isin(["grid meter", "virtual grid meter"])]\
             [[db_p.ID_USER, db_p.ID_METER]]
         df_temp.set_index(db_p.ID_USER, inplace=True)
@@ -275,8 +272,7 @@ class ScenarioAnalyzer:
         # Check which market participants have PV, batteries, EVs and heat pumps
         df_results["PV_Bat_EV_HP_Wind_Fix"] = self.pv_bat_ev_hp_wind_fix
         # Sort all the transactions according to the user for the time period max_time
-        df_transactions = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_LOGS_TRANSACTIONS}.csv",
-                                      index_col=0)
+        df_transactions = self.__read_table_snapshot(db_p.NAME_TABLE_LOGS_TRANSACTIONS)
         df_transactions = df_transactions[df_transactions[db_p.TS_DELIVERY] <= self.max_time]
         df_transactions[db_p.DELTA_BALANCE] = df_transactions[db_p.DELTA_BALANCE] * self.conv_to_EUR
         df_temp_pos = df_transactions[df_transactions[db_p.QTY_ENERGY] >= 0]
@@ -388,7 +384,7 @@ class ScenarioAnalyzer:
         print("*** CREATING PLOTS OF EXAMPLE HOUSEHOLD ***")
 
         # Load meter information
-        df_meters = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_INFO_METER}.csv", index_col=0, dtype={"id_user": str})
+        df_meters = self.__read_table_snapshot(db_p.NAME_TABLE_INFO_METER, dtype={"id_user": str})
 
         # Create dataframe to store the information about the participants
         df_users = pd.DataFrame(columns=[db_p.ID_USER, "main_id", "PV_Bat_EV_HP_Wind_Fix"])
@@ -510,8 +506,7 @@ class ScenarioAnalyzer:
                                         "balance_€", "consumption_kWh", "avg_price_€/kWh"]).set_index(db_p.ID_USER)
 
         # Look up each participants main meter id
-        df_meters = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_INFO_METER}.csv", index_col=0,
-                                dtype={"id_user": str})
+        df_meters = self.__read_table_snapshot(db_p.NAME_TABLE_INFO_METER, dtype={"id_user": str})
         df_temp = df_meters[df_meters[db_p.TYPE_METER].isin(["grid meter", "virtual grid meter"])] \
             [[db_p.ID_USER, db_p.ID_METER]]
         df_temp.set_index(db_p.ID_USER, inplace=True)
@@ -523,8 +518,7 @@ class ScenarioAnalyzer:
         df_info["PV_Bat_EV_HP_Wind_Fix"] = self.pv_bat_ev_hp_wind_fix
 
         # Sort all the transactions according to the user for the time period max_time
-        df_transactions = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_LOGS_TRANSACTIONS}.csv",
-                                      index_col=0)
+        df_transactions = self.__read_table_snapshot(db_p.NAME_TABLE_LOGS_TRANSACTIONS)
         df_transactions = df_transactions[df_transactions[db_p.TS_DELIVERY] <= self.max_time]
         df_temp_pos = df_transactions[df_transactions[db_p.QTY_ENERGY] >= 0]
         df_temp_pos = df_temp_pos.groupby(db_p.ID_USER).sum()
@@ -542,8 +536,7 @@ class ScenarioAnalyzer:
         df_info["balance_€"] = df_info["revenue_sold_€"] - df_info["cost_bought_€"]
         df_info["n_participants"] = 1
         # Get the power consumption of every household by checking the submeter's delta readings
-        df_consumption = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_READINGS_METER_DELTA}.csv",
-                                     index_col=0)
+        df_consumption = self.__read_table_snapshot(db_p.NAME_TABLE_READINGS_METER_DELTA)
         df_meters = df_meters.set_index("id_meter")
         df_consumption = df_consumption[df_consumption[db_p.TS_DELIVERY] <= self.max_time].sort_values(db_p.TS_DELIVERY)
         df_consumption = df_consumption.groupby("id_meter").sum()
@@ -667,8 +660,7 @@ class ScenarioAnalyzer:
         """
 
         # Get market data and truncate at maximum simulated time step
-        df_market_results = pd.read_csv(f"{self.path_results}/db_snapshot/results_market_{type_market}.csv",
-                                        index_col=0)
+        df_market_results = self.__read_table_snapshot(f"results_market_{type_market}")
         df_market_results = df_market_results[df_market_results[db_p.TS_DELIVERY] <= self.max_time]
 
         # Dataframe setup with timestamps as indices
@@ -750,8 +742,7 @@ class ScenarioAnalyzer:
         """
 
         # Get market data and truncate at maximum simulated time step
-        df_market_results = pd.read_csv(f"{self.path_results}/db_snapshot/results_market_{type_market}.csv",
-                                        index_col=0)
+        df_market_results = self.__read_table_snapshot(f"results_market_{type_market}")
         df_market_results = df_market_results[df_market_results[db_p.TS_DELIVERY] <= self.max_time]
         df_market_results.set_index(db_p.TS_DELIVERY, inplace=True)
         df_market_results = df_market_results.sort_index()
@@ -810,8 +801,7 @@ class ScenarioAnalyzer:
         """
 
         # Get meter data of example household for each submeter ID
-        df_meter_readings = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_READINGS_METER_DELTA}.csv",
-                                        index_col=0)
+        df_meter_readings = self.__read_table_snapshot(db_p.NAME_TABLE_READINGS_METER_DELTA)
         df_user = df_meter_readings.loc[df_meter_readings[db_p.ID_METER] == id_meter]
         df_user = df_user.set_index(db_p.TS_DELIVERY)
 
@@ -861,8 +851,7 @@ class ScenarioAnalyzer:
         """
 
         # Sort all the transactions according to the user for the time period max_time
-        df_transactions = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_LOGS_TRANSACTIONS}.csv",
-                                      index_col=0)
+        df_transactions = self.__read_table_snapshot(db_p.NAME_TABLE_LOGS_TRANSACTIONS)
         df_transactions = df_transactions[df_transactions[db_p.TS_DELIVERY] <= self.max_time]
         df_temp_revenue = df_transactions[df_transactions[db_p.DELTA_BALANCE] >= 0]
         df_temp_bal_pos = df_transactions[(df_transactions[db_p.DELTA_BALANCE] >= 0) &
@@ -952,8 +941,7 @@ class ScenarioAnalyzer:
         """
 
         # Read and prepare the desired market dataframe
-        df_market_results = pd.read_csv(f"{self.path_results}/db_snapshot/results_market_{type_market}.csv",
-                                        index_col=0)
+        df_market_results = self.__read_table_snapshot(f"results_market_{type_market}")
         df_market_results = df_market_results[df_market_results[db_p.TS_DELIVERY] <= self.max_time]
         df_market_results["costs_€"] = df_market_results[db_p.QTY_ENERGY_TRADED] * df_market_results[column_price] * \
                                        self.conv_to_EUR
@@ -1005,8 +993,7 @@ class ScenarioAnalyzer:
         """
 
         # Read the desired market dataframe
-        df_market_results = pd.read_csv(f"{self.path_results}/db_snapshot/results_market_{type_market}.csv",
-                                        index_col=0)
+        df_market_results = self.__read_table_snapshot(f"results_market_{type_market}")
         df_market_results = df_market_results[df_market_results[db_p.TS_DELIVERY] <= self.max_time]
         df_market_results = df_market_results.sort_index()
 
@@ -1048,8 +1035,7 @@ class ScenarioAnalyzer:
 
         """
 
-        db_settlement_status = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_STATUS_SETTLEMENT}.csv",
-                                           index_col=0)
+        db_settlement_status = self.__read_table_snapshot(db_p.NAME_TABLE_STATUS_SETTLEMENT)
         db_settlement_status = db_settlement_status.sort_values(by=db_p.TS_DELIVERY)
 
         return max(db_settlement_status[db_settlement_status[db_p.STATUS_SETTLEMENT_COMPLETE] == 1][db_p.TS_DELIVERY])
@@ -1065,7 +1051,7 @@ class ScenarioAnalyzer:
         """
 
         # Load meter information
-        df_meters = pd.read_csv(f"{self.path_results}/db_snapshot/{db_p.NAME_TABLE_INFO_METER}.csv", index_col=0, dtype={"id_user": str})
+        df_meters = self.__read_table_snapshot(db_p.NAME_TABLE_INFO_METER, dtype={"id_user": str})
 
         # Prepare temporary dataframe to create tuple column that contains if participants have devices
         df_temp = pd.DataFrame(columns=[db_p.ID_USER, "PV_Bat_EV_HP_Wind_Fix"])
@@ -1111,6 +1097,31 @@ class ScenarioAnalyzer:
 
         return config
 
+    def __read_table_snapshot(self, table_name, dtype=None) -> pd.DataFrame:
+        """reads a table of the database snapshot, saved either as csv or as parquet file(s)
+
+        Args:
+            table_name: string with the name of the table
+            dtype: optional dict with the data types of selected columns
+
+        Returns:
+            df_table: dataframe containing the table contents
+
+        """
+
+        path_table = f"{self.path_results}/db_snapshot/{table_name}"
+        # parquet snapshots are saved as single file or, for tables exported incrementally, as directory. if the
+        # snapshot was saved in several formats, the most recently saved one is read
+        list_paths = [path for path in [f"{path_table}.csv", f"{path_table}.parquet", path_table]
+                      if os.path.exists(path)]
+        path_table = max(list_paths, key=os.path.getmtime)
+        if path_table.endswith(".csv"):
+            return pd.read_csv(path_table, index_col=0, dtype=dtype)
+        df_table = pd.read_parquet(path_table)
+        if dtype is not None:
+            df_table = df_table.astype(dtype)
+        return df_table
+
     def __get_table_columns(self, table_name) -> list:
         """returns a list containing the names of all columns of the provided table
 
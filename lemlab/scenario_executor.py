@@ -10,6 +10,9 @@ import json
 import string
 import shutil
 import os
+import asyncio
+import traceback
+import contextlib
 import multiprocessing as mp
 from random import choice
 from tqdm import tqdm
@@ -18,9 +21,13 @@ import feather as ft
 import numpy as np
 from ruamel.yaml import YAML
 from lemlab.db_connection.db_connection import DatabaseConnection
+from lemlab.db_connection.db_budget import ConnectionBudget, merge_stats_wait
+from lemlab.db_connection.db_connection_async import AsyncDatabaseConnection
+from lemlab.db_connection.db_instrumentation import QueryInstrumentation, merge_metrics, log_metrics
 from lemlab.agents import Prosumer
 from lemlab.agents import Aggregator
 from lemlab.agents import Retailer
+from lemlab.utilities.state_store import StateStore, MemoryStateStore
 import lemlab.lem.clearing_ex_ante as clearing_ex_ante
 import lemlab.lem.settlement as lem_settlement
 import warnings
@@ -94,6 +101,20 @@ class ScenarioExecutor:
         # initialize database connection objects
         self.db_conn_admin = None
         self.db_conn_user = None
+        self.db_conn_user_async = None
+        # connection wait statistics of the parallel workers, by process id
+        self.stats_pool_workers = {}
+        # optional query instrumentation of the database connections, see __setup_instrumentation()
+        self.instrumentation = {}
+        self.metrics_queries_workers = []
+        # optional process pool calculating the settlement of groups of main meters, see __get_pool_settlement()
+        self.pool_settlement = None
+        # time of the last balance snapshot if balances are derived from the transaction logs
+        self.t_snapshot_balances = None
+        # persistent prosumers of real-time simulations by path, simulations keep them in the workers of
+        # _ShardsProsumers. time of their last checkpoint, see __step_checkpoint_agents()
+        self.dict_prosumers = {}
+        self.t_checkpoint_agents = None
         self.config = None
 
     def run(self) -> None:
@@ -141,11 +162,17 @@ class ScenarioExecutor:
         self.step_counter = 0
         # setup database connections required
         self.db_conn_admin = DatabaseConnection(
-            db_dict=self.config["db_connections"]["database_connection_admin"],
+            db_dict=self.__get_db_dict("database_connection_admin"),
             lem_config=self.config["lem"])
         self.db_conn_user = DatabaseConnection(
-            db_dict=self.config["db_connections"]["database_connection_user"],
+            db_dict=self.__get_db_dict("database_connection_user"),
             lem_config=self.config["lem"])
+        # real-time simulations may step their agents concurrently
+        if self.config["simulation"]["rts"] is True and self.config["simulation"].get("rts_async_agents", False):
+            self.db_conn_user_async = AsyncDatabaseConnection(
+                db_conn=self.db_conn_user,
+                max_concurrency=self.__get_async_concurrency())
+        self.__setup_instrumentation()
 
         self.__execute()
 
@@ -163,6 +190,12 @@ class ScenarioExecutor:
         :return: None
 
         """
+        # persistent prosumers of real-time simulations write their configurations to disk
+        for prosumer in self.dict_prosumers.values():
+            prosumer.checkpoint()
+        # the final balances are part of the database snapshot
+        if self.config["lem"].get("balances_ledger", False):
+            self.db_conn_admin.snapshot_balances_user(t_snapshot=self.t_now)
         self.export_database_snapshot()
         with open(f"{self.path_results}/sim_info.json", "r") as read_file:
             dict_sim = json.load(read_file)
@@ -170,8 +203,23 @@ class ScenarioExecutor:
         with open(f"{self.path_results}/sim_info.json", "w+") as write_file:
             json.dump(dict_sim, write_file)
 
+        # save the time spent waiting for database connections, to size the connection budget
+        with open(f"{self.path_results}/stats_db_connections.json", "w+") as write_file:
+            json.dump({"admin": self.db_conn_admin.get_stats_pool(),
+                       "user": self.db_conn_user.get_stats_pool(),
+                       "workers": merge_stats_wait(list(self.stats_pool_workers.values()))},
+                      write_file, indent=4)
+
+        if self.pool_settlement is not None:
+            self.pool_settlement.close()
+            self.pool_settlement.join()
+            self.pool_settlement = None
+
         self.db_conn_admin.end_connection()
-        self.db_conn_user.end_connection()
+        if self.db_conn_user_async is not None:
+            self.db_conn_user_async.end_connection()
+        else:
+            self.db_conn_user.end_connection()
         # exit()
 
     def end_execution(self):
@@ -191,25 +239,34 @@ class ScenarioExecutor:
         with open(f"{self.path_results}/sim_info.json", "w+") as write_file:
             json.dump(dict_sim, write_file)
 
-    def export_database_snapshot(self) -> None:
+    def export_database_snapshot(self, file_format: str = None, incremental: bool = False) -> None:
         """
         Takes a database snapshot of a running simulation/emulation. Called automatically at the end of any simulation.
         Must be called manually if the current state of a real-time emulation is to be plotted using ScenarioAnalyzer
 
         Comment: to use this function for a running real-time emulation, the user should create a new ScenarioExecutor
                 instance using the console, and call "end_execution" on that instance.
+
+        :param file_format: str, "csv" or "parquet", defaults to the simulation setting "db_snapshot_format"
+        :param incremental: bool, parquet only, if True only rows newer than the last snapshot are exported for the
+                            large time series tables
+
+        :return: None
         """
+        with open(f"{self.path_results}/config.yaml") as config_file:
+            config = YAML().load(config_file)
         if self.db_conn_admin is None:
-            with open(f"{self.path_results}/config.yaml") as config_file:
-                config = YAML().load(config_file)
-
             self.db_conn_admin = DatabaseConnection(
-                db_dict=config["db_connections"]["database_connection_admin"],
+                db_dict=ConnectionBudget(config["db_connections"]).get_db_dict("database_connection_admin"),
                 lem_config=config["lem"])
+        if file_format is None:
+            file_format = config["simulation"].get("db_snapshot_format", "csv")
         path_db_results = f"{self.path_results}/db_snapshot"
         # create folder if it doesn't exist, do not delete
         self.__create_folders([[path_db_results, False]])
-        self.db_conn_admin.save_all_tables(path=path_db_results)
+        self.db_conn_admin.save_all_tables(path=path_db_results,
+                                           file_format=file_format,
+                                           incremental=incremental)
 
     # Private methods
 
@@ -248,11 +305,17 @@ class ScenarioExecutor:
 
         # setup database connections required
         self.db_conn_admin = DatabaseConnection(
-            db_dict=self.config["db_connections"]["database_connection_admin"],
+            db_dict=self.__get_db_dict("database_connection_admin"),
             lem_config=self.config["lem"])
         self.db_conn_user = DatabaseConnection(
-            db_dict=self.config["db_connections"]["database_connection_user"],
+            db_dict=self.__get_db_dict("database_connection_user"),
             lem_config=self.config["lem"])
+        # real-time simulations may step their agents concurrently
+        if self.config["simulation"]["rts"] is True and self.config["simulation"].get("rts_async_agents", False):
+            self.db_conn_user_async = AsyncDatabaseConnection(
+                db_conn=self.db_conn_user,
+                max_concurrency=self.__get_async_concurrency())
+        self.__setup_instrumentation()
 
         # check whether a full or partial simulation is desired and delete agents accordingly
         if self.config["simulation"]["rts"] is True:
@@ -280,6 +343,19 @@ class ScenarioExecutor:
         with open(f"{self.path_results}/sim_info.json", "w+") as write_file:
             json.dump({"quit_sim": False, "ts_delivery": None}, write_file)
 
+    def __setup_instrumentation(self) -> None:
+        """
+        Attaches query instrumentation to the admin and user database connections if enabled in the config.
+        The connections of the parallel workers are instrumented in _par_step_prosumers_init().
+
+        :param: None
+
+        :return: None
+        """
+        if self.config["simulation"].get("db_instrumentation", False):
+            self.instrumentation = {"admin": QueryInstrumentation(self.db_conn_admin),
+                                    "user": QueryInstrumentation(self.db_conn_user)}
+
     def __setup_agents(self, t_override=None) -> None:
         """
         Finalizes setup of agents before simulation begins.
@@ -458,6 +534,11 @@ class ScenarioExecutor:
         # initialise database by wiping existing database and resetting tables
         self.db_conn_admin.init_db(clear_tables=True,
                                    reformat_tables=True)
+        # create the partitions of partitioned tables for the first days of the simulation
+        self.db_conn_admin.create_partitions(
+            ts_delivery_first=t_setup - self.config["lem"].get("partition_interval", 86400),
+            ts_delivery_last=t_setup + self.config["lem"]["horizon_clearing"]
+            + self.config["lem"].get("partition_interval", 86400))
 
         # initialize the settlement status database
         # by setting the last delivery timestep before simulation begin to "settled"
@@ -533,10 +614,12 @@ class ScenarioExecutor:
                 self.t_now = round(time.time())
                 if self.t_now > ts_delivery_current + 900:
                     self.t_now = ts_delivery_current + 60
+                self.__refresh_caches()
 
                 # do pre clearing things for prosumers and aggregators
-                self.__step_prosumers_pre()
-                self.__step_aggregator_pre()
+                results_market = self.__prefetch_results_market()
+                self.__step_prosumers_pre(results_market=results_market)
+                self.__step_aggregator_pre(results_market=results_market)
                 self.__step_retailer_pre()
 
                 self.__wait_for_time(target_time=ts_delivery_current + 10*60,
@@ -556,11 +639,14 @@ class ScenarioExecutor:
                     f" market clearing and settlement")
 
                 self.__step_lem()
+                self.__step_maintenance()
 
                 pbar.set_description_str(
                     f"{pd.Timestamp(self.t_now, unit='s', tz=self.config['simulation']['sim_start_tz'])}:"
                     f" agents retrieving market results")
                 self.__step_prosumers_post()
+                self.__step_checkpoint_agents()
+                self.__log_metrics_queries(ts_delivery_current)
 
                 with open(f"{self.path_results}/sim_info.json", "r") as read_file:
                     dict_sim = json.load(read_file)
@@ -586,22 +672,31 @@ class ScenarioExecutor:
 
             # set up multiprocessing pool for prosumer functionality
             # pre-clearing activity is computationally intensive, as it contains utilities and optimization
+            # persistent prosumers are kept by a fixed set of workers instead, each one owning a share of them
 
-            # number of parallel processes should not exceed the number of prosumers being simulated
-            # initializing processes is expensive
-            num_par_processes = min(len(self.__get_active_prosumers()), mp.cpu_count())
-            # num_par_processes = 32
-
-            with mp.Pool(initializer=_par_step_prosumers_init,
-                         initargs=(_par_step_prosumers_pre,
-                                   self.config,
-                                   path_weather),
-                         processes=num_par_processes
-                         ) as pool:
+            num_par_processes = self.__get_num_par_processes()
+            agents_persistent = self.config["simulation"].get("agents_persistent", False)
+
+            if agents_persistent:
+                pool = _ShardsProsumers(list_paths_prosumers=self.__get_list_paths_prosumers(),
+                                        num_processes=num_par_processes,
+                                        config=self.config,
+                                        path_weather=path_weather,
+                                        db_dict=self.__get_db_dict("database_connection_user"))
+            else:
+                pool = mp.Pool(initializer=_par_step_prosumers_init,
+                               initargs=(_par_step_prosumers_pre,
+                                         self.config,
+                                         path_weather,
+                                         self.__get_db_dict("database_connection_user")),
+                               processes=num_par_processes)
+
+            with pool:
                 # main simulation loop, step from ts_delivery start to end
                 while ts_delivery_current <= ts_delivery_end:
                     # at one minute past the quarter-hour:
                     self.t_now = ts_delivery_current + 60
+                    self.__refresh_caches()
                     # set new label on progress bar
                     str_time = \
                         f"Simulating timestep #{self.step_counter} at " \
@@ -611,8 +706,11 @@ class ScenarioExecutor:
                     # perform pre-clearing activities for prosumers, aggregators, retailer
                     # pre-clearing includes real-time controllers, logging of meter values, utilities,
                     # model predictive control and posting bids to the market
-                    pool.map(_par_step_prosumers_pre,
-                             self.__gen_par_step_prosumers_pre_input())
+                    if agents_persistent:
+                        results_workers = pool.pre_clearing_activity(self.__gen_par_step_prosumers_pre_input())
+                    else:
+                        results_workers = pool.map(_par_step_prosumers_pre, self.__gen_par_step_prosumers_pre_input())
+                    self.__collect_stats_workers(results_workers)
                     self.__step_aggregator_pre()
                     self.__step_retailer_pre()
 
@@ -621,10 +719,17 @@ class ScenarioExecutor:
                     # 1: market clearing (if ex-ante market) and market settlement
                     pbar.set_description(f"{str_time}: {'Market clearing and settlement'.ljust(str_len)}")
                     self.__step_lem()
+                    self.__step_maintenance()
                     # 2: prosumers check market results
                     pbar.set_description(f"{str_time}: {'Checking of market results'.ljust(str_len)}")
                     pbar.update()
-                    self.__step_prosumers_post()
+                    if agents_persistent:
+                        self.__collect_stats_workers(
+                            pool.post_clearing_activity(self.__gen_par_step_prosumers_pre_input()))
+                        self.__step_checkpoint_agents(shards_prosumers=pool)
+                    else:
+                        self.__step_prosumers_post()
+                    self.__log_metrics_queries(ts_delivery_current)
                     # increment ts_delivery and step_counter
                     ts_delivery_current += 900
                     self.step_counter += 1
@@ -636,6 +741,19 @@ class ScenarioExecutor:
         else:
             print("Error: parameter 'simulation' 'real-time' must be True or False")
 
+    def __refresh_caches(self) -> None:
+        """
+        Drops the cached metadata lookups of the executor's database connections that were outdated by registrations
+        or preference updates made through other connections. Called once per step, see
+        DatabaseConnection.refresh_cache().
+
+        :param: None
+
+        :return: None
+        """
+        self.db_conn_admin.refresh_cache()
+        self.db_conn_user.refresh_cache()
+
     # agent pre-clearing activities
 
     def __step_retailer_pre(self, clear_positions=False):
@@ -653,13 +771,13 @@ class ScenarioExecutor:
             retailer.pre_clearing_activity(db_obj=self.db_conn_user,
                                            clear_positions=clear_positions)
 
-    def __step_aggregator_pre(self, clear_positions=False):
+    def __step_aggregator_pre(self, clear_positions=False, results_market=None):
         """
         Performs pre-clearing activities for all aggregators in the simulation.
         New instances are instantiated and Aggregator.pre_clearing_activity() is
         executed for each.
 
-        :param: None
+        :param results_market: dict, prefetched ex-ante market results, see __prefetch_results_market()
 
         :return: None
         """
@@ -667,9 +785,10 @@ class ScenarioExecutor:
         for aggregator in list_aggregators:
             aggregator.pre_clearing_activity(
                 db_obj=self.db_conn_user,
-                clear_positions=clear_positions)
+                clear_positions=clear_positions,
+                results_market=results_market)
 
-    def __step_prosumers_pre(self, clear_positions=False):
+    def __step_prosumers_pre(self, clear_positions=False, results_market=None):
         """
         Performs pre-clearing activities for all prosumers in the simulation.
         New instances are instantiated and Prosumer.pre_clearing_activity() is
@@ -678,14 +797,43 @@ class ScenarioExecutor:
         Used for real-time emulations only, as simulations are conducted using
         scenario_executor._par_step_prosumers_pre().
 
-        :param: None
+        :param results_market: dict, prefetched ex-ante market results, see __prefetch_results_market()
 
         :return: None
         """
         list_prosumers = self.__get_active_prosumers()
+        if self.db_conn_user_async is not None:
+            asyncio.run(self.db_conn_user_async.gather(
+                [(prosumer.pre_clearing_activity, {"db_obj": self.db_conn_user, "clear_positions": clear_positions,
+                                                   "results_market": results_market})
+                 for prosumer in list_prosumers]))
+            return
         for prosumer in list_prosumers:
             prosumer.pre_clearing_activity(db_obj=self.db_conn_user,
-                                           clear_positions=clear_positions)
+                                           clear_positions=clear_positions,
+                                           results_market=results_market)
+
+    def __prefetch_results_market(self):
+        """
+        Retrieves the ex-ante market results of all market agents with a single query, instead of one query per
+        agent. The queried delivery period covers the previous time step and the longest trading horizon of all
+        agents, so each agent can select its own results from the prefetched ones.
+
+        :param: None
+
+        :return: dict, market results by id_market_agent, None if no ex-ante market is configured
+        """
+        if not self.config["lem"]["types_clearing_ex_ante"]:
+            return None
+        info_user = self.db_conn_user.get_info_user(balances=False)
+        if info_user.empty:
+            return {}
+        ts_delivery_prev = round(pd.Timestamp(self.t_now, unit="s").floor("15min").timestamp() - 900)
+        horizon_trading = int(info_user[self.db_conn_user.db_param.HORIZON_TRADING].max())
+        return self.db_conn_user.get_results_market_ex_ante_by_user(
+            list_id_user=list(info_user[self.db_conn_user.db_param.ID_MARKET_AGENT]),
+            ts_delivery_first=ts_delivery_prev,
+            ts_delivery_last=ts_delivery_prev + 900 + horizon_trading * 900)
 
     def __gen_par_step_prosumers_pre_input(self):
         """
@@ -694,11 +842,16 @@ class ScenarioExecutor:
         New instances are instantiated and prosumer.pre_clearing_activity() is
         executed for each.
 
+        Persistent prosumers receive the same inputs for their pre- and post-clearing activities, see
+        _ShardsProsumers.
+
         :param: None
 
         :return: list of dicts: A dict for each prosumer containing:
-                                path prosumer -- str - a path to the prosumer's directory
-                                t_now         -- int - the current simulation time to be used by the parallel process
+                                path prosumer  -- str - a path to the prosumer's directory
+                                t_now          -- int - the current simulation time to be used by the parallel process
+                                results_market -- dict - the prefetched market results of the prosumer, None if no
+                                                  ex-ante market is configured
         """
         # get list all prosumers in the simulation
         if self.config["simulation"]["agents_active"]:
@@ -706,11 +859,24 @@ class ScenarioExecutor:
         else:
             list_paths_prosumers = []
 
+        # prefetch the market results of all prosumers, each worker only receives the results of its prosumer
+        results_market = self.__prefetch_results_market() if list_paths_prosumers else None
+        dict_id_market_agent = {}
+        if results_market is not None:
+            info_user = self.db_conn_user.get_info_user(balances=False)
+            dict_id_market_agent = dict(zip(info_user[self.db_conn_user.db_param.ID_USER],
+                                            info_user[self.db_conn_user.db_param.ID_MARKET_AGENT]))
+
         list_par_inputs = []
         # generate input list for parallel processing of prosumers
         for i, _ in enumerate(list_paths_prosumers):
+            results_market_prosumer = None
+            if list_paths_prosumers[i] in dict_id_market_agent:
+                id_market_agent = dict_id_market_agent[list_paths_prosumers[i]]
+                results_market_prosumer = {id_market_agent: results_market[id_market_agent]}
             list_par_inputs.append({"path_prosumer": self.path_results + "/prosumer/" + list_paths_prosumers[i],
-                                    "t_now": self.t_now})
+                                    "t_now": self.t_now,
+                                    "results_market": results_market_prosumer})
         return list_par_inputs
 
     # agent-post-clearing activities
@@ -725,8 +891,28 @@ class ScenarioExecutor:
 
         :return: None
         """
+        results_market = self.__prefetch_results_market()
+        if self.db_conn_user_async is not None:
+            asyncio.run(self.db_conn_user_async.gather(
+                [(prosumer.post_clearing_activity, {"db_obj": self.db_conn_user, "results_market": results_market})
+                 for prosumer in self.__get_active_prosumers()]))
+            return
         for prosumer in self.__get_active_prosumers():
-            prosumer.post_clearing_activity(db_obj=self.db_conn_user)
+            prosumer.post_clearing_activity(db_obj=self.db_conn_user, results_market=results_market)
+
+    def __collect_stats_workers(self, results_workers) -> None:
+        """
+        Collects the connection wait statistics and query metrics returned by the parallel prosumer workers.
+
+        :param results_workers: iterable of tuples, process id, connection wait statistics and query metrics of a
+                                worker, see _par_step_prosumers_pre()
+
+        :return: None
+        """
+        for pid, stats_pool, metrics_queries in results_workers:
+            self.stats_pool_workers[pid] = stats_pool
+            if metrics_queries is not None:
+                self.metrics_queries_workers.append(metrics_queries)
 
     # step lem
 
@@ -743,82 +929,196 @@ class ScenarioExecutor:
 
         :return: None
         """
-        # initialize new settlement status for current ts_delivery
-        dict_status = {
-            self.db_conn_admin.db_param.TS_DELIVERY: [self.t_now - self.t_now % 900],
-            self.db_conn_admin.db_param.STATUS_METER_READINGS_PROCESSED: [0],
-            self.db_conn_admin.db_param.STATUS_SETTLEMENT_COMPLETE: [0]
-        }
-        self.db_conn_admin.set_status_settlement(pd.DataFrame().from_dict(dict_status))
+        # partitions are created one interval ahead of the clearing horizon, so no rows are written to the
+        # default partition
+        self.db_conn_admin.create_partitions(
+            ts_delivery_first=self.t_now,
+            ts_delivery_last=self.t_now + self.config["lem"]["horizon_clearing"]
+            + self.config["lem"].get("partition_interval", 86400))
+
+        # all writes of clearing and settlement are committed together at the end of the step if the unit of work is
+        # enabled, each phase is a savepoint
+        with self.__transaction_step():
+            with self.__transaction_step(savepoint=True):
+                # initialize new settlement status for current ts_delivery
+                dict_status = {
+                    self.db_conn_admin.db_param.TS_DELIVERY: [self.t_now - self.t_now % 900],
+                    self.db_conn_admin.db_param.STATUS_METER_READINGS_PROCESSED: [0],
+                    self.db_conn_admin.db_param.STATUS_SETTLEMENT_COMPLETE: [0]
+                }
+                self.db_conn_admin.set_status_settlement(pd.DataFrame().from_dict(dict_status))
+
+                # check for which ts_delivery ALL meter readings have been logged, calculate energy deltas for each
+                # meter label processed steps in status_settlement. deltas of provisionally settled steps changed by
+                # late readings are returned for re-settlement
+                cells_changed = lem_settlement.update_complete_meter_readings(db_obj=self.db_conn_admin)
+                # provisionally settled steps whose readings are still incomplete after the final cut-off are
+                # closed, their late readings are no longer re-settled
+                late_max = self.config["lem"].get("settlement_late_max", 86400)
+                if late_max is not None:
+                    lem_settlement.close_ts_delivery_provisional(db_obj=self.db_conn_admin,
+                                                                 t_now=self.t_now,
+                                                                 late_max=late_max)
+
+                # set settlement prices for current simulation ts_delivery in database, as agents need these for their
+                # naive forecasts
+                # TODO: adjust agent forecasts so this step is unnecessary
+                # TODO: add option of posting settlement prices in advance, useful for time-varying tariffs
+                lem_settlement.set_prices_settlement(db_obj=self.db_conn_admin,
+                                                     path_simulation=self.path_results,
+                                                     list_ts_delivery=[self.t_now - self.t_now % 900])
+                # generate list of ts_delivery that are ready to be settled (i.e. (his means meter readings have been
+                # processed)
+                list_ts_delivery_ready = lem_settlement.get_list_ts_delivery_ready(db_obj=self.db_conn_admin)
+                # if a maximum waiting time for meter readings is set, overdue steps are settled provisionally with
+                # the readings available
+                list_ts_delivery_provisional = []
+                if self.config["lem"].get("settlement_wait_max") is not None:
+                    list_ts_delivery_provisional = lem_settlement.get_list_ts_delivery_overdue(
+                        db_obj=self.db_conn_admin,
+                        t_now=self.t_now,
+                        wait_max=self.config["lem"]["settlement_wait_max"])
+                    list_ts_delivery_ready = sorted(list_ts_delivery_ready + list_ts_delivery_provisional)
+                # in some simulations, some plant have no physical meters. Their power flow must be implicitly
+                # calculated and assigned to a virtual meter.
+
+            with self.__transaction_step(savepoint=True):
+                # if ex-ante market selected, clear market
+                if self.config["lem"]["types_clearing_ex_ante"]:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore")
+                        clearing_ex_ante.market_clearing(db_obj=self.db_conn_admin,
+                                                         config_lem=self.config["lem"],
+                                                         t_override=self.t_now)
+                # if ex-post markets are to be calculated, this is done here
+                if self.config["lem"]["types_clearing_ex_post"]:
+                    lem_settlement.set_community_price(db_obj=self.db_conn_admin,
+                                                       path_simulation=self.path_results,
+                                                       lem_config=self.config["lem"],
+                                                       list_ts_delivery=list_ts_delivery_ready)
+
+            with self.__transaction_step(savepoint=True):
+                # final transaction settlement is performed now
+                # only one market can be settled. This is the first ex-ante market listed,
+                # if none is listed, the first ex-post is chosen
+                if self.config["lem"]["types_clearing_ex_ante"]:
+                    # determine balancing energy flows
+                    lem_settlement.determine_balancing_energy(db_obj=self.db_conn_admin,
+                                                              list_ts_delivery=list_ts_delivery_ready)
+                # settle balancing energy costs (trading costs were cleared in clearing_ex_ante.py) or ex-post market
+                # costs and levies with each user in one pass
+                lem_settlement.update_balance_settlement(db_obj=self.db_conn_admin,
+                                                         list_ts_delivery=list_ts_delivery_ready,
+                                                         lem_config=self.config["lem"],
+                                                         t_now=self.t_now,
+                                                         id_retailer=self.config["retailer"]["id_user"],
+                                                         pool=self.__get_pool_settlement())
+                # late readings of provisionally settled steps are settled with correcting transactions
+                lem_settlement.update_balance_late_readings(db_obj=self.db_conn_admin,
+                                                            t_now=self.t_now,
+                                                            path_simulation=self.path_results,
+                                                            lem_config=self.config["lem"],
+                                                            cells_changed=cells_changed,
+                                                            id_retailer=self.config["retailer"]["id_user"])
+
+            with self.__transaction_step(savepoint=True):
+                # label all settled ts_delivery as complete
+                lem_settlement.set_status_settled(db_obj=self.db_conn_admin,
+                                                  list_ts_delivery=list_ts_delivery_ready,
+                                                  list_ts_delivery_provisional=list_ts_delivery_provisional)
 
-        # check for which ts_delivery ALL meter readings have been logged, calculate energy deltas for each meter
-        # label processed steps in status_settlement
-        lem_settlement.update_complete_meter_readings(db_obj=self.db_conn_admin)
+    def __transaction_step(self, savepoint=False):
+        """
+        Returns the context in which the writes of a simulation step are executed.
 
-        # set settlement prices for current simulation ts_delivery in database, as agents need these for their naive
-        # forecasts
-        # TODO: adjust agent forecasts so this step is unnecessary
-        # TODO: add option of posting settlement prices in advance, useful for time-varying tariffs
-        lem_settlement.set_prices_settlement(db_obj=self.db_conn_admin,
-                                             path_simulation=self.path_results,
-                                             list_ts_delivery=[self.t_now - self.t_now % 900])
-        # generate list of ts_delivery that are ready to be settled (i.e. (his means meter readings have been processed)
-        list_ts_delivery_ready = lem_settlement.get_list_ts_delivery_ready(db_obj=self.db_conn_admin)
-        # in some simulations, some plant have no physical meters. Their power flow must be implicitly calculated and
-        # assigned to a virtual meter.
-
-        # if ex-ante market selected, clear market
-        if self.config["lem"]["types_clearing_ex_ante"]:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                clearing_ex_ante.market_clearing(db_obj=self.db_conn_admin,
-                                                 config_lem=self.config["lem"],
-                                                 t_override=self.t_now)
-        # if ex-post markets are to be calculated, this is done here
-        if self.config["lem"]["types_clearing_ex_post"]:
-            lem_settlement.set_community_price(db_obj=self.db_conn_admin,
-                                               path_simulation=self.path_results,
-                                               lem_config=self.config["lem"],
-                                               list_ts_delivery=list_ts_delivery_ready)
-
-        # final transaction settlement is performed now
-        # only one market can be settled. This is the first ex-ante market listed,
-        # if none is listed, the first ex-post is chosen
-        if self.config["lem"]["types_clearing_ex_ante"]:
-            # determine balancing energy flows
-            lem_settlement.determine_balancing_energy(db_obj=self.db_conn_admin,
-                                                      list_ts_delivery=list_ts_delivery_ready)
-            # settle balancing energy costs with each user, trading costs were cleared in clearing_ex_ante.py
-            lem_settlement.update_balance_balancing_costs(db_obj=self.db_conn_admin,
-                                                          list_ts_delivery=list_ts_delivery_ready,
-                                                          lem_config=self.config["lem"],
-                                                          t_now=self.t_now,
-                                                          id_retailer=self.config["retailer"]["id_user"])
-        else:
-            lem_settlement.update_balance_ex_post(db_obj=self.db_conn_admin,
-                                                  id_retailer=self.config["retailer"]["id_user"],
-                                                  lem_config=self.config["lem"],
-                                                  list_ts_delivery=list_ts_delivery_ready,
-                                                  t_now=self.t_now)
-        # levy costs are determined based on
-        # settle levy costs with each user
-        lem_settlement.update_balance_levies(db_obj=self.db_conn_admin,
-                                             list_ts_delivery=list_ts_delivery_ready,
-                                             lem_config=self.config["lem"],
-                                             t_now=self.t_now,
-                                             id_retailer=self.config["retailer"]["id_user"])
-
-        # initialize new settlement status for current ts_delivery
-        for ts_d in list_ts_delivery_ready:
-            dict_status = {
-                self.db_conn_admin.db_param.TS_DELIVERY: [ts_d],
-                self.db_conn_admin.db_param.STATUS_METER_READINGS_PROCESSED: [1],
-                self.db_conn_admin.db_param.STATUS_SETTLEMENT_COMPLETE: [1]
-            }
-            self.db_conn_admin.set_status_settlement(pd.DataFrame().from_dict(dict_status))
+        If 'db_unit_of_work' is enabled in the simulation config, the step is one unit of work of the admin connection
+        and its phases are savepoints, see DatabaseConnection.unit_of_work(). Otherwise, every write is committed on
+        its own.
+
+        :param savepoint: bool, if True, the context of a phase within the step is returned
+
+        :return: context manager
+        """
+        if not self.config["simulation"].get("db_unit_of_work", False):
+            return contextlib.nullcontext()
+        if savepoint:
+            return self.db_conn_admin.savepoint()
+        return self.db_conn_admin.unit_of_work()
+
+    def __step_maintenance(self) -> None:
+        """
+        Performs database maintenance that is bounded in time per step.
+
+        Archived positions of delivery periods older than the retention period are compacted into the summary table
+        or moved to cold files, see DatabaseConnection.compact_positions_archive(). If the time limit is reached,
+        compaction is continued in the following steps.
+
+        If balances are derived from the transaction logs, a balance snapshot is taken every
+        interval_snapshot_balances, so the transactions to be summed up for the current balances stay few.
+
+        :param: None
+
+        :return: None
+        """
+        if self.config["lem"].get("balances_ledger", False) and (
+                self.t_snapshot_balances is None
+                or self.t_now - self.t_snapshot_balances >= self.config["lem"].get("interval_snapshot_balances",
+                                                                                   86400)):
+            self.db_conn_admin.snapshot_balances_user(t_snapshot=self.t_now)
+            self.t_snapshot_balances = self.t_now
+        if self.config["lem"].get("archive_retention") is None:
+            return
+        self.db_conn_admin.compact_positions_archive(
+            ts_delivery_before=self.t_now - self.t_now % 900 - self.config["lem"]["archive_retention"],
+            mode=self.config["lem"].get("archive_compaction", "summary"),
+            path_cold=f"{self.path_results}/db_cold",
+            t_max=self.config["lem"].get("archive_compaction_t_max", 1))
+
+    def __step_checkpoint_agents(self, shards_prosumers=None) -> None:
+        """
+        Writes the configurations of persistent prosumers to disk every interval_checkpoint_agents, so a simulation
+        can be inspected or restarted from the prosumer directories while it is running.
+
+        The first call only starts the interval. The final checkpoint is written at the end of the execution.
+
+        :param shards_prosumers: _ShardsProsumers, workers keeping the persistent prosumers of a simulation, None for
+                                 real-time simulations, whose prosumers are kept in dict_prosumers
+
+        :return: None
+        """
+        if self.t_checkpoint_agents is None:
+            self.t_checkpoint_agents = self.t_now
+            return
+        if self.t_now - self.t_checkpoint_agents < self.config["simulation"].get("interval_checkpoint_agents", 86400):
+            return
+        if shards_prosumers is not None:
+            shards_prosumers.checkpoint()
+        for prosumer in self.dict_prosumers.values():
+            prosumer.checkpoint()
+        self.t_checkpoint_agents = self.t_now
 
     # auxiliary methods
 
+    def __log_metrics_queries(self, ts_delivery) -> None:
+        """
+        Appends the query metrics of the current step to stats_db_queries.jsonl in the results directory, if query
+        instrumentation is enabled.
+
+        :param ts_delivery: int, delivery period of the current step
+
+        :return: None
+        """
+        if not self.instrumentation:
+            return
+        dict_metrics = {name: instrumentation.pop_metrics() for name, instrumentation in self.instrumentation.items()}
+        if self.metrics_queries_workers:
+            dict_metrics["workers"] = merge_metrics(self.metrics_queries_workers)
+            self.metrics_queries_workers = []
+        log_metrics(path=f"{self.path_results}/stats_db_queries.jsonl",
+                    dict_metrics=dict_metrics,
+                    step=self.step_counter,
+                    ts_delivery=int(ts_delivery))
+
     def __wait_for_time(self, target_time, progress_bar, reason, offset=0):
         """
         Waits for a target time before allowing the simulation to continue. Regularly updates the progress bar while
@@ -855,6 +1155,73 @@ class ScenarioExecutor:
                 progress_bar.close()
                 self.__end_execution()
 
+    def __get_num_par_processes(self) -> int:
+        """
+        Returns the number of parallel processes used for the prosumer pre-clearing activities of simulations.
+
+        :param: None
+
+        :return: int, number of processes
+        """
+        # number of parallel processes should not exceed the number of prosumers being simulated
+        # initializing processes is expensive
+        if self.config["simulation"]["agents_active"]:
+            return min(len(os.listdir(self.path_results + "/prosumer")), mp.cpu_count())
+        return 0
+
+    def __get_pool_settlement(self):
+        """
+        Returns the process pool calculating the settlement of groups of main meters, created on first use.
+
+        The workers only calculate transactions and need no database connection, see
+        settlement.update_balance_settlement().
+
+        :param: None
+
+        :return: multiprocessing.Pool, None if settlement_processes is not larger than 1
+        """
+        num_processes = self.config["lem"].get("settlement_processes", 1)
+        if self.pool_settlement is None and num_processes > 1:
+            self.pool_settlement = mp.Pool(processes=min(num_processes, mp.cpu_count()))
+        return self.pool_settlement
+
+    def __get_db_dict(self, name_connection) -> dict:
+        """
+        Returns the connection dict for a DatabaseConnection with its share of the connection budget.
+
+        The budget is shared by the admin and user connections of the executor and, for simulations, by the
+        user connection of each parallel worker.
+
+        :param name_connection: str, key of the connection in the db_connections section of the config
+
+        :return: dict, connection dict
+        """
+        n_engines = 2
+        if self.config["simulation"]["rts"] is not True:
+            n_engines += self.__get_num_par_processes()
+        return ConnectionBudget(self.config["db_connections"]).get_db_dict(name_connection, n_engines=n_engines)
+
+    def __get_async_concurrency(self) -> int:
+        """
+        Returns the number of agents stepped concurrently in real-time simulations.
+
+        Every agent stepped concurrently holds a connection of the user pool. The configured concurrency is capped at
+        the connections the user pool may open within the connection budget, so agents do not block each other
+        waiting for connections.
+
+        :return: int, number of threads of the AsyncDatabaseConnection
+        """
+        max_concurrency = self.config["simulation"].get("rts_async_concurrency", 10)
+        db_dict = self.__get_db_dict("database_connection_user")
+        if db_dict.get("mode_pool", "queue") == "queue" and "pool_size" in db_dict:
+            max_connections_pool = db_dict["pool_size"] + db_dict.get("max_overflow", 0)
+            if max_concurrency > max_connections_pool:
+                warnings.warn(f"rts_async_concurrency of {max_concurrency} exceeds the {max_connections_pool} "
+                              f"connections of the user pool within the connection budget. Only "
+                              f"{max_connections_pool} agents are stepped concurrently.")
+                max_concurrency = max_connections_pool
+        return max_concurrency
+
     def __get_active_prosumers(self) -> list:
         """
         Returns list of active prosumers in the simulation.
@@ -863,16 +1230,34 @@ class ScenarioExecutor:
 
         :return: list, instances of Prosumer class
         """
-        if self.config["simulation"]["agents_active"]:
-            list_prosumers = os.listdir(self.path_results + "/prosumer")
-        else:
-            list_prosumers = []
+        if not self.config["simulation"].get("agents_persistent", False):
+            return [Prosumer(path=path_prosumer, t_override=self.t_now)
+                    for path_prosumer in self.__get_list_paths_prosumers()]
+        # persistent prosumers are created once and advanced to the current time in the following steps
         list_prosumer_obj = []
-        for prosumer in list_prosumers:
-            list_prosumer_obj.append(Prosumer(path=f"{self.path_results}/prosumer/{prosumer}",
-                                              t_override=self.t_now))
+        for path_prosumer in self.__get_list_paths_prosumers():
+            if path_prosumer in self.dict_prosumers:
+                self.dict_prosumers[path_prosumer].set_time(t_override=self.t_now)
+            else:
+                self.dict_prosumers[path_prosumer] = Prosumer(
+                    path=path_prosumer, t_override=self.t_now, persistent=True,
+                    state_store=_get_state_store(config=self.config, path_prosumer=path_prosumer))
+            list_prosumer_obj.append(self.dict_prosumers[path_prosumer])
         return list_prosumer_obj
 
+    def __get_list_paths_prosumers(self) -> list:
+        """
+        Returns the paths to the directories of all active prosumers in the simulation.
+
+        :param: None
+
+        :return: list of str
+        """
+        if self.config["simulation"]["agents_active"]:
+            return [f"{self.path_results}/prosumer/{prosumer}" for prosumer in os.listdir(self.path_results
+                                                                                          + "/prosumer")]
+        return []
+
     def __get_active_aggregators(self) -> list:
         """
         Returns list of active aggregators in the simulation.
@@ -963,9 +1348,27 @@ class ScenarioExecutor:
         return ''.join(choice(characters) for _ in range(length))
 
 
+def _get_state_store(config, path_prosumer):
+    """
+    Creates the state store of a persistent prosumer according to the simulation setting 'agents_state_store'.
+
+    :param config: dict, LEM config dict
+
+    :param path_prosumer: str, path to the prosumer's directory
+
+    :return: StateStore, states are kept in memory by a MemoryStateStore unless the setting is "files"
+    """
+    type_store = config["simulation"].get("agents_state_store", "files")
+    if type_store == "memory":
+        return MemoryStateStore(path=path_prosumer)
+    if type_store == "memory_async":
+        return MemoryStateStore(path=path_prosumer, write_async=True)
+    return StateStore(path=path_prosumer)
+
+
 # parallel functions need to be defined outside the class to work
 
-def _par_step_prosumers_init(func, config, path_weather):
+def _par_step_prosumers_init(func, config, path_weather, db_dict):
     """
     Initializes DatabaseConnection instances for par_step_prosumer_pre processes.
 
@@ -975,10 +1378,17 @@ def _par_step_prosumers_init(func, config, path_weather):
 
     param config: dict, LEM config dict required to create a DatabaseConnection object
 
+    param db_dict: dict, user connection dict including the worker's share of the connection budget
+
     """
     # initialize each multiprocessing worker with a database connection
-    func.db_conn = DatabaseConnection(db_dict=config["db_connections"]["database_connection_user"],
+    func.db_conn = DatabaseConnection(db_dict=db_dict,
                                       lem_config=config["lem"])
+    # delivery period the cached lookups of the connection were last refreshed for, see _par_step_prosumers_pre()
+    func.t_refresh_cache = None
+    func.instrumentation = None
+    if config["simulation"].get("db_instrumentation", False):
+        func.instrumentation = QueryInstrumentation(func.db_conn)
     # each multiprocessing worker gets a copy of the weather file for the simulation,
     # as every worker needs to regularly access the same read-only file
 
@@ -1015,11 +1425,238 @@ def _par_step_prosumers_pre(list_info_prosumers):
 
     :param: None
 
-    :return: None
+    :return: tuple, process id, connection wait statistics and query metrics of the worker, metrics are None if
+             query instrumentation is disabled
     """
+    # the cached lookups of the worker's connection are refreshed once per step, not once per prosumer
+    if _par_step_prosumers_pre.t_refresh_cache != list_info_prosumers["t_now"]:
+        _par_step_prosumers_pre.db_conn.refresh_cache()
+        _par_step_prosumers_pre.t_refresh_cache = list_info_prosumers["t_now"]
+
     prosumer = Prosumer(path=list_info_prosumers["path_prosumer"],
                         t_override=list_info_prosumers["t_now"],
                         df_weather_history=_par_step_prosumers_pre.df_weather_history,
                         df_weather_fcast=_par_step_prosumers_pre.df_weather_fcast)
 
-    prosumer.pre_clearing_activity(db_obj=_par_step_prosumers_pre.db_conn)
+    prosumer.pre_clearing_activity(db_obj=_par_step_prosumers_pre.db_conn,
+                                   results_market=list_info_prosumers.get("results_market"))
+
+    metrics_queries = None
+    if _par_step_prosumers_pre.instrumentation is not None:
+        metrics_queries = _par_step_prosumers_pre.instrumentation.pop_metrics()
+
+    return os.getpid(), _par_step_prosumers_pre.db_conn.get_stats_pool(), metrics_queries
+
+
+def _par_shard_prosumers(connection, list_paths_prosumers, config, path_weather, db_dict):
+    """
+    Keeps the persistent prosumers of a shard in memory and performs their activities on request.
+
+    Runs in a process started by _ShardsProsumers. Commands are received through the connection as tuples of the
+    command and its inputs:
+        "pre"        -- list of dicts, see ScenarioExecutor.__gen_par_step_prosumers_pre_input(), performs
+                        Prosumer.pre_clearing_activity()
+        "post"       -- list of dicts, same as "pre", performs Prosumer.post_clearing_activity()
+        "checkpoint" -- None, writes the configurations of all prosumers to disk
+        "close"      -- None, writes the configurations of all prosumers to disk and ends the process
+
+    Every command is answered with the process id, connection wait statistics and query metrics of the worker, or
+    with the formatted traceback of the exception raised, as exceptions are not necessarily picklable.
+
+    :param connection: multiprocessing.connection.Connection, worker end of the pipe to _ShardsProsumers
+
+    :param list_paths_prosumers: list of str, paths to the directories of the prosumers of the shard
+
+    :param config: dict, LEM config dict required to create a DatabaseConnection object
+
+    :param path_weather: str, path to the weather file of the simulation
+
+    :param db_dict: dict, user connection dict including the worker's share of the connection budget
+
+    :return: None
+    """
+    _par_step_prosumers_init(_par_shard_prosumers, config, path_weather, db_dict)
+    dict_prosumers = {}
+    while True:
+        command, list_info_prosumers = connection.recv()
+        try:
+            # the cached lookups of the worker's connection are refreshed once per step
+            if command == "pre":
+                _par_shard_prosumers.db_conn.refresh_cache()
+            if command in ["checkpoint", "close"]:
+                for prosumer in dict_prosumers.values():
+                    prosumer.checkpoint()
+            for info_prosumer in list_info_prosumers or []:
+                path_prosumer = info_prosumer["path_prosumer"]
+                if path_prosumer not in dict_prosumers:
+                    dict_prosumers[path_prosumer] = Prosumer(
+                        path=path_prosumer,
+                        t_override=info_prosumer["t_now"],
+                        df_weather_history=_par_shard_prosumers.df_weather_history,
+                        df_weather_fcast=_par_shard_prosumers.df_weather_fcast,
+                        persistent=True,
+                        state_store=_get_state_store(config=config, path_prosumer=path_prosumer))
+                else:
+                    dict_prosumers[path_prosumer].set_time(t_override=info_prosumer["t_now"])
+                if command == "pre":
+                    dict_prosumers[path_prosumer].pre_clearing_activity(
+                        db_obj=_par_shard_prosumers.db_conn,
+                        results_market=info_prosumer.get("results_market"))
+                else:
+                    dict_prosumers[path_prosumer].post_clearing_activity(
+                        db_obj=_par_shard_prosumers.db_conn,
+                        results_market=info_prosumer.get("results_market"))
+        except Exception:
+            connection.send(traceback.format_exc())
+        else:
+            metrics_queries = None
+            if _par_shard_prosumers.instrumentation is not None:
+                metrics_queries = _par_shard_prosumers.instrumentation.pop_metrics()
+            connection.send((os.getpid(), _par_shard_prosumers.db_conn.get_stats_pool(), metrics_queries))
+        # the worker ends on "close" even if its prosumers could not be checkpointed, as the parent waits for it
+        if command == "close":
+            _par_shard_prosumers.db_conn.end_connection()
+            connection.close()
+            return
+
+
+class _ShardsProsumers:
+    """
+    Fixed set of worker processes keeping persistent prosumers in memory between simulation steps.
+
+    Unlike with a multiprocessing pool, every prosumer is always handled by the same worker, so its instance, plant
+    configurations and forecasting models are created only once per simulation. Each worker owns a fixed share of
+    the prosumers, see _par_shard_prosumers().
+    """
+
+    def __init__(self, list_paths_prosumers, num_processes, config, path_weather, db_dict):
+        """
+        Starts the workers and assigns the prosumers to them.
+
+        :param list_paths_prosumers: list of str, paths to the directories of all prosumers in the simulation
+
+        :param num_processes: int, number of workers
+
+        :param config: dict, LEM config dict
+
+        :param path_weather: str, path to the weather file of the simulation
+
+        :param db_dict: dict, user connection dict including each worker's share of the connection budget
+        """
+        list_paths_prosumers = sorted(list_paths_prosumers)
+        num_processes = max(1, min(num_processes, len(list_paths_prosumers)))
+        self.dict_shards = {}
+        self.connections = []
+        self.processes = []
+        for i in range(num_processes):
+            connection, connection_worker = mp.Pipe()
+            process = mp.Process(target=_par_shard_prosumers,
+                                 args=(connection_worker, list_paths_prosumers[i::num_processes],
+                                       config, path_weather, db_dict),
+                                 daemon=True)
+            process.start()
+            connection_worker.close()
+            self.dict_shards.update({path_prosumer: i for path_prosumer in list_paths_prosumers[i::num_processes]})
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def pre_clearing_activity(self, list_info_prosumers) -> list:
+        """
+        Performs Prosumer.pre_clearing_activity() for the prosumers in their workers.
+
+        :param list_info_prosumers: list of dicts, see ScenarioExecutor.__gen_par_step_prosumers_pre_input()
+
+        :return: list of tuples, process id, connection wait statistics and query metrics of each worker
+        """
+        return self.__send("pre", list_info_prosumers)
+
+    def post_clearing_activity(self, list_info_prosumers) -> list:
+        """
+        Performs Prosumer.post_clearing_activity() for the prosumers in their workers.
+
+        :param list_info_prosumers: list of dicts, see ScenarioExecutor.__gen_par_step_prosumers_pre_input()
+
+        :return: list of tuples, process id, connection wait statistics and query metrics of each worker
+        """
+        return self.__send("post", list_info_prosumers)
+
+    def checkpoint(self) -> None:
+        """
+        Writes the configurations of all prosumers to disk.
+
+        :param: None
+
+        :return: None
+        """
+        self.__send("checkpoint")
+
+    def close(self) -> None:
+        """
+        Writes the configurations of all prosumers to disk and ends the workers. Closing again has no effect.
+
+        :param: None
+
+        :return: None
+        """
+        if not self.processes:
+            return
+        try:
+            self.__send("close")
+        finally:
+            # workers that do not end in time, e.g. as they did not receive the command, are terminated
+            t_deadline = time.time() + 60
+            for process in self.processes:
+                process.join(timeout=max(0., t_deadline - time.time()))
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            self.connections = []
+            self.processes = []
+
+    def __send(self, command, list_info_prosumers=None) -> list:
+        """
+        Sends a command to all workers, each one receiving the inputs of its own prosumers, and waits for all of them.
+
+        :param command: str, see _par_shard_prosumers()
+
+        :param list_info_prosumers: list of dicts or None
+
+        :return: list of tuples, process id, connection wait statistics and query metrics of each worker
+        """
+        list_inputs = [[] for _ in self.connections]
+        for info_prosumer in list_info_prosumers or []:
+            list_inputs[self.dict_shards[info_prosumer["path_prosumer"]]].append(info_prosumer)
+        for connection, inputs in zip(self.connections, list_inputs):
+            connection.send((command, inputs))
+        list_results = [connection.recv() for connection in self.connections]
+        for result in list_results:
+            if isinstance(result, str):
+                raise RuntimeError(f"Prosumer worker failed:\n{result}")
+        return list_results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None:
+            # the workers still responding write the configurations of their prosumers to disk before they are ended
+            list_connections_checkpoint = []
+            for connection in self.connections:
+                try:
+                    connection.send(("checkpoint", None))
+                    list_connections_checkpoint.append(connection)
+                except OSError:
+                    pass
+            t_deadline = time.time() + 60
+            for connection in list_connections_checkpoint:
+                try:
+                    if connection.poll(max(0., t_deadline - time.time())):
+                        connection.recv()
+                except (OSError, EOFError):
+                    pass
+            for process in self.processes:
+                process.terminate()
+            self.connections = []
+            self.processes = []
+            return
+        self.close()
@@ -6,7 +6,6 @@ __email__ = "sebastian.lumpp@tum.de"
 
 import warnings
 import random
-import json
 import pathlib
 import os
 import feather as ft
@@ -72,6 +71,24 @@ class ForecastManager:
         self.df_weather_history = prosumer_obj.df_weather_history
         self.df_weather_fcast = prosumer_obj.df_weather_fcast
 
+        # configurations are saved by the owning Prosumer instance, which defers saving if it is persistent
+        self.save_config_account = prosumer_obj.save_config_account
+        self.save_config_plants = prosumer_obj.save_config_plants
+        # states of the owning Prosumer instance, such as price histories and forecasts, see StateStore
+        self.state_store = prosumer_obj.state_store
+
+    def set_time(self, prosumer_obj):
+        """Takes over the simulation time of the owning Prosumer instance, see Prosumer.set_time().
+
+        :param prosumer_obj: the Prosumer object that owns this instance of ForecastManager
+
+        :return: None
+        """
+        self.t_now = prosumer_obj.t_now
+        self.ts_delivery_prev = prosumer_obj.ts_delivery_prev
+        self.ts_delivery_current = prosumer_obj.ts_delivery_current
+        self.fcast_table = None
+
     def update_forecasts(self):
 
         """Public function that calls retraining and updating functions for all plants and prices required by the parent
@@ -85,7 +102,7 @@ class ForecastManager:
         # retrieve most recent forecast results, update and save back to file
         self._retrieve_fcast_table()
         self._update_all_forecasts()
-        ft.write_dataframe(self.fcast_table.reset_index(), f"{self.path_prosumer}/fcasts_current.ft")
+        self.state_store.write_dataframe("fcasts_current.ft", self.fcast_table.reset_index())
 
     # internal functions
 
@@ -117,8 +134,7 @@ class ForecastManager:
                     self.plant_dict[plant]["fcast_last_retrain"] = self.ts_delivery_current
 
         # save retraining timestamps to file
-        with open(f"{self.path_prosumer}/config_plants.json", "w") as write_file:
-            json.dump(self.plant_dict, write_file)
+        self.save_config_plants()
 
     def _update_all_forecasts(self):
         # update forecasts for all plants operated by the owning Prosumer instance
@@ -146,8 +162,7 @@ class ForecastManager:
                         df_temp.rename(columns={'wind_speed': f'wind_speed_{plant}'}, inplace=True)
 
                         # translate wind speed into power generation according to plant spec file
-                        with open(f"{self.path_prosumer}/spec_{plant}.json") as read_file:
-                            spec_file = json.load(read_file)
+                        spec_file = self.state_store.read_json(f"spec_{plant}.json")
 
                         lookup_ws = spec_file["wind_speed_m/s"]
                         lookup_power = spec_file["power_pu"]
@@ -210,8 +225,7 @@ class ForecastManager:
 
                     # if plant was updated, save this to the spec file
                     self.plant_dict[plant]["fcast_last_update"] = self.ts_delivery_current
-                    with open(f"{self.path_prosumer}/config_plants.json", "w") as write_file:
-                        json.dump(self.plant_dict, write_file)
+                    self.save_config_plants()
 
             # These forecasts are handled separately from those for plants
             # LEM prices are forecast either naively (same as yesterday)
@@ -224,15 +238,14 @@ class ForecastManager:
                     df_temp = self.__update_single_forecast(
                         fcast=self.config_dict["mpc_price_fcast"],
                         fcast_horizon=self.config_dict["mpc_horizon"] + period_update//900,
-                        filepath=f"{self.path_prosumer}/price_history.ft",
+                        filename="price_history.ft",
                         column="weighted_average_price",
                     )
                     df_temp.rename(columns={'weighted_average_price': f'price'}, inplace=True)
                     self.fcast_table = self.fcast_table.join(df_temp, how="outer", lsuffix=f"duplicate")
 
                     self.config_dict["mpc_price_fcast_last_update"] = self.ts_delivery_current
-                    with open(f"{self.path_prosumer}/config_account.json", "w") as write_file:
-                        json.dump(self.config_dict, write_file)
+                    self.save_config_account()
             # or flat (market price is always exactly the average between the market floor and ceiling)
             else:
                 self.fcast_table[f'price'] = (self.config_dict["max_bid"] + self.config_dict["min_offer"]) / 2
@@ -244,7 +257,7 @@ class ForecastManager:
                         fcast="naive",
                         column="price_energy_levies_positive",
                         fcast_horizon=self.config_dict["mpc_horizon"],
-                        filepath=f"{self.path_prosumer}/price_history.ft"
+                        filename="price_history.ft"
                         )
 
             self.fcast_table = self.fcast_table.join(df_temp, how="outer", lsuffix="duplicate")
@@ -252,7 +265,7 @@ class ForecastManager:
                         fcast="naive",
                         column="price_energy_levies_negative",
                         fcast_horizon=self.config_dict["mpc_horizon"],
-                        filepath=f"{self.path_prosumer}/price_history.ft"
+                        filename="price_history.ft"
                         )
             self.fcast_table = self.fcast_table.join(df_temp, how="outer", lsuffix="duplicate")
 
@@ -266,10 +279,10 @@ class ForecastManager:
                                  id_plant=None,
                                  fcast=None,
                                  fcast_horizon=None,
-                                 filepath=None,
+                                 filename=None,
                                  column="power"):
         """
-        Takes the forecast model "fcast" for plant "id_plant" and applies it to the data in "column" of "filepath" and returns a forecast
+        Takes the forecast model "fcast" for plant "id_plant" and applies it to the data in "column" of "filename" and returns a forecast
         starting at ts_delivery_current for "fcast_horizon" steps.
 
         id_plant is optional as price forecasts don't require a plant to be attached.
@@ -277,7 +290,7 @@ class ForecastManager:
         :param id_plant: string, id of plant to be forecast
         :param fcast: string, type of fcast model to be used e.g. "sarma" or "perfect"
         :param fcast_horizon: int, how many timesteps should the forecast contain?
-        :param filepath: string, path to the data
+        :param filename: string, name of the data file in the prosumer directory, see StateStore
         :param column: string, name of the data column to be forecast
 
         :return obj: float, RMSE of the SARMA model
@@ -295,14 +308,14 @@ class ForecastManager:
         if fcast is None:
             fcast = self.plant_dict[id_plant].get("fcast")
 
-        if filepath is None:
-            filepath = f"{self.path_prosumer}/raw_data_{id_plant}.ft"
+        if filename is None:
+            filename = f"raw_data_{id_plant}.ft"
 
         if fcast == "sarma":
             # return sarma forecast on data
 
             # read historical values and create time series to be utilities from
-            df_in = ft.read_dataframe(filepath)
+            df_in = self.state_store.read_dataframe(filename)
             df_in.set_index("timestamp", inplace=True)
             y = list(df_in[(df_in.index <= self.ts_delivery_current - 900)][column]
                      / df_in[(df_in.index <= self.ts_delivery_current - 900)][column].max()*2)
@@ -377,7 +390,7 @@ class ForecastManager:
 
         elif fcast == "perfect":
             # perfect knowledge of the future
-            df_in = ft.read_dataframe(filepath)
+            df_in = self.state_store.read_dataframe(filename)
             df_in.set_index("timestamp", inplace=True)
             df_y_hat = df_in[(self.ts_delivery_current <= df_in.index)
                              & (df_in.index <= self.ts_delivery_current + 900 * fcast_horizon)][column].to_frame()
@@ -386,7 +399,7 @@ class ForecastManager:
         elif fcast == "naive":
             # naive forecast, today will be the average of the previous 1 days
             # read historical values and create time series to be utilities from
-            df_in = ft.read_dataframe(filepath)
+            df_in = self.state_store.read_dataframe(filename)
             df_in.set_index("timestamp", inplace=True)
             y = list(df_in[(df_in.index <= self.ts_delivery_current - 900)][column])
 
@@ -403,7 +416,7 @@ class ForecastManager:
         elif fcast == "naive_average":
             # naive forecast, today will be the average of the previous 7 days
             # read historical values and create time series to be utilities from
-            df_in = ft.read_dataframe(filepath)
+            df_in = self.state_store.read_dataframe(filename)
             df_in.set_index("timestamp", inplace=True)
             y = list(df_in[(df_in.index <= self.ts_delivery_current - 900)][column])
             y_hat = []
@@ -419,7 +432,7 @@ class ForecastManager:
 
         elif fcast == "aggregator":
             # return a zero forecast if plant is aggregated
-            df_in = ft.read_dataframe(filepath)
+            df_in = self.state_store.read_dataframe(filename)
             df_in.set_index("timestamp", inplace=True)
             df_y_hat = df_in[(self.ts_delivery_current <= df_in.index)
                              & (df_in.index <= self.ts_delivery_current + 900 * fcast_horizon - 1)][column]
@@ -428,7 +441,7 @@ class ForecastManager:
 
         elif fcast == "smoothed":
             # moving average "perfect filter" forecast
-            df_in = ft.read_dataframe(filepath)
+            df_in = self.state_store.read_dataframe(filename)
             df_in.set_index("timestamp", inplace=True)
             raw_pred_temp = list(df_in[(self.ts_delivery_current - 900 * fcast_param <= df_in.index)
                                  & (df_in.index <= self.ts_delivery_current
@@ -456,7 +469,7 @@ class ForecastManager:
         elif fcast == "ev_close":
             # "realistic" forecast for electric vehicles. As soon as the vehicle arrives, we know the SOC and for
             # how long the vehicle will be available. Nothing is knows beyond the current charging cycle
-            df_in = ft.read_dataframe(filepath)
+            df_in = self.state_store.read_dataframe(filename)
             df_in.set_index("timestamp", inplace=True)
             df_in = df_in[(self.ts_delivery_current <= df_in.index)
                           & (df_in.index <= self.ts_delivery_current + 900 * fcast_horizon - 1)]
@@ -471,7 +484,7 @@ class ForecastManager:
         elif fcast == "nn":
             # neural network for pv plant
             # load saved neural network model
-            path = pathlib.Path(filepath)
+            path = pathlib.Path(f"{self.path_prosumer}/{filename}")
             nn_model = self.tf.keras.models.load_model(path.parent.joinpath(f"fcast_model_{id_plant}.hdf5"))
             # set forecasting timeframe
             ts_d_start = self.ts_delivery_current
@@ -576,8 +589,8 @@ class ForecastManager:
         return nn_data_normalized
 
     def _retrieve_fcast_table(self):
-        if os.path.exists(f"{self.path_prosumer}/fcasts_current.ft"):
-            self.fcast_table = ft.read_dataframe(f"{self.path_prosumer}/fcasts_current.ft").set_index("timestamp")
+        if self.state_store.exists("fcasts_current.ft"):
+            self.fcast_table = self.state_store.read_dataframe("fcasts_current.ft").set_index("timestamp")
         else:
             ts_init = [[ts, 0] for ts in range(self.ts_delivery_current,
                                                self.ts_delivery_current + self.config_dict["mpc_horizon"] * 900,
@@ -668,7 +681,7 @@ class ForecastManager:
         """
 
         # read historical values and create time series to be utilities from
-        df_in = ft.read_dataframe(f"{self.path_prosumer}/raw_data_{id_plant}.ft")
+        df_in = self.state_store.read_dataframe(f"raw_data_{id_plant}.ft")
         df_in.set_index("timestamp", inplace=True)
 
         y = list(df_in[(df_in.index < self.ts_delivery_prev)][column] /
@@ -712,8 +725,7 @@ class ForecastManager:
 
         self.plant_dict[id_plant]["fcast_param"] = optimal_param
         # save forecast parameters to file
-        with open(f"{self.path_prosumer}/config_plants.json", "w") as write_file:
-            json.dump(self.plant_dict, write_file)
+        self.save_config_plants()
 
     @staticmethod
     def _calc_mppc(df_raw_data):
@@ -0,0 +1,233 @@
+__author__ = "sdlumpp"
+__credits__ = []
+__license__ = ""
+__maintainer__ = "sdlumpp"
+__email__ = "sebastian.lumpp@tum.de"
+
+import os
+import copy
+import json
+import threading
+import concurrent.futures
+import feather as ft
+
+# asynchronous writes of all MemoryStateStore instances of a process are made by a single background thread, so
+# the writes of a file are made in the order they were requested. created on first use in each process
+_executor_write = None
+_pid_executor_write = None
+_lock_executor_write = threading.Lock()
+
+
+class StateStore:
+    """
+    StateStore reads and writes the state of an agent, such as storage SOCs, cumulative meter readings, buffered meter
+    readings, energy management logs, forecasts, controller results and price histories.
+
+    States are identified by the name of their file in the agent's directory. JSON states are python objects,
+    tabular states are pandas DataFrames. Every read and write of this class is made from and to the file, as the
+    agents did before states were kept in memory, see MemoryStateStore.
+
+    Public methods:
+
+        __init__ :          Self explanatory
+
+        read_json:          Returns a JSON state
+
+        write_json:         Saves a JSON state
+
+        read_dataframe:     Returns a tabular state
+
+        write_dataframe:    Saves a tabular state
+
+        exists:             Checks whether a state exists
+
+        checkpoint:         Writes all states kept in memory to their files
+    """
+
+    def __init__(self, path):
+        """Create a StateStore instance for an agent.
+
+        :param path: path to the agent's directory
+        """
+        self.path = path
+
+    def read_json(self, name):
+        """Returns a JSON state.
+
+        :param name: str, name of the state's file, e.g. "soc_bat01.json"
+
+        :return: python object of the state
+        """
+        with open(f"{self.path}/{name}", "r") as read_file:
+            return json.load(read_file)
+
+    def write_json(self, name, obj):
+        """Saves a JSON state.
+
+        :param name: str, name of the state's file
+        :param obj: python object of the state, must be JSON serializable
+
+        :return: None
+        """
+        with open(f"{self.path}/{name}", "w") as write_file:
+            json.dump(obj, write_file)
+
+    def read_dataframe(self, name, columns=None):
+        """Returns a tabular state.
+
+        :param name: str, name of the state's file, e.g. "log_ems.ft"
+        :param columns: list of str, columns to be returned, all columns if None
+
+        :return: pandas DataFrame of the state
+        """
+        return ft.read_dataframe(f"{self.path}/{name}", columns=columns)
+
+    def write_dataframe(self, name, df, keep=True):
+        """Saves a tabular state.
+
+        :param name: str, name of the state's file
+        :param df: pandas DataFrame of the state
+        :param keep: bool, if False, the state is not read again by the agent and is not kept in memory, e.g. the
+                     archived results of every controller run
+
+        :return: None
+        """
+        ft.write_dataframe(df, f"{self.path}/{name}")
+
+    def exists(self, name):
+        """Checks whether a state exists.
+
+        :param name: str, name of the state's file
+
+        :return: bool
+        """
+        return os.path.exists(f"{self.path}/{name}")
+
+    def checkpoint(self):
+        """Writes all states kept in memory to their files. All states of this class are written immediately.
+
+        :return: None
+        """
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """
+    MemoryStateStore keeps the states of an agent in memory, so persistent agents do not read and rewrite their state
+    files every step.
+
+    States are read from their files once and then kept as python objects and DataFrames. Written states are kept in
+    memory and written to their files on checkpoint() or, if write_async is set, by a background thread right away.
+    States that are not kept are written right away, by the background thread if write_async is set. Read states are
+    copies, so states in memory are only changed by writing them.
+
+    Only the agent owning the store may change the state files while it is in use.
+    """
+
+    def __init__(self, path, write_async=False):
+        """Create a MemoryStateStore instance for an agent.
+
+        :param path: path to the agent's directory
+        :param write_async: bool, if True, written states are written to their files by a background thread right
+                            away, otherwise on checkpoint()
+        """
+        super().__init__(path)
+        self.write_async = write_async
+        # states in memory by name, tuples of the type of the state ("json" or "dataframe") and the state
+        self.dict_states = {}
+        # states written since the last checkpoint by name
+        self.dict_states_dirty = {}
+        # asynchronous writes that have not been completed yet
+        self.list_futures = []
+
+    def read_json(self, name):
+        if name not in self.dict_states:
+            self.dict_states[name] = ("json", super().read_json(name))
+        return copy.deepcopy(self.__get_state(name))
+
+    def write_json(self, name, obj):
+        self.__set_state(name, ("json", copy.deepcopy(obj)), keep=True)
+
+    def read_dataframe(self, name, columns=None):
+        if name not in self.dict_states:
+            self.dict_states[name] = ("dataframe", super().read_dataframe(name))
+        df = self.__get_state(name)
+        if columns is not None:
+            return df[columns].copy()
+        return df.copy()
+
+    def write_dataframe(self, name, df, keep=True):
+        self.__set_state(name, ("dataframe", df.copy()), keep=keep)
+
+    def exists(self, name):
+        return name in self.dict_states or super().exists(name)
+
+    def checkpoint(self):
+        """Writes all states written since the last checkpoint to their files and waits for all asynchronous writes.
+
+        :return: None
+        """
+        for name, state in self.dict_states_dirty.items():
+            _write_state(self.path, name, state)
+        self.dict_states_dirty = {}
+        for future in self.list_futures:
+            future.result()
+        self.list_futures = []
+
+    def __get_state(self, name):
+        return self.dict_states[name][1]
+
+    def __set_state(self, name, state, keep):
+        if keep:
+            self.dict_states[name] = state
+        else:
+            self.dict_states.pop(name, None)
+            self.dict_states_dirty.pop(name, None)
+        if self.write_async:
+            # the state is not changed after writing, as reads are copies. errors of completed writes are raised
+            list_futures_pending = []
+            for future in self.list_futures:
+                if future.done():
+                    future.result()
+                else:
+                    list_futures_pending.append(future)
+            self.list_futures = list_futures_pending
+            self.list_futures.append(_get_executor_write().submit(_write_state, self.path, name, state))
+        elif keep:
+            self.dict_states_dirty[name] = state
+        else:
+            # states that are not kept are not buffered until the next checkpoint, so they do not accumulate in memory
+            _write_state(self.path, name, state)
+
+
+def _get_executor_write():
+    """
+    Returns the background thread writing the states of all MemoryStateStore instances of the process.
+
+    :return: concurrent.futures.ThreadPoolExecutor
+    """
+    global _executor_write, _pid_executor_write
+    with _lock_executor_write:
+        # threads are not inherited by forked processes
+        if _executor_write is None or _pid_executor_write != os.getpid():
+            _executor_write = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            _pid_executor_write = os.getpid()
+        return _executor_write
+
+
+def _write_state(path, name, state):
+    """
+    Writes a state kept in memory to its file.
+
+    :param path: path to the agent's directory
+    :param name: str, name of the state's file
+    :param state: tuple, type of the state ("json" or "dataframe") and the state
+
+    :return: None
+    """
+    type_state, obj = state
+    if type_state == "json":
+        with open(f"{path}/{name}", "w") as write_file:
+            json.dump(obj, write_file)
+    else:
+        ft.write_dataframe(obj, f"{path}/{name}")
@@ -0,0 +1,27 @@
+__author__ = "sdlumpp"
+__credits__ = []
+__license__ = ""
+__maintainer__ = "sdlumpp"
+__email__ = "sebastian.lumpp@tum.de"
+
+from types import SimpleNamespace
+import pandas as pd
+import lemlab.db_connection.db_param as db_p
+from lemlab.lem.clearing_ex_ante import _aggregate_identical_positions
+
+
+def test_aggregate_identical_positions_sums_quantities():
+    # identical positions of a user are merged into one position with the summed quantity
+    db_obj = SimpleNamespace(db_param=db_p)
+    positions = pd.DataFrame({db_p.ID_USER: ["user01", "user02", "user01", "user01", "user02"],
+                              db_p.PRICE_ENERGY: [50, 50, 50, 60, 50],
+                              db_p.QUALITY_ENERGY: ["na", "na", "na", "na", "local"],
+                              db_p.QTY_ENERGY: [3, 4, 5, 7, 2]})
+    subset = [db_p.PRICE_ENERGY, db_p.QUALITY_ENERGY, db_p.ID_USER]
+
+    positions_aggregated = _aggregate_identical_positions(db_obj=db_obj, positions=positions.copy(), subset=subset)
+
+    pd.testing.assert_series_equal(
+        positions_aggregated.set_index(subset)[db_p.QTY_ENERGY].sort_index(),
+        positions.groupby(subset)[db_p.QTY_ENERGY].sum().sort_index())
+    assert positions_aggregated[db_p.QTY_ENERGY].sum() == positions[db_p.QTY_ENERGY].sum()
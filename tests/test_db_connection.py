@@ -0,0 +1,236 @@
+__author__ = "sdlumpp"
+__credits__ = []
+__license__ = ""
+__maintainer__ = "sdlumpp"
+__email__ = "sebastian.lumpp@tum.de"
+
+import os
+import pytest
+import pandas as pd
+import sqlalchemy as db
+from ruamel.yaml import YAML
+import lemlab.db_connection.db_param as db_p
+from lemlab.db_connection.db_connection import DatabaseConnection
+
+PATH_CONFIG = os.path.join(os.path.dirname(__file__), "..", "code_examples", "sim_0_config.yaml")
+
+
+def _connect(url, create_tables=False):
+    # the statements are run against SQLite. Statements only PostgreSQL supports are run against the server set by
+    # LEMLAB_TEST_POSTGRESQL and skipped otherwise
+    with open(PATH_CONFIG) as config_file:
+        lem_config = YAML().load(config_file)["lem"]
+    db_obj = DatabaseConnection(db_dict={"user": "lemlab", "pw": "", "host": "localhost", "port": 5432,
+                                         "db": "lemlab"},
+                                lem_config=lem_config)
+    db_obj.engine = db.create_engine(url)
+    if db_obj.engine.dialect.name == "sqlite":
+        # the aggregated book is sorted with the binary collation "C" of PostgreSQL, which compares by code point
+        db.event.listen(db_obj.engine, "connect",
+                        lambda dbapi_connection, connection_record: dbapi_connection.create_collation(
+                            "C", lambda a, b: (a > b) - (a < b)))
+    if create_tables:
+        for table in db_obj.list_tables:
+            db_obj._drop_table(table.name)
+            db_obj._create_table(table)
+    return db_obj
+
+
+def _skip_sqlite(db_obj):
+    if db_obj.engine.dialect.name == "sqlite":
+        pytest.skip("data-modifying statements in WITH clauses require PostgreSQL")
+
+
+def _count_queries(db_obj):
+    # list of the statements executed through the engine of db_obj from now on
+    list_statements = []
+    db.event.listen(db_obj.engine, "before_cursor_execute",
+                    lambda conn, cursor, statement, *args: list_statements.append(statement))
+    return list_statements
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def url_db(request, tmp_path):
+    if request.param == "sqlite":
+        return f"sqlite:///{tmp_path}/lemlab.db"
+    if os.environ.get("LEMLAB_TEST_POSTGRESQL") is None:
+        pytest.skip("LEMLAB_TEST_POSTGRESQL is not set to the URL of an empty PostgreSQL test database")
+    return os.environ["LEMLAB_TEST_POSTGRESQL"]
+
+
+@pytest.fixture
+def db_obj(url_db):
+    db_obj = _connect(url_db, create_tables=True)
+    yield db_obj
+    db_obj.end_connection()
+
+
+def _user(id_user):
+    return pd.DataFrame([{db_p.ID_USER: id_user, db_p.BALANCE_ACCOUNT: 0, db_p.T_UPDATE_BALANCE: 0,
+                          db_p.PRICE_ENERGY_BID_MAX: 100, db_p.PRICE_ENERGY_OFFER_MIN: 0,
+                          db_p.PREFERENCE_QUALITY: "na", db_p.PREMIUM_PREFERENCE_QUALITY: 0,
+                          db_p.STRATEGY_MARKET_AGENT: "linear", db_p.HORIZON_TRADING: 4,
+                          db_p.ID_MARKET_AGENT: f"ma_{id_user}", db_p.TS_DELIVERY_FIRST: 0,
+                          db_p.TS_DELIVERY_LAST: 2147483647}])
+
+
+def _positions(list_positions):
+    # tuples of id_user, type_position, number_position, ts_delivery, price_energy, quality_energy and qty_energy
+    return pd.DataFrame([{db_p.ID_USER: id_user, db_p.QTY_ENERGY: qty_energy, db_p.PRICE_ENERGY: price_energy,
+                          db_p.QUALITY_ENERGY: quality_energy, db_p.PREMIUM_PREFERENCE_QUALITY: 0,
+                          db_p.TYPE_POSITION: type_position, db_p.NUMBER_POSITION: number_position,
+                          db_p.STATUS_POSITION: 0, db_p.TS_DELIVERY: ts_delivery}
+                         for id_user, type_position, number_position, ts_delivery, price_energy, quality_energy,
+                         qty_energy in list_positions])
+
+
+POSITIONS = [("user01", "bid", 0, 900, 50, "na", 3),
+             ("user01", "offer", 1, 900, 40, "local", 5),
+             ("user01", "bid", 2, 1800, 60, "na", 7),
+             ("user01", "bid", 3, 2700, 70, "na", 9),
+             ("user02", "bid", 0, 900, 55, "green_local", 4),
+             ("user02", "offer", 1, 1800, 45, "na", 6)]
+
+
+def _numbers(df_positions):
+    return sorted(zip(df_positions[db_p.ID_USER], df_positions[db_p.NUMBER_POSITION]))
+
+
+def test_get_open_positions_filters_and_archives(db_obj):
+    db_obj.post_positions(_positions(POSITIONS), t_override=100)
+
+    bids, offers = db_obj.get_open_positions(id_user="user01", ts_delivery_first=900, ts_delivery_last=1800,
+                                             archive=True)
+
+    assert _numbers(bids) == [("user01", 0), ("user01", 2)]
+    assert _numbers(offers) == [("user01", 1)]
+    assert bids[db_p.TS_DELIVERY].is_monotonic_increasing
+    assert (bids[db_p.T_SUBMISSION] == 100).all()
+    bids_archived, offers_archived = db_obj.get_positions_archive()
+    assert _numbers(bids_archived) == _numbers(bids) and _numbers(offers_archived) == _numbers(offers)
+    # the positions remain open
+    assert sum(map(len, db_obj.get_open_positions())) == len(POSITIONS)
+
+
+def test_get_open_positions_dtypes_follow_the_table(db_obj):
+    # empty results have the same dtypes as filled ones instead of dtypes inferred from the values
+    db_obj.post_positions(_positions(POSITIONS), t_override=100)
+
+    for id_user in ["user01", "nobody"]:
+        bids, _ = db_obj.get_open_positions(id_user=id_user)
+        assert bids[db_p.QTY_ENERGY].dtype == "int64"
+        assert bids[db_p.TS_DELIVERY].dtype == "int64"
+        assert bids[db_p.ID_USER].dtype == object
+
+
+def test_get_open_positions_archives_and_clears(db_obj):
+    _skip_sqlite(db_obj)
+    db_obj.post_positions(_positions(POSITIONS), t_override=100)
+
+    bids, offers = db_obj.get_open_positions(ts_delivery_first=900, ts_delivery_last=1800, clear_table=True,
+                                             archive=True)
+
+    assert _numbers(bids) == [("user01", 0), ("user01", 2), ("user02", 0)]
+    assert _numbers(offers) == [("user01", 1), ("user02", 1)]
+    # the whole table is cleared, only the returned positions are archived
+    assert sum(map(len, db_obj.get_open_positions())) == 0
+    bids_archived, offers_archived = db_obj.get_positions_archive()
+    assert _numbers(bids_archived) == _numbers(bids) and _numbers(offers_archived) == _numbers(offers)
+
+
+def test_cached_lookups_are_refreshed_once_per_step(db_obj, url_db):
+    db_obj.register_user(_user("user01"))
+    db_obj_other = _connect(url_db)
+    assert list(db_obj_other.get_info_user(balances=False)[db_p.ID_USER]) == ["user01"]
+
+    # users registered through another connection are only seen after the versions were checked
+    db_obj.register_user(_user("user02"))
+    list_statements = _count_queries(db_obj_other)
+    assert list(db_obj_other.get_info_user(balances=False)[db_p.ID_USER]) == ["user01"]
+    assert list_statements == []
+    db_obj_other.refresh_cache()
+    assert sorted(db_obj_other.get_info_user(balances=False)[db_p.ID_USER]) == ["user01", "user02"]
+    assert db_obj_other.get_mapping_to_user()["ma_user02"] == "user02"
+
+    # modifications through the connection itself are seen right away
+    db_obj_other.delete_user("user01")
+    assert list(db_obj_other.get_info_user(balances=False)[db_p.ID_USER]) == ["user02"]
+
+    # balance updates are not cached, so they neither invalidate the cache nor wait for a refresh
+    db_obj_other.get_mapping_to_user()
+    db_obj.update_balance_user(pd.DataFrame({db_p.DELTA_BALANCE: [5], db_p.T_UPDATE_BALANCE: [900],
+                                             db_p.ID_USER: ["user02"]}))
+    info_user = db_obj_other.get_info_user()
+    assert list(info_user.columns) == db_obj_other.get_table_columns(db_p.NAME_TABLE_INFO_USER)
+    assert info_user.loc[0, db_p.BALANCE_ACCOUNT] == 5 and info_user.loc[0, db_p.T_UPDATE_BALANCE] == 900
+    db_obj_other.refresh_cache()
+    list_statements.clear()
+    db_obj_other.get_mapping_to_user()
+    assert list_statements == []
+    db_obj_other.end_connection()
+
+
+def test_get_open_positions_aggregated(db_obj):
+    db_obj.post_positions(_positions(POSITIONS + [("user01", "bid", 4, 900, 50, "na", 2),
+                                                  ("user02", "bid", 2, 900, 50, "local", 1),
+                                                  ("user02", "offer", 3, 900, 35, "na", 8)]), t_override=100)
+
+    bids, offers = db_obj.get_open_positions(ts_delivery_first=900, ts_delivery_last=900, aggregate=True)
+
+    # identical positions of a user are summed up, the book is sorted in clearing order
+    assert list(zip(bids[db_p.ID_USER], bids[db_p.PRICE_ENERGY], bids[db_p.QTY_ENERGY])) == \
+        [("user02", 55, 4), ("user01", 50, 5), ("user02", 50, 1)]
+    assert list(bids[db_p.NUMBER_POSITION]) == [0, 0, 2]
+    assert list(zip(offers[db_p.ID_USER], offers[db_p.PRICE_ENERGY])) == [("user02", 35), ("user01", 40)]
+    assert bids[db_p.QTY_ENERGY].dtype == "int64"
+
+
+def test_get_open_positions_aggregated_archives_individual_positions(db_obj):
+    _skip_sqlite(db_obj)
+    db_obj.post_positions(_positions(POSITIONS + [("user01", "bid", 4, 900, 50, "na", 2)]), t_override=100)
+
+    for clear_table in [False, True]:
+        bids, _ = db_obj.get_open_positions(ts_delivery_first=900, ts_delivery_last=900, clear_table=clear_table,
+                                            archive=True, aggregate=True)
+        assert list(zip(bids[db_p.ID_USER], bids[db_p.QTY_ENERGY])) == [("user02", 4), ("user01", 5)]
+
+    bids_archived, _ = db_obj.get_positions_archive()
+    assert _numbers(bids_archived) == sorted(2 * [("user01", 0), ("user01", 4), ("user02", 0)])
+
+
+def test_get_results_market_ex_ante_by_user(db_obj):
+    table_name = db_p.NAME_TABLE_RESULTS_MARKET_EX_ANTE_ + db_obj.lem_config["types_clearing_ex_ante"][0]
+    # tuples of id_user_offer, id_user_bid, ts_delivery, t_cleared and qty_energy_traded
+    list_results = [("user01", "user02", 900, 100, 3),
+                    ("user02", "user03", 900, 100, 4),
+                    ("user03", "user01", 1800, 100, 5),
+                    ("user01", "user03", 2700, 100, 6),
+                    ("user01", "user02", 1800, 900, 7)]
+    db_obj.insert(table_name, pd.DataFrame([{db_p.ID_USER_OFFER: id_user_offer, db_p.NUMBER_POSITION_OFFER: i,
+                                             db_p.PRICE_ENERGY_OFFER: 40, db_p.ID_USER_BID: id_user_bid,
+                                             db_p.NUMBER_POSITION_BID: i, db_p.PRICE_ENERGY_BID: 50,
+                                             db_p.QTY_ENERGY_TRADED: qty_energy_traded, db_p.T_CLEARED: t_cleared,
+                                             db_p.TS_DELIVERY: ts_delivery}
+                                            for i, (id_user_offer, id_user_bid, ts_delivery, t_cleared,
+                                                    qty_energy_traded) in enumerate(list_results)]
+                                           ).reindex(columns=db_obj.get_table_columns(table_name), fill_value=0))
+
+    dict_results = db_obj.get_results_market_ex_ante_by_user(list_id_user=["user01", "user02", "user04"],
+                                                             ts_delivery_first=900, ts_delivery_last=1800,
+                                                             t_cleared_last=500)
+
+    # a position matched between two of the users belongs to both of them
+    assert list(dict_results) == ["user01", "user02", "user04"]
+    assert list(dict_results["user01"][db_p.QTY_ENERGY_TRADED]) == [3, 5]
+    assert list(dict_results["user02"][db_p.QTY_ENERGY_TRADED]) == [3, 4]
+    # the prefetched results of each user give the same results as querying them for the user alone
+    for id_user in ["user01", "user02", "user04"]:
+        dict_kwargs = {"id_user": id_user, "ts_delivery_first": 900, "ts_delivery_last": 1800, "t_cleared_last": 500}
+        results_queried, net_queried = db_obj.get_results_market_ex_ante(**dict_kwargs)
+        results_prefetched, net_prefetched = db_obj.get_results_market_ex_ante(results_market=dict_results[id_user],
+                                                                               **dict_kwargs)
+        # empty results of the database have an empty index of another type
+        pd.testing.assert_frame_equal(results_prefetched, results_queried, check_index_type=False)
+        if net_queried is not None:
+            pd.testing.assert_frame_equal(net_prefetched, net_queried)
+    assert dict_results["user04"].empty and dict_results["user04"][db_p.QTY_ENERGY_TRADED].dtype == "int64"
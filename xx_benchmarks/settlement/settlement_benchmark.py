@@ -0,0 +1,671 @@
+__author__ = "sdlumpp"
+__credits__ = []
+__license__ = ""
+__maintainer__ = "sdlumpp"
+__email__ = "sebastian.lumpp@tum.de"
+
+import copy
+import json
+import time
+import shutil
+import tempfile
+import warnings
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import feather as ft
+import sqlalchemy as db
+
+from ruamel.yaml import YAML
+from pathlib import Path
+
+import settlement_reference
+import lemlab.lem.settlement as settlement
+import lemlab.db_connection.db_param as db_p
+from lemlab.db_connection.db_connection import DatabaseConnection
+
+""" Benchmark of the settlement functions in lemlab.lem.settlement.
+    Meters, virtual meter trees, meter readings, ex-ante market results and settlement prices are synthesized at the
+    configured scales and settled in a SQLite database, so no PostgreSQL server or scenario is required. Every function
+    is timed individually on a copy of the database state it is called with during a simulation step. The same calls
+    are made to the reference implementation in settlement_reference.py and the resulting database tables are compared,
+    so optimizations of the settlement can be proven to be equivalent and faster."""
+
+ID_NULL = "0000000000"
+TS_DELIVERY_FIRST = 1609459200
+
+
+def run_settlement_benchmark(config_file_name):
+    # load configuration files
+    with open(f"{config_file_name}") as config_file:
+        config_bm = YAML().load(config_file)["benchmark"]
+    with open(f"{config_bm['path_config']}") as config_file:
+        config = YAML().load(config_file)
+
+    pool = None
+    if config_bm["n_processes_settlement"] > 1:
+        pool = mp.Pool(config_bm["n_processes_settlement"])
+
+    list_timing = []
+    try:
+        for type_settlement in config_bm["types_settlement"]:
+            lem_config = get_lem_config(config=config, config_bm=config_bm, type_settlement=type_settlement)
+            for n_users in config_bm["n_users"]:
+                for n_ts_delivery in config_bm["n_ts_delivery"]:
+                    print(f"\nSettlement {type_settlement}, {n_users} users, {n_ts_delivery} ts_delivery")
+                    with tempfile.TemporaryDirectory() as path_tmp:
+                        df_timing = run_benchmark_scale(config_bm=config_bm,
+                                                        lem_config=lem_config,
+                                                        id_retailer=config["retailer"]["id_user"],
+                                                        n_users=n_users,
+                                                        n_ts_delivery=n_ts_delivery,
+                                                        path_tmp=path_tmp,
+                                                        pool=pool)
+                    df_timing.insert(0, "type_settlement", type_settlement)
+                    df_timing.insert(1, "n_users", n_users)
+                    df_timing.insert(2, "n_ts_delivery", n_ts_delivery)
+                    print(df_timing.to_string(index=False))
+                    list_timing.append(df_timing)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    df_timing = pd.concat(list_timing, ignore_index=True)
+    t_current_str = pd.Timestamp.now().strftime("%Y-%m-%d-%H-%M-%S")
+    Path(config_bm["path_results"]).mkdir(parents=True, exist_ok=True)
+    df_timing.to_csv(f"{config_bm['path_results']}/{t_current_str}_settlement_benchmark.csv", index=False)
+
+    return df_timing
+
+
+def get_lem_config(config, config_bm, type_settlement):
+    """
+    Returns the lem config of a benchmark run.
+
+    :param config: dictionary, lemlab configuration
+    :param config_bm: dictionary, benchmark configuration
+    :param type_settlement: string, "ex_ante" or "ex_post"
+
+    :return: dictionary, lem config
+    """
+    lem_config = copy.deepcopy(config["lem"])
+    if type_settlement == "ex_post":
+        lem_config["types_clearing_ex_ante"] = {}
+    lem_config["settlement_processes"] = config_bm["n_processes_settlement"]
+    if config_bm["pricing_files"]:
+        lem_config["bal_energy_pricing_mechanism"] = "file"
+        lem_config["levy_pricing_mechanism"] = "file"
+    return lem_config
+
+
+def run_benchmark_scale(config_bm, lem_config, id_retailer, n_users, n_ts_delivery, path_tmp, pool=None):
+    """
+    Synthesizes the data of one benchmark scale and times all settlement functions in the order of a simulation step.
+
+    :param config_bm: dictionary, benchmark configuration
+    :param lem_config: dictionary, lem config
+    :param id_retailer: string, retailer id
+    :param n_users: integer, number of users
+    :param n_ts_delivery: integer, number of ts_delivery with meter readings
+    :param path_tmp: string, path to a temporary folder for the databases and lem files
+    :param pool: multiprocessing pool of update_balance_settlement or None
+
+    :return: DataFrame, one row per function with the median times and the result of the comparison
+    """
+    rng = np.random.default_rng(config_bm["seed"])
+    path_simulation = f"{path_tmp}/simulation"
+    create_lem_files(path_simulation=path_simulation, config_bm=config_bm, lem_config=lem_config,
+                     n_ts_delivery=n_ts_delivery, rng=rng)
+
+    # both implementations start from the same database state, which is advanced case by case
+    dict_path_state = {"current": f"{path_tmp}/state_current.db", "reference": f"{path_tmp}/state_reference.db"}
+    db_obj = create_database(path_db=dict_path_state["current"], lem_config=lem_config)
+    df_readings_missing = create_data(db_obj=db_obj, config_bm=config_bm, lem_config=lem_config,
+                                      id_retailer=id_retailer, n_users=n_users, n_ts_delivery=n_ts_delivery, rng=rng)
+    db_obj.end_connection()
+    shutil.copyfile(dict_path_state["current"], dict_path_state["reference"])
+    path_state_initial = f"{path_tmp}/state_initial.db"
+    shutil.copyfile(dict_path_state["current"], path_state_initial)
+
+    list_records = [run_case(case=case_meter_readings(), dict_path_state=dict_path_state, path_tmp=path_tmp,
+                             lem_config=lem_config, config_bm=config_bm)]
+
+    # the ts_delivery ready for settlement are determined by the processed meter readings
+    db_obj = connect_database(path_db=dict_path_state["current"], lem_config=lem_config)
+    list_ts_delivery = settlement.get_list_ts_delivery_ready(db_obj=db_obj)
+    db_obj.end_connection()
+    t_now = TS_DELIVERY_FIRST + (n_ts_delivery + 1) * 900
+
+    for case in get_cases(lem_config=lem_config, path_simulation=path_simulation, list_ts_delivery=list_ts_delivery,
+                          t_now=t_now, id_retailer=id_retailer, pool=pool):
+        list_records.append(run_case(case=case, dict_path_state=dict_path_state, path_tmp=path_tmp,
+                                     lem_config=lem_config, config_bm=config_bm))
+
+    list_records.append(run_check_late_readings(path_state_initial=path_state_initial, path_tmp=path_tmp,
+                                                path_simulation=path_simulation, lem_config=lem_config,
+                                                id_retailer=id_retailer, df_readings_missing=df_readings_missing,
+                                                t_now=t_now))
+
+    return pd.DataFrame(list_records)
+
+
+def case_meter_readings():
+    return {"name": "update_complete_meter_readings",
+            "current": lambda db_obj: settlement.update_complete_meter_readings(db_obj=db_obj),
+            "reference": lambda db_obj: settlement_reference.update_complete_meter_readings(db_obj=db_obj),
+            "tables": [db_p.NAME_TABLE_READINGS_METER_DELTA, db_p.NAME_TABLE_STATUS_SETTLEMENT],
+            "advance": True}
+
+
+def get_cases(lem_config, path_simulation, list_ts_delivery, t_now, id_retailer, pool=None):
+    """
+    Returns the benchmark cases following update_complete_meter_readings(), in the order of a simulation step.
+
+    Every case is a dictionary of
+        name:       name of the timed function
+        current:    callable with argument db_obj, calls the function of lemlab.lem.settlement
+        reference:  callable with argument db_obj, calls the equivalent functions of settlement_reference or None
+        tables:     list of tables that are compared after both calls
+        result:     "value" if the return values are compared, or the name of the table of the reference database
+                    that the DataFrame returned by current is compared to
+        advance:    if True, the following cases are called with the database state after this case
+
+    :param lem_config: dictionary, lem config
+    :param path_simulation: string, path to the folder containing the lem files
+    :param list_ts_delivery: list of integers, ts_delivery to be settled
+    :param t_now: integer, unix timestamp current time
+    :param id_retailer: string, retailer id
+    :param pool: multiprocessing pool of update_balance_settlement or None
+
+    :return: list of dictionaries
+    """
+    kwargs_transactions = {"t_now": t_now, "lem_config": lem_config, "list_ts_delivery": list_ts_delivery,
+                           "id_retailer": id_retailer}
+    tables_transactions = [db_p.NAME_TABLE_LOGS_TRANSACTIONS, db_p.NAME_TABLE_INFO_USER]
+    ex_ante = bool(lem_config["types_clearing_ex_ante"])
+
+    list_cases = [
+        {"name": "get_list_ts_delivery_ready",
+         "current": lambda db_obj: settlement.get_list_ts_delivery_ready(db_obj=db_obj),
+         "reference": lambda db_obj: settlement_reference.get_list_ts_delivery_ready(db_obj=db_obj),
+         "result": "value"},
+        {"name": "get_list_ts_delivery_overdue",
+         "current": lambda db_obj: settlement.get_list_ts_delivery_overdue(db_obj=db_obj, t_now=t_now, wait_max=0)},
+        {"name": "calculate_virtual_submeters",
+         "current": lambda db_obj: settlement.calculate_virtual_submeters(db_obj=db_obj,
+                                                                          list_ts_delivery=list_ts_delivery),
+         "reference": lambda db_obj: settlement_reference.calculate_virtual_submeters(
+             db_obj=db_obj, list_ts_delivery=list_ts_delivery),
+         "tables": [db_p.NAME_TABLE_READINGS_METER_DELTA]},
+        {"name": "set_prices_settlement",
+         "current": lambda db_obj: settlement.set_prices_settlement(db_obj=db_obj, path_simulation=path_simulation,
+                                                                    list_ts_delivery=list_ts_delivery),
+         "reference": lambda db_obj: settlement_reference.set_prices_settlement(
+             db_obj=db_obj, path_simulation=path_simulation, list_ts_delivery=list_ts_delivery),
+         "tables": [db_p.NAME_TABLE_PRICES_SETTLEMENT],
+         "advance": True},
+    ]
+    if lem_config["types_clearing_ex_post"]:
+        list_cases.append(
+            {"name": "set_community_price",
+             "current": lambda db_obj: settlement.set_community_price(
+                 db_obj=db_obj, path_simulation=path_simulation, lem_config=lem_config,
+                 list_ts_delivery=list_ts_delivery),
+             "reference": lambda db_obj: settlement_reference.set_community_price(
+                 db_obj=db_obj, path_simulation=path_simulation, lem_config=lem_config,
+                 list_ts_delivery=list_ts_delivery),
+             "tables": [db_p.NAME_TABLE_RESULTS_MARKET_EX_POST_ + lem_config["types_clearing_ex_post"][0]],
+             "advance": True})
+    if ex_ante:
+        list_cases += [
+            {"name": "determine_balancing_energy",
+             "current": lambda db_obj: settlement.determine_balancing_energy(db_obj=db_obj,
+                                                                             list_ts_delivery=list_ts_delivery),
+             "reference": lambda db_obj: settlement_reference.determine_balancing_energy(
+                 db_obj=db_obj, list_ts_delivery=list_ts_delivery),
+             "tables": [db_p.NAME_TABLE_ENERGY_BALANCING],
+             "advance": True},
+            {"name": "get_transactions_balancing",
+             "current": lambda db_obj: settlement.get_transactions_balancing(db_obj=db_obj, **kwargs_transactions),
+             "reference": lambda db_obj: settlement_reference.update_balance_balancing_costs(db_obj=db_obj,
+                                                                                             **kwargs_transactions),
+             "result": db_p.NAME_TABLE_LOGS_TRANSACTIONS},
+            {"name": "update_balance_balancing_costs",
+             "current": lambda db_obj: settlement.update_balance_balancing_costs(db_obj=db_obj,
+                                                                                 **kwargs_transactions),
+             "reference": lambda db_obj: settlement_reference.update_balance_balancing_costs(db_obj=db_obj,
+                                                                                             **kwargs_transactions),
+             "tables": tables_transactions}]
+    else:
+        list_cases += [
+            {"name": "get_transactions_ex_post",
+             "current": lambda db_obj: settlement.get_transactions_ex_post(db_obj=db_obj, **kwargs_transactions),
+             "reference": lambda db_obj: settlement_reference.update_balance_ex_post(db_obj=db_obj,
+                                                                                     **kwargs_transactions),
+             "result": db_p.NAME_TABLE_LOGS_TRANSACTIONS},
+            {"name": "update_balance_ex_post",
+             "current": lambda db_obj: settlement.update_balance_ex_post(db_obj=db_obj, **kwargs_transactions),
+             "reference": lambda db_obj: settlement_reference.update_balance_ex_post(db_obj=db_obj,
+                                                                                     **kwargs_transactions),
+             "tables": tables_transactions}]
+
+    def update_balance_settlement_reference(db_obj):
+        if ex_ante:
+            settlement_reference.update_balance_balancing_costs(db_obj=db_obj, **kwargs_transactions)
+        else:
+            settlement_reference.update_balance_ex_post(db_obj=db_obj, **kwargs_transactions)
+        settlement_reference.update_balance_levies(db_obj=db_obj, **kwargs_transactions)
+
+    def set_status_settled_reference(db_obj):
+        # the reference settlement labelled every settled ts_delivery separately
+        for ts_delivery in list_ts_delivery:
+            db_obj.set_status_settlement(pd.DataFrame().from_dict({
+                db_obj.db_param.TS_DELIVERY: [ts_delivery],
+                db_obj.db_param.STATUS_METER_READINGS_PROCESSED: [1],
+                db_obj.db_param.STATUS_SETTLEMENT_COMPLETE: [1]}))
+
+    list_cases += [
+        {"name": "get_transactions_levies",
+         "current": lambda db_obj: settlement.get_transactions_levies(db_obj=db_obj, **kwargs_transactions),
+         "reference": lambda db_obj: settlement_reference.update_balance_levies(db_obj=db_obj, **kwargs_transactions),
+         "result": db_p.NAME_TABLE_LOGS_TRANSACTIONS},
+        {"name": "update_balance_levies",
+         "current": lambda db_obj: settlement.update_balance_levies(db_obj=db_obj, **kwargs_transactions),
+         "reference": lambda db_obj: settlement_reference.update_balance_levies(db_obj=db_obj, **kwargs_transactions),
+         "tables": tables_transactions},
+        {"name": "update_balance_settlement",
+         "current": lambda db_obj: settlement.update_balance_settlement(db_obj=db_obj, pool=pool,
+                                                                        **kwargs_transactions),
+         "reference": update_balance_settlement_reference,
+         "tables": tables_transactions,
+         "advance": True},
+        {"name": "set_status_settled",
+         "current": lambda db_obj: settlement.set_status_settled(db_obj=db_obj, list_ts_delivery=list_ts_delivery),
+         "reference": set_status_settled_reference,
+         "tables": [db_p.NAME_TABLE_STATUS_SETTLEMENT],
+         "advance": True}]
+    return list_cases
+
+
+def run_check_late_readings(path_state_initial, path_tmp, path_simulation, lem_config, id_retailer,
+                            df_readings_missing, t_now):
+    """
+    Verifies the re-settlement of late meter readings against the settlement with all readings logged on time.
+
+    In the first run, all ts_delivery are settled, those with missing readings provisionally. The missing readings are
+    then logged late and re-settled with update_balance_late_readings(). In the second run, the missing readings are
+    logged before all ts_delivery are settled. The sums of the transactions of every user, ts_delivery and transaction
+    type and the balances of both runs must be equal. update_balance_late_readings() has no reference implementation,
+    so the settlement on time of the current implementation, verified by the other cases, serves as reference.
+
+    :param path_state_initial: string, path to the database state before the meter readings were processed
+    :param path_tmp: string, path to a temporary folder for the database copies
+    :param path_simulation: string, path to the folder containing the lem files
+    :param lem_config: dictionary, lem config
+    :param id_retailer: string, retailer id
+    :param df_readings_missing: DataFrame, the cumulative meter readings missing from the initial state
+    :param t_now: integer, unix timestamp current time, all ts_delivery are overdue
+
+    :return: dictionary, time of the re-settlement and result of the comparison
+    """
+    record = {"function": "update_balance_late_readings", "t_current": np.nan, "t_reference": np.nan,
+              "speedup": np.nan, "equal": None}
+    dict_results = {}
+    for run in ["late", "on_time"]:
+        path_db = f"{path_tmp}/work_{run}.db"
+        shutil.copyfile(path_state_initial, path_db)
+        db_obj = connect_database(path_db=path_db, lem_config=lem_config)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if run == "on_time":
+                db_obj.insert(db_p.NAME_TABLE_READINGS_METER_CUMULATIVE, df_readings_missing)
+            settle_step(db_obj=db_obj, path_simulation=path_simulation, lem_config=lem_config,
+                        id_retailer=id_retailer, t_now=t_now)
+            if run == "late":
+                db_obj.insert(db_p.NAME_TABLE_READINGS_METER_CUMULATIVE, df_readings_missing)
+                t_start = time.perf_counter()
+                cells_changed = settlement.update_complete_meter_readings(db_obj=db_obj)
+                settlement.update_balance_late_readings(db_obj=db_obj, t_now=t_now + 900,
+                                                        path_simulation=path_simulation, lem_config=lem_config,
+                                                        cells_changed=cells_changed, id_retailer=id_retailer)
+                record["t_current"] = time.perf_counter() - t_start
+        list_keys = [db_p.ID_USER, db_p.TS_DELIVERY, db_p.TYPE_TRANSACTION]
+        df_sums = read_table(db_obj, db_p.NAME_TABLE_LOGS_TRANSACTIONS).groupby(list_keys)[
+            [db_p.QTY_ENERGY, db_p.DELTA_BALANCE]].sum()
+        # entries that were corrected to zero are equal to entries that were never logged
+        dict_results[run] = {"transactions": df_sums[(df_sums != 0).any(axis=1)].reset_index(),
+                             "balances": read_table(db_obj, db_p.NAME_TABLE_INFO_USER)[
+                                 [db_p.ID_USER, db_p.BALANCE_ACCOUNT]]}
+        db_obj.end_connection()
+
+    record["equal"] = True
+    for name, df_late in dict_results["late"].items():
+        if not is_equal(df_late, dict_results["on_time"][name]):
+            print(f"update_balance_late_readings: {name} differ from the settlement with readings on time")
+            record["equal"] = False
+    return record
+
+
+def settle_step(db_obj, path_simulation, lem_config, id_retailer, t_now):
+    """
+    Settles all ts_delivery as a simulation step does, ts_delivery with missing readings provisionally.
+
+    :param db_obj: instance of DatabaseConnection
+    :param path_simulation: string, path to the folder containing the lem files
+    :param lem_config: dictionary, lem config
+    :param id_retailer: string, retailer id
+    :param t_now: integer, unix timestamp current time
+
+    :return None:
+    """
+    settlement.update_complete_meter_readings(db_obj=db_obj)
+    list_ts_delivery_provisional = settlement.get_list_ts_delivery_overdue(db_obj=db_obj, t_now=t_now, wait_max=0)
+    list_ts_delivery = sorted(settlement.get_list_ts_delivery_ready(db_obj=db_obj) + list_ts_delivery_provisional)
+    settlement.set_prices_settlement(db_obj=db_obj, path_simulation=path_simulation, list_ts_delivery=list_ts_delivery)
+    if lem_config["types_clearing_ex_post"]:
+        settlement.set_community_price(db_obj=db_obj, path_simulation=path_simulation, lem_config=lem_config,
+                                       list_ts_delivery=list_ts_delivery)
+    if lem_config["types_clearing_ex_ante"]:
+        settlement.determine_balancing_energy(db_obj=db_obj, list_ts_delivery=list_ts_delivery)
+    settlement.update_balance_settlement(db_obj=db_obj, list_ts_delivery=list_ts_delivery, lem_config=lem_config,
+                                         t_now=t_now, id_retailer=id_retailer)
+    settlement.set_status_settled(db_obj=db_obj, list_ts_delivery=list_ts_delivery,
+                                  list_ts_delivery_provisional=list_ts_delivery_provisional)
+
+
+def run_case(case, dict_path_state, path_tmp, lem_config, config_bm):
+    """
+    Times a benchmark case and compares the results of the current and the reference implementation.
+
+    Every call is made on a fresh copy of the database state, so that repeated calls find the same state.
+
+    :param case: dictionary, see get_cases()
+    :param dict_path_state: dictionary, paths to the database states of the current and the reference implementation
+    :param path_tmp: string, path to a temporary folder for the database copies
+    :param lem_config: dictionary, lem config
+    :param config_bm: dictionary, benchmark configuration
+
+    :return: dictionary, function name, median times in seconds, speedup and result of the comparison
+    """
+    list_implementations = ["current"]
+    if config_bm["reference"] and case.get("reference") is not None:
+        list_implementations.append("reference")
+
+    record = {"function": case["name"], "t_current": np.nan, "t_reference": np.nan, "speedup": np.nan, "equal": None}
+    dict_path_work = {}
+    dict_results = {}
+    for implementation in list_implementations:
+        dict_path_work[implementation] = f"{path_tmp}/work_{implementation}.db"
+        list_t = []
+        for _ in range(config_bm["n_repetitions"]):
+            shutil.copyfile(dict_path_state[implementation], dict_path_work[implementation])
+            db_obj = connect_database(path_db=dict_path_work[implementation], lem_config=lem_config)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                t_start = time.perf_counter()
+                dict_results[implementation] = case[implementation](db_obj)
+                list_t.append(time.perf_counter() - t_start)
+            db_obj.end_connection()
+        record[f"t_{implementation}"] = float(np.median(list_t))
+
+    if "reference" in list_implementations:
+        record["speedup"] = record["t_reference"] / record["t_current"]
+        record["equal"] = compare_case(case=case, dict_path_work=dict_path_work, dict_results=dict_results,
+                                       lem_config=lem_config)
+
+    if case.get("advance", False):
+        for implementation in list_implementations:
+            shutil.copyfile(dict_path_work[implementation], dict_path_state[implementation])
+        # without a reference call, the reference state is advanced by the current implementation
+        if "reference" not in list_implementations:
+            shutil.copyfile(dict_path_work["current"], dict_path_state["reference"])
+
+    return record
+
+
+def compare_case(case, dict_path_work, dict_results, lem_config):
+    """
+    Compares the tables and results of a case after the calls of the current and the reference implementation.
+
+    :param case: dictionary, see get_cases()
+    :param dict_path_work: dictionary, paths to the databases after the last calls
+    :param dict_results: dictionary, return values of the last calls
+    :param lem_config: dictionary, lem config
+
+    :return: bool, True if all compared tables and results are equal
+    """
+    db_current = connect_database(path_db=dict_path_work["current"], lem_config=lem_config)
+    db_reference = connect_database(path_db=dict_path_work["reference"], lem_config=lem_config)
+    equal = True
+    for table_name in case.get("tables", []):
+        if not is_equal(read_table(db_current, table_name), read_table(db_reference, table_name)):
+            print(f"{case['name']}: table {table_name} differs from reference")
+            equal = False
+    if case.get("result") == "value":
+        if sorted(dict_results["current"]) != sorted(dict_results["reference"]):
+            print(f"{case['name']}: result differs from reference")
+            equal = False
+    elif case.get("result") is not None:
+        # the returned DataFrame is compared to the table written by the reference implementation
+        df_result = dict_results["current"]
+        if df_result is None:
+            df_result = pd.DataFrame(columns=read_table(db_reference, case["result"]).columns)
+        df_reference = read_table(db_reference, case["result"])[list(df_result.columns)]
+        if not is_equal(df_result.reset_index(drop=True), df_reference):
+            print(f"{case['name']}: result differs from table {case['result']} of reference")
+            equal = False
+    db_current.end_connection()
+    db_reference.end_connection()
+    return equal
+
+
+def create_database(path_db, lem_config):
+    db_obj = connect_database(path_db=path_db, lem_config=lem_config)
+    for table in db_obj.list_tables:
+        db_obj._create_table(table)
+    return db_obj
+
+
+def connect_database(path_db, lem_config):
+    # the connection is created as for PostgreSQL and bound to the SQLite database file afterwards
+    db_obj = DatabaseConnection(db_dict={"user": "lemlab", "pw": "", "host": "localhost", "port": 5432, "db": "lemlab"},
+                                lem_config=lem_config)
+    db_obj.engine.dispose()
+    db_obj.engine = db.create_engine(f"sqlite:///{path_db}")
+    return db_obj
+
+
+def read_table(db_obj, table_name):
+    return pd.read_sql_query(f"SELECT * FROM {table_name}", db_obj.engine)
+
+
+def is_equal(df_current, df_reference):
+    # tables are compared independent of the row order and the integer and float types of their columns
+    if sorted(df_current.columns) != sorted(df_reference.columns) or len(df_current) != len(df_reference):
+        return False
+    list_columns = sorted(df_current.columns)
+    df_current = df_current[list_columns].sort_values(list_columns).reset_index(drop=True)
+    df_reference = df_reference[list_columns].sort_values(list_columns).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(df_current, df_reference, check_dtype=False, check_exact=False)
+    except AssertionError:
+        return False
+    return True
+
+
+def create_lem_files(path_simulation, config_bm, lem_config, n_ts_delivery, rng):
+    """
+    Writes the lem files read by the settlement: config, pricing curves and settlement price time series.
+
+    :param path_simulation: string, path to the simulation folder to be created
+    :param config_bm: dictionary, benchmark configuration
+    :param lem_config: dictionary, lem config
+    :param n_ts_delivery: integer, number of ts_delivery with meter readings
+    :param rng: numpy random generator
+
+    :return None:
+    """
+    Path(f"{path_simulation}/lem").mkdir(parents=True, exist_ok=True)
+    with open(f"{path_simulation}/lem/config_account.json", "w+") as write_file:
+        json.dump(lem_config, write_file)
+    for type_pricing in lem_config["types_pricing_ex_post"]:
+        str_type_pricing = lem_config["types_pricing_ex_post"][type_pricing]
+        shutil.copyfile(f"{config_bm['path_input_data']}/lem/ex_post_pricing/{str_type_pricing}.json",
+                        f"{path_simulation}/lem/{str_type_pricing}.json")
+
+    # settlement prices in EUR/kWh for every ts_delivery
+    array_timestamp = TS_DELIVERY_FIRST + 900 * np.arange(n_ts_delivery + 1)
+    ft.write_dataframe(pd.DataFrame({"timestamp": array_timestamp,
+                                     "price_balancing_energy_positive": rng.uniform(0.05, 0.5, len(array_timestamp)),
+                                     "price_balancing_energy_negative": rng.uniform(-0.1, 0.1, len(array_timestamp))}),
+                       f"{path_simulation}/lem/balancing_prices.ft")
+    ft.write_dataframe(pd.DataFrame({"timestamp": array_timestamp,
+                                     "price_energy_levies_positive": rng.uniform(0, 0.05, len(array_timestamp)),
+                                     "price_energy_levies_negative": rng.uniform(0.1, 0.25, len(array_timestamp))}),
+                       f"{path_simulation}/lem/levy_prices.ft")
+
+
+def create_data(db_obj, config_bm, lem_config, id_retailer, n_users, n_ts_delivery, rng):
+    """
+    Synthesizes users, meter trees, cumulative meter readings, settlement status and ex-ante market results.
+
+    Every user has a grid meter with one to three plant submeters. Depending on the configured shares, the grid meter
+    or one plant submeter is virtual, a dividing meter with its own plant submeters is added, the plant submeters are
+    removed halfway through the period and single meter readings are missing. Grid and dividing meters measure the
+    sum of their submeters plus an unmetered household load. A virtual meter measures the difference of its
+    supermeter and its siblings.
+
+    :param db_obj: instance of DatabaseConnection
+    :param config_bm: dictionary, benchmark configuration
+    :param lem_config: dictionary, lem config
+    :param id_retailer: string, retailer id
+    :param n_users: integer, number of users
+    :param n_ts_delivery: integer, number of ts_delivery with meter readings
+    :param rng: numpy random generator
+
+    :return: DataFrame, the cumulative meter readings that are missing from the database
+    """
+    types_meter = lem_config["types_meter"]
+    types_quality = list(lem_config["types_quality"].values())
+    ts_delivery_last = 2 ** 31 - 1
+    ts_delivery_removed = TS_DELIVERY_FIRST + (n_ts_delivery // 2) * 900
+
+    list_users, list_meters = [], []
+    dict_flows = {}
+
+    def add_meter(id_meter, id_user, id_meter_super, type_meter, flows=None, ts_first=TS_DELIVERY_FIRST,
+                  ts_last=ts_delivery_last, quality="na"):
+        list_meters.append({db_p.ID_METER: id_meter, db_p.ID_USER: id_user, db_p.ID_METER_SUPER: id_meter_super,
+                            db_p.TYPE_METER: types_meter[type_meter], db_p.ID_AGGREGATOR: ID_NULL,
+                            db_p.QUALITY_ENERGY: quality, db_p.TS_DELIVERY_FIRST: ts_first,
+                            db_p.TS_DELIVERY_LAST: ts_last, db_p.INFO_ADDITIONAL: ""})
+        if flows is not None:
+            dict_flows[id_meter] = flows
+
+    def flows_plant():
+        return rng.integers(-500, 500, n_ts_delivery)
+
+    def flows_household():
+        return rng.integers(-300, 0, n_ts_delivery)
+
+    for i in range(n_users):
+        id_user = f"user{i:06d}"
+        id_meter_main = f"m{i:09d}"
+        main_virtual = rng.random() < config_bm["share_main_meters_virtual"]
+        sub_virtual = not main_virtual and rng.random() < config_bm["share_submeters_virtual"]
+        removed = rng.random() < config_bm["share_meters_removed"]
+        list_users.append({db_p.ID_USER: id_user, db_p.BALANCE_ACCOUNT: 0, db_p.T_UPDATE_BALANCE: 0,
+                           db_p.PRICE_ENERGY_BID_MAX: 0, db_p.PRICE_ENERGY_OFFER_MIN: 0,
+                           db_p.PREFERENCE_QUALITY: "na", db_p.PREMIUM_PREFERENCE_QUALITY: 0,
+                           db_p.STRATEGY_MARKET_AGENT: "linear", db_p.HORIZON_TRADING: 4,
+                           db_p.ID_MARKET_AGENT: f"ma{i:08d}", db_p.TS_DELIVERY_FIRST: TS_DELIVERY_FIRST,
+                           db_p.TS_DELIVERY_LAST: ts_delivery_last})
+
+        flows_main = np.zeros(n_ts_delivery, dtype=np.int64) if main_virtual else flows_household()
+        for k in range(rng.integers(1, 4)):
+            quality = types_quality[k % len(types_quality)]
+            if sub_virtual and k == 0:
+                # the virtual submeter measures the household load of the grid meter
+                add_meter(f"s{i:06d}{k:03d}", id_user, id_meter_main, 1, quality=quality)
+                continue
+            flows = flows_plant()
+            if removed:
+                # the plant does not feed in after the removal of its meter
+                flows[n_ts_delivery // 2:] = 0
+                add_meter(f"s{i:06d}{k:03d}", id_user, id_meter_main, 0, flows=flows,
+                          ts_last=ts_delivery_removed - 900, quality=quality)
+            else:
+                add_meter(f"s{i:06d}{k:03d}", id_user, id_meter_main, 0, flows=flows, quality=quality)
+            flows_main = flows_main + flows
+        if rng.random() < config_bm["share_dividing_meters"]:
+            id_meter_dividing = f"d{i:09d}"
+            flows_dividing = np.zeros(n_ts_delivery, dtype=np.int64) if main_virtual else flows_household()
+            for k in range(rng.integers(1, 3)):
+                flows = flows_plant()
+                flows_dividing = flows_dividing + flows
+                add_meter(f"p{i:06d}{k:03d}", id_user, id_meter_dividing, 0, flows=flows,
+                          quality=types_quality[k % len(types_quality)])
+            add_meter(id_meter_dividing, id_user, id_meter_main, 2, flows=flows_dividing)
+            flows_main = flows_main + flows_dividing
+        add_meter(id_meter_main, id_user, ID_NULL, 5 if main_virtual else 4,
+                  flows=None if main_virtual else flows_main)
+
+    # cumulative readings at the start of every ts_delivery and at the end of the last one, removed meters only
+    # report readings while they are active
+    df_meters = pd.DataFrame(list_meters).set_index(db_p.ID_METER)
+    list_readings = []
+    array_t_reading = TS_DELIVERY_FIRST + 900 * np.arange(n_ts_delivery + 1)
+    for id_meter, flows in dict_flows.items():
+        flows = np.concatenate([[0], flows])
+        mask = (array_t_reading >= df_meters.at[id_meter, db_p.TS_DELIVERY_FIRST]) \
+            & (array_t_reading <= df_meters.at[id_meter, db_p.TS_DELIVERY_LAST] + 900)
+        list_readings.append(pd.DataFrame({db_p.T_READING: array_t_reading[mask],
+                                           db_p.ID_METER: id_meter,
+                                           db_p.ENERGY_IN_CUM: np.cumsum(np.maximum(-flows, 0))[mask],
+                                           db_p.ENERGY_OUT_CUM: np.cumsum(np.maximum(flows, 0))[mask]}))
+
+    df_readings = pd.concat(list_readings, ignore_index=True)
+    # a missing reading of a single meter keeps the ts_delivery before and after it from being settled
+    n_missing = int(config_bm["share_ts_delivery_incomplete"] * n_ts_delivery / 2)
+    array_t_missing = rng.choice(array_t_reading, n_missing, replace=False)
+    index_missing = [rng.choice(df_readings.index[df_readings[db_p.T_READING] == t_missing])
+                     for t_missing in array_t_missing]
+    df_readings_missing = df_readings.loc[index_missing].reset_index(drop=True)
+    df_readings = df_readings.drop(index=index_missing)
+
+    db_obj.insert(db_p.NAME_TABLE_INFO_USER, pd.DataFrame(list_users))
+    db_obj.insert(db_p.NAME_TABLE_INFO_METER, df_meters.reset_index())
+    db_obj.insert(db_p.NAME_TABLE_READINGS_METER_CUMULATIVE, df_readings)
+    db_obj.set_status_settlement(pd.DataFrame({
+        db_p.TS_DELIVERY: TS_DELIVERY_FIRST + 900 * np.arange(n_ts_delivery),
+        db_p.STATUS_METER_READINGS_PROCESSED: 0,
+        db_p.STATUS_SETTLEMENT_COMPLETE: 0}))
+
+    if lem_config["types_clearing_ex_ante"]:
+        # one trade per user and ts_delivery, every fifth one with the retailer
+        table_name = db_p.NAME_TABLE_RESULTS_MARKET_EX_ANTE_ + lem_config["types_clearing_ex_ante"][0]
+        n_trades = n_users * n_ts_delivery
+        df_results = pd.DataFrame(0, index=range(n_trades), columns=db_obj.get_table_columns(table_name))
+        array_bid = rng.integers(0, n_users, n_trades)
+        array_offer = (array_bid + rng.integers(1, max(n_users, 2), n_trades)) % n_users
+        df_results[db_p.ID_USER_BID] = [f"ma{i:08d}" for i in array_bid]
+        df_results[db_p.ID_USER_OFFER] = [f"ma{i:08d}" if k % 5 else id_retailer
+                                          for k, i in enumerate(array_offer)]
+        df_results[db_p.TS_DELIVERY] = TS_DELIVERY_FIRST + 900 * (np.arange(n_trades) // n_users)
+        df_results[db_p.QTY_ENERGY_TRADED] = rng.integers(1, 400, n_trades)
+        df_results[db_p.T_CLEARED] = TS_DELIVERY_FIRST - 900
+        df_results[db_p.NUMBER_POSITION_BID] = np.arange(n_trades)
+        df_results[db_p.NUMBER_POSITION_OFFER] = np.arange(n_trades)
+        for column in df_results.columns:
+            if column.startswith("price"):
+                df_results[column] = rng.integers(10000, 30000, n_trades)
+        db_obj.insert(table_name, df_results)
+
+    return df_readings_missing
+
+
+if __name__ == '__main__':
+    # Run settlement benchmark ###
+    config_file_name = "settlement_benchmark_config.yaml"
+    df_timing_results = run_settlement_benchmark(config_file_name=config_file_name)
@@ -0,0 +1,250 @@
+__author__ = "sdlumpp"
+__credits__ = []
+__license__ = ""
+__maintainer__ = "sdlumpp"
+__email__ = "sebastian.lumpp@tum.de"
+
+import os
+import json
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import feather as ft
+
+from ruamel.yaml import YAML
+from pathlib import Path
+
+from lemlab.utilities.state_store import StateStore, MemoryStateStore
+
+""" Benchmark of the agent state stores in lemlab.utilities.state_store.
+    Prosumer directories with raw data, SOCs, meter readings, logs, forecasts, controller results and price histories
+    are synthesized at the configured scales. Every simulated step, each agent reads and writes its states in the order
+    and shape of Prosumer.pre_clearing_activity() and Prosumer.post_clearing_activity(), so no PostgreSQL server,
+    scenario or solver is required. The state files written through the in-memory stores are compared to those written
+    by the file-based store, so the stores can be proven to be equivalent."""
+
+TS_DELIVERY_FIRST = 1609459200
+ID_METER_GRID = "meter_grid"
+LIST_PLANTS = ["hh01", "pv01", "bat01"]
+
+
+def run_state_store_benchmark(config_file_name):
+    # load configuration file
+    with open(f"{config_file_name}") as config_file:
+        config_bm = YAML().load(config_file)["benchmark"]
+
+    list_timing = []
+    for n_agents in config_bm["n_agents"]:
+        print(f"\nState stores, {n_agents} agents, {config_bm['n_steps']} steps")
+        with tempfile.TemporaryDirectory(dir=config_bm["path_tmp"]) as path_tmp:
+            df_timing = run_benchmark_scale(config_bm=config_bm, n_agents=n_agents, path_tmp=path_tmp)
+        df_timing.insert(0, "n_agents", n_agents)
+        print(df_timing.to_string(index=False))
+        list_timing.append(df_timing)
+
+    df_timing = pd.concat(list_timing, ignore_index=True)
+    t_current_str = pd.Timestamp.now().strftime("%Y-%m-%d-%H-%M-%S")
+    Path(config_bm["path_results"]).mkdir(parents=True, exist_ok=True)
+    df_timing.to_csv(f"{config_bm['path_results']}/{t_current_str}_state_store_benchmark.csv", index=False)
+
+    return df_timing
+
+
+def run_benchmark_scale(config_bm, n_agents, path_tmp):
+    """
+    Synthesizes the agent directories of one benchmark scale once for every state store and simulates all steps.
+
+    The file-based store is always run first, as the states written by the other stores are compared to its states.
+
+    :param config_bm: dict, benchmark configuration
+    :param n_agents: int, number of agents
+    :param path_tmp: str, temporary directory for the agent directories
+
+    :return: DataFrame, timing results by state store
+    """
+    types_store = ["files"] + [type_store for type_store in config_bm["types_store"] if type_store != "files"]
+    list_results = []
+    for type_store in types_store:
+        list_paths = [f"{path_tmp}/{type_store}/prosumer/{i:06d}" for i in range(n_agents)]
+        for i, path_agent in enumerate(list_paths):
+            create_agent(path_agent=path_agent, config_bm=config_bm, seed=[config_bm["seed"], i])
+        list_stores = [create_store(type_store=type_store, path_agent=path_agent) for path_agent in list_paths]
+
+        list_t_step = []
+        t_checkpoint = 0
+        for step in range(config_bm["n_steps"]):
+            t_start = time.perf_counter()
+            for i, store in enumerate(list_stores):
+                step_agent(store=store, step=step, seed=[config_bm["seed"], i, step])
+            list_t_step.append(time.perf_counter() - t_start)
+            if (step + 1) % config_bm["n_steps_checkpoint"] == 0:
+                t_start = time.perf_counter()
+                for store in list_stores:
+                    store.checkpoint()
+                t_checkpoint += time.perf_counter() - t_start
+        # the final checkpoint writes all remaining states, as at the end of a simulation
+        t_start = time.perf_counter()
+        for store in list_stores:
+            store.checkpoint()
+        t_checkpoint += time.perf_counter() - t_start
+
+        equal = True
+        if type_store != "files":
+            equal = all(is_equal_agent(path_agent=path_agent,
+                                       path_agent_files=path_agent.replace(f"/{type_store}/", "/files/"))
+                        for path_agent in list_paths)
+        list_results.append({"type_store": type_store,
+                             "t_step_median": np.median(list_t_step),
+                             "t_step_max": max(list_t_step),
+                             "t_checkpoint": t_checkpoint,
+                             "t_total": sum(list_t_step) + t_checkpoint,
+                             "equal": equal})
+
+    df_timing = pd.DataFrame(list_results)
+    df_timing["speedup"] = df_timing.loc[df_timing["type_store"] == "files", "t_total"].iloc[0] / df_timing["t_total"]
+    return df_timing
+
+
+def create_store(type_store, path_agent):
+    if type_store == "memory":
+        return MemoryStateStore(path=path_agent)
+    if type_store == "memory_async":
+        return MemoryStateStore(path=path_agent, write_async=True)
+    return StateStore(path=path_agent)
+
+
+def step_agent(store, step, seed):
+    """
+    Reads and writes the states of an agent as a prosumer with a household, PV plant and battery does in one
+    simulation step. Values are derived from the seed only, so all stores write the same states.
+
+    :param store: StateStore of the agent
+    :param step: int, number of the simulated step
+    :param seed: list of int, seed of the values of the agent in this step
+
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    ts_delivery_prev = TS_DELIVERY_FIRST + step * 900
+    ts_delivery_current = ts_delivery_prev + 900
+
+    # real-time controller, see Prosumer.controller_real_time()
+    df_target_grid_power = store.read_dataframe("target_grid_power.ft").set_index("timestamp")
+    p_hh = store.read_dataframe("raw_data_hh01.ft").set_index("timestamp").loc[ts_delivery_prev, "power"]
+    p_pv = store.read_dataframe("raw_data_pv01.ft", columns=["timestamp", "power"]
+                                ).set_index("timestamp").loc[ts_delivery_prev, "power"]
+    p_bat = float(df_target_grid_power["power_bat01"].iloc[0]) if len(df_target_grid_power) else 0
+    soc_bat = store.read_json("soc_bat01.json")
+    store.write_json("soc_bat01.json", min(max(soc_bat + 0.25 * p_bat, 0), 10000))
+    meas_val = {"timestamp": ts_delivery_prev, "hh01": int(p_hh), "pv01": int(p_pv), "bat01": int(p_bat)}
+    meas_val[ID_METER_GRID] = sum(meas_val[plant] for plant in LIST_PLANTS)
+    store.write_json("controller_rtc.json", meas_val)
+
+    # logging of meter readings, see Prosumer.log_meter_readings() and Prosumer._set_new_meter_reading_local()
+    df_log_ems = store.read_dataframe("log_ems.ft").set_index("timestamp")
+    df_log_ems.loc[ts_delivery_prev] = [meas_val[ID_METER_GRID] / 4] + [meas_val[plant] / 4 for plant in LIST_PLANTS]
+    df_log_ems.index.name = "timestamp"
+    dict_buffer = store.read_dataframe("buffer_meter_readings.ft").to_dict()
+    for id_meter in [ID_METER_GRID] + LIST_PLANTS:
+        reading = store.read_json(f"meter_{id_meter}.json")
+        energy = meas_val[id_meter] / 4
+        reading_new = [reading[0] + max(-energy, 0), reading[1] + max(energy, 0)]
+        store.write_json(f"meter_{id_meter}.json", reading_new)
+        index = len(dict_buffer["t_reading"])
+        dict_buffer["t_reading"][index] = ts_delivery_current
+        dict_buffer["energy_in_cum"][index] = reading_new[0]
+        dict_buffer["energy_out_cum"][index] = reading_new[1]
+        dict_buffer["id_meter"][index] = id_meter
+        dict_buffer["t_send"][index] = int(ts_delivery_current + 900 * rng.integers(0, 3))
+    store.write_dataframe("buffer_meter_readings.ft", pd.DataFrame.from_dict(dict_buffer))
+    store.write_dataframe("log_ems.ft", df_log_ems.round().reset_index())
+    df_buffer = store.read_dataframe("buffer_meter_readings.ft")
+    store.write_dataframe("buffer_meter_readings.ft", df_buffer[df_buffer["t_send"] > ts_delivery_current + 60])
+
+    # price history, see Prosumer.update_price_history()
+    df_price_history = store.read_dataframe("price_history.ft").set_index("timestamp")
+    df_price_history.loc[ts_delivery_prev] = rng.uniform(0.05, 0.3, len(df_price_history.columns))
+    store.write_dataframe("price_history.ft", df_price_history.reset_index())
+
+    # forecasts and model predictive control, see ForecastManager.update_forecasts() and
+    # Prosumer.controller_model_predictive()
+    df_fcast = store.read_dataframe("fcasts_current.ft").set_index("timestamp")
+    df_fcast.index = df_fcast.index + 900
+    df_fcast[:] = rng.normal(0, 1000, df_fcast.shape).round()
+    store.write_dataframe("fcasts_current.ft", df_fcast.reset_index())
+    df_mpc = store.read_dataframe("fcasts_current.ft").set_index("timestamp")
+    df_mpc["power_bat01"] = rng.normal(0, 500, len(df_mpc)).round()
+    store.write_dataframe("controller_mpc.ft", df_mpc.reset_index())
+    store.write_dataframe(f"controller_mpc_{ts_delivery_current}.ft", df_mpc.reset_index(), keep=False)
+
+    # target grid power, see Prosumer.set_target_grid_power()
+    df_target_grid_power = store.read_dataframe("controller_mpc.ft").set_index("timestamp")
+    df_target_grid_power[f"power_{ID_METER_GRID}"] = df_target_grid_power.sum(axis=1)
+    store.write_dataframe("target_grid_power.ft", df_target_grid_power.reset_index())
+
+
+def create_agent(path_agent, config_bm, seed):
+    """
+    Writes the state files of an agent as they are after the setup of a simulation.
+
+    :param path_agent: str, path to the agent's directory
+    :param config_bm: dict, benchmark configuration
+    :param seed: list of int, seed of the synthetic raw data
+
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    Path(path_agent).mkdir(parents=True, exist_ok=True)
+    n_ts_raw_data = config_bm["n_days_raw_data"] * 96
+    timestamps = TS_DELIVERY_FIRST + 900 * np.arange(n_ts_raw_data)
+    ft.write_dataframe(pd.DataFrame({"timestamp": timestamps, "power": rng.integers(0, 3000, n_ts_raw_data)}),
+                       f"{path_agent}/raw_data_hh01.ft")
+    ft.write_dataframe(pd.DataFrame({"timestamp": timestamps, "power": -rng.integers(0, 5000, n_ts_raw_data)}),
+                       f"{path_agent}/raw_data_pv01.ft")
+    with open(f"{path_agent}/soc_bat01.json", "w") as write_file:
+        json.dump(5000, write_file)
+    for id_meter in [ID_METER_GRID] + LIST_PLANTS:
+        with open(f"{path_agent}/meter_{id_meter}.json", "w") as write_file:
+            json.dump([0, 0], write_file)
+    ft.write_dataframe(pd.DataFrame(columns=["timestamp", ID_METER_GRID] + LIST_PLANTS), f"{path_agent}/log_ems.ft")
+    ft.write_dataframe(pd.DataFrame(columns=["t_reading", "id_meter", "energy_in_cum", "energy_out_cum", "t_send"]),
+                       f"{path_agent}/buffer_meter_readings.ft")
+    ft.write_dataframe(pd.DataFrame({"timestamp": TS_DELIVERY_FIRST - 900 * np.arange(96, 0, -1),
+                                     "price_energy_levies_positive": 0.1,
+                                     "price_energy_levies_negative": 0.1,
+                                     "weighted_average_price": 0.2}),
+                       f"{path_agent}/price_history.ft")
+    ts_horizon = TS_DELIVERY_FIRST + 900 * np.arange(config_bm["mpc_horizon"])
+    ft.write_dataframe(pd.DataFrame({"timestamp": ts_horizon,
+                                     **{f"power_{plant}": 0.0 for plant in LIST_PLANTS},
+                                     "price": 0.0}),
+                       f"{path_agent}/fcasts_current.ft")
+    ft.write_dataframe(pd.DataFrame({"timestamp": ts_horizon,
+                                     **{f"power_{plant}": 0.0 for plant in LIST_PLANTS},
+                                     f"power_{ID_METER_GRID}": 0.0}),
+                       f"{path_agent}/target_grid_power.ft")
+
+
+def is_equal_agent(path_agent, path_agent_files):
+    # all state files must be the same as those written by the file-based store
+    list_files = sorted(os.listdir(path_agent))
+    if list_files != sorted(os.listdir(path_agent_files)):
+        print(f"Files of {path_agent} differ from those of the file-based store")
+        return False
+    for file in list_files:
+        if file.endswith(".json"):
+            with open(f"{path_agent}/{file}") as read_file, open(f"{path_agent_files}/{file}") as read_file_files:
+                equal = json.load(read_file) == json.load(read_file_files)
+        else:
+            equal = ft.read_dataframe(f"{path_agent}/{file}").equals(ft.read_dataframe(f"{path_agent_files}/{file}"))
+        if not equal:
+            print(f"{path_agent}/{file} differs from the file of the file-based store")
+            return False
+    return True
+
+
+if __name__ == '__main__':
+    # Run state store benchmark ###
+    config_file_name = "state_store_benchmark_config.yaml"
+    run_state_store_benchmark(config_file_name)